@@ -11,7 +11,11 @@ _defaults = {
     'lunch_end': 1205, # there is no break between the end of lunch and the next class
     'time_between_classes': 10, # amount of minutes between classes
     'default_max_class_size' : 30,
-    'default_min_class_size' : 0
+    'default_min_class_size' : 0,
+    'schedule_job_workers': 1, # schedules made at the same time (see schedule_jobs)
+    'notification_verbosity': 'info', # info, warning or error, the least important notes kept
+    'notification_flush_interval': 2, # seconds between the inserts of the buffered notes
+    'schedule_view_cache_size': 16 # schedule views kept in memory (see schedule_views)
 }
 
 # Named tuple (read only) which stores config values
@@ -24,7 +28,11 @@ _Config = namedtuple('_Config', [
     'lunch_end',
     'time_between_classes',
     'default_max_class_size',
-    'default_min_class_size'
+    'default_min_class_size',
+    'schedule_job_workers',
+    'notification_verbosity',
+    'notification_flush_interval',
+    'schedule_view_cache_size'
 ])
 
 # Basically a singleton here, just so we don't spend time reading the config
@@ -0,0 +1,394 @@
+import unittest
+import os
+import subprocess
+import tempfile
+import time
+from datetime import datetime
+from flask import json
+from sqlalchemy import event
+from schoolbloc import app, db
+from schoolbloc.users.models import User
+from schoolbloc.scheduler.models import *
+from schoolbloc.scheduler.schedule_data import ScheduleData
+from schoolbloc.scheduler.scheduler import Scheduler
+from schoolbloc.scheduler.schedule_jobs import ScheduleJobQueue, process_start_time
+from schoolbloc.scheduler.worker import JobProgress
+import schoolbloc.scheduler.scheduler_util as SchedUtil
+import schoolbloc.scheduler.schedule_views as schedule_views
+import schoolbloc.scheduler.restexport as restexport
+import schoolbloc.scheduler.timeblock_cache as timeblock_cache
+from schoolbloc.scheduler.test_util import SchedulerTestUtilities as TestUtil
+from schoolbloc.testing.testing import BaseTestClass
+
+
+class ApiTests(BaseTestClass):
+    """ Tests the scheduler's REST api """
+
+    def setUp(self):
+        # a scratch database file rather than BaseTestClass.setUp's in memory database, which
+        # the forked placement workers and the job workers can't share
+        self.db_uri = app.config['SQLALCHEMY_DATABASE_URI']
+        self.db_fd, self.db_path = tempfile.mkstemp(suffix='.db')
+        # the objects of the earlier tests' session belong to their database
+        db.session.remove()
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + self.db_path
+        self.app = app.test_client(use_cookies=False)
+        db.create_all()
+        self._create_roles()
+        for name in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']:
+            db.session.add(Day(name=name))
+        db.session.add(User(username='admin', password='admin', role_type='admin'))
+        db.session.commit()
+        key, _ = self.login('admin', 'admin')
+        self.headers = {'Authorization': 'JWT {}'.format(key)}
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        app.config['SQLALCHEMY_DATABASE_URI'] = self.db_uri
+        os.close(self.db_fd)
+        os.unlink(self.db_path)
+
+    def get_json(self, url):
+        response = self.app.get(url, headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        return self.parse_response_json(response)
+
+    def post_json(self, url, data):
+        response = self.app.post(url, data=json.dumps(data), headers=self.headers,
+                                 content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return self.parse_response_json(response)
+
+    def put_json(self, url, data):
+        response = self.app.put(url, data=json.dumps(data), headers=self.headers,
+                                content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return self.parse_response_json(response)
+
+    def test_timeblock_cache(self):
+        TestUtil.generate_timeblocks()
+        timeblock = Timeblock.query.order_by(Timeblock.id).first()
+        url = '/api/timeblocks/{}?constraints=false'.format(timeblock.id)
+        self.assertEqual(self.get_json(url)['days'], ['Monday', 'Wednesday', 'Friday'])
+        self.assertEqual(ScheduleData([]).timeblocks[timeblock.id].days_string, 'Monday, Wednesday, Friday')
+
+        # the days and times changed through the api are seen by the next schedule
+        saturday = Day.query.filter_by(name='Saturday').one()
+        self.put_json('/api/timeblocks/{}'.format(timeblock.id),
+                      {'start_time': 700, 'day': [{'method': 'add', 'id': saturday.id}]})
+        self.assertEqual(self.get_json(url)['days'], ['Monday', 'Wednesday', 'Friday', 'Saturday'])
+        info = ScheduleData([]).timeblocks[timeblock.id]
+        self.assertEqual((info.start_time, info.days_string), (700, 'Monday, Wednesday, Friday, Saturday'))
+
+        # a change flushed and rolled back is never cached, one flushed and committed is once
+        for commit, start_time in [(False, 700), (True, 600)]:
+            Timeblock.query.get(timeblock.id).start_time = 600
+            db.session.flush()
+            timeblock_cache.timeblocks()
+            if commit:
+                db.session.commit()
+            else:
+                db.session.rollback()
+            self.assertEqual(timeblock_cache.timeblock(timeblock.id).start_time, start_time)
+
+    def test_notifications(self):
+        # a sink which only writes the notes when they are flushed
+        sink = SchedUtil.sink
+        SchedUtil.sink = SchedUtil.NotificationSink(flush_interval=3600)
+        try:
+            self.check_notifications()
+        finally:
+            SchedUtil.sink = sink
+
+    def test_notification_failures(self):
+        # without the notifications table, the sink keeps the latest notes and stops retrying
+        # each time it fills up
+        sink = SchedUtil.NotificationSink(flush_interval=3600, max_buffered=3)
+        Notification.__table__.drop(db.engine)
+        for i in range(10):
+            sink.add({'type': 'info', 'subject': 'Scheduler', 'description': str(i),
+                      'created_at': datetime.now(), 'unread': True})
+        self.assertEqual(sink.failures, 1)
+        self.assertEqual([ row['description'] for row in sink.rows ], ['7', '8', '9'])
+        self.assertGreater(sink.retry_at, time.time())
+
+        Notification.__table__.create(db.engine)
+        sink.flush()
+        self.assertEqual((sink.failures, sink.rows), (0, []))
+        self.assertEqual([ note.description for note in Notification.query.order_by(Notification.id) ], ['7', '8', '9'])
+
+    def check_notifications(self):
+        # the notes are buffered, neither saved nor committing the scheduler's session
+        db.session.add(Day(name='Holiday'))
+        SchedUtil.log_note("info", "Scheduler", "Generating a mapping")
+        SchedUtil.log_note("error", "Scheduler", "No valid mapping exists")
+        self.assertEqual(Notification.query.count(), 0)
+        db.session.rollback()
+
+        SchedUtil.flush_notes()
+        notes = self.get_json('/api/notifications/unread')
+        self.assertEqual([ note['description'] for note in notes ], ["Generating a mapping", "No valid mapping exists"])
+        self.assertIsNone(Day.query.filter_by(name='Holiday').first())
+
+        # the notes below the verbosity are dropped
+        SchedUtil.set_verbosity('warning')
+        try:
+            SchedUtil.log_note("info", "Scheduler", "Attempting to solve using 3 classes")
+            SchedUtil.log_note("warning", "Scheduler", "Failed placing students")
+        finally:
+            SchedUtil.set_verbosity('info')
+        SchedUtil.flush_notes()
+        self.assertEqual([ note.description for note in Notification.query.order_by(Notification.id)[2:] ],
+                         ["Failed placing students"])
+        self.assertRaises(ValueError, SchedUtil.set_verbosity, 'debug')
+
+    def build_dataset(self):
+        """ one course, with a teacher and two rooms, for four students in classes of two """
+        TestUtil.generate_timeblocks()
+        teacher = TestUtil.generate_teachers(1)[0]
+        for room_number in [101, 102]:
+            db.session.add(Classroom(room_number=room_number))
+        course = Course(name="Algebra", max_student_count=2)
+        db.session.add(course)
+        db.session.flush()
+        db.session.add(CoursesTeacher(course_id=course.id, teacher_id=teacher.id, priority='high'))
+        for student in TestUtil.generate_students(4):
+            db.session.add(CoursesStudent(course_id=course.id, student_id=student.id, priority='mandatory'))
+        db.session.commit()
+
+    def count_queries(self, func, *args):
+        """ returns what func returned and the number of statements it sent to the database """
+        statements = []
+        def count_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', count_statement)
+        try:
+            return func(*args), len(statements)
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count_statement)
+
+    def test_schedule_views(self):
+        self.build_dataset()
+        schedule_id = Scheduler().make_schedule()
+        db.session.expire_all()
+        schedule = Schedule.query.get(schedule_id)
+
+        # whatever the number of classes and students, the views take the same queries
+        view, query_count = self.count_queries(schedule.student_serialize)
+        self.assertEqual(query_count, 1)
+        # the classes of each student, read through the relationships
+        expected = {}
+        for sch_class in schedule.scheduled_classes:
+            for student in sch_class.students:
+                expected.setdefault(student.id, []).append(
+                    (str(sch_class.classroom), str(sch_class.course), str(sch_class.teacher),
+                     [ day.strip() for day in sch_class.days.split(',') ]))
+        self.assertEqual(len(view['students']), 4)
+        self.assertEqual(dict((s['id'], [ (c['classroom'], c['course'], c['teacher'], c['days']) for c in s['classes'] ])
+                              for s in view['students']), expected)
+        self.assertEqual(self.get_json('/api/schedules/{}/student'.format(schedule_id)), view)
+
+        db.session.expire_all()
+        schedule = Schedule.query.get(schedule_id)
+        view, query_count = self.count_queries(schedule.serialize, True)
+        self.assertEqual(query_count, 2)
+        self.assertEqual(sorted(len(c['students']) for c in view['classes']), [2, 2])
+        self.assertEqual(self.get_json('/api/schedules/{}/class'.format(schedule_id)), json.loads(json.dumps(view)))
+
+    def test_schedule_view_cache(self):
+        self.build_dataset()
+        schedule_id = Scheduler().make_schedule()
+        schedule = Schedule.query.get(schedule_id)
+        student_view = json.loads(json.dumps(schedule.student_serialize()))
+
+        # the views are stored at save time and served from memory once read
+        self.assertEqual(ScheduleView.query.filter_by(schedule_id=schedule_id).count(), 2)
+        schedule_views.evict(schedule_id)
+        self.assertEqual(self.get_json('/api/schedules/{}/student'.format(schedule_id)), student_view)
+        data, query_count = self.count_queries(schedule_views.get, schedule_id, 'student')
+        self.assertEqual((json.loads(data.decode('utf-8')), query_count), (student_view, 0))
+
+        # a schedule without stored views is serialized on its first request
+        ScheduleView.query.filter_by(schedule_id=schedule_id).delete()
+        db.session.commit()
+        schedule_views.evict(schedule_id)
+        self.assertEqual(self.get_json('/api/schedules/{}/student'.format(schedule_id)), student_view)
+
+        # deleting the schedule drops its views
+        response = self.app.delete('/api/schedules/{}/class'.format(schedule_id), headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(schedule_views.get(schedule_id, 'student'))
+        response = self.app.get('/api/schedules/{}/student'.format(schedule_id), headers=self.headers)
+        self.assertEqual(response.status_code, 404)
+
+    def test_timetables(self):
+        self.build_dataset()
+        schedule_id = Scheduler().make_schedule()
+        schedule = Schedule.query.get(schedule_id)
+        student_view = json.loads(json.dumps(schedule.student_serialize()))
+        student, other_student = Student.query.order_by(Student.id).limit(2).all()
+        teacher = Teacher.query.one()
+
+        # a student's classes are read with one query, through the student's index
+        timetable, query_count = self.count_queries(schedule.student_timetable, student)
+        self.assertEqual(query_count, 1)
+        url = '/api/schedules/{}/students/{}'.format(schedule_id, student.id)
+        self.assertEqual(self.get_json(url)['student'],
+                         [ s for s in student_view['students'] if s['id'] == student.id ][0])
+        query = schedule.class_query()\
+                        .join(ScheduledClassesStudent, ScheduledClassesStudent.scheduled_class_id == ScheduledClass.id)\
+                        .filter(ScheduledClassesStudent.student_id == student.id)
+        sql = str(query.statement.compile(compile_kwargs={'literal_binds': True}))
+        plan = ' '.join(str(row) for row in db.session.execute('EXPLAIN QUERY PLAN ' + sql))
+        self.assertIn('_student_scheduled_class_ix', plan)
+
+        teacher_classes = self.get_json('/api/schedules/{}/teachers/{}'.format(schedule_id, teacher.id))['teacher']['classes']
+        self.assertEqual(sorted(len(c['students']) for c in teacher_classes), [2, 2])
+        self.assertEqual(sorted(s['id'] for c in teacher_classes for s in c['students']),
+                         sorted(s.id for s in Student.query.all()))
+
+        # a student only sees their own timetable
+        user = User(username='student', password='student', role_type='student')
+        db.session.add(user)
+        db.session.flush()
+        Student.query.filter_by(id=student.id).update({'user_id': user.id})
+        db.session.commit()
+        key, _ = self.login('student', 'student')
+        headers = {'Authorization': 'JWT {}'.format(key)}
+        self.assertEqual(self.app.get(url, headers=headers).status_code, 200)
+        for url in ['/api/schedules/{}/students/{}'.format(schedule_id, other_student.id),
+                    '/api/schedules/{}/teachers/{}'.format(schedule_id, teacher.id),
+                    '/api/schedules/{}/students/{}'.format(schedule_id + 1, student.id)]:
+            self.assertIn(self.app.get(url, headers=headers).status_code, (403, 404))
+
+    def test_rest_list_pages(self):
+        self.build_dataset()
+        students = self.get_json('/api/students')
+        self.assertEqual([ s['id'] for s in students ], sorted(s.id for s in Student.query.all()))
+        self.assertEqual([ c['value'] for c in students[0]['course'] ], ['Algebra'])
+
+        # the pages are the same whatever the rows read at a time
+        batch_size = restexport.STREAM_BATCH_SIZE
+        restexport.STREAM_BATCH_SIZE = 3
+        try:
+            self.assertEqual(self.get_json('/api/students'), students)
+            self.assertEqual(self.get_json('/api/students?limit=2&offset=1'), students[1:3])
+            self.assertEqual(self.get_json('/api/students?after_id={}&limit=5'.format(students[0]['id'])), students[1:])
+            self.assertEqual(self.get_json('/api/students?offset=1&after_id={}'.format(students[0]['id'])), students[2:])
+        finally:
+            restexport.STREAM_BATCH_SIZE = batch_size
+
+        page = self.get_json('/api/students?fields=id,first_name,course&limit=1')
+        self.assertEqual(page, [ dict((key, students[0][key]) for key in ['id', 'first_name', 'course']) ])
+        for args in ['limit=-1', 'after_id=first']:
+            response = self.app.get('/api/students?' + args, headers=self.headers)
+            self.assertEqual(response.status_code, 400)
+
+    def test_rest_constraint_queries(self):
+        self.build_dataset()
+        course = Course.query.one()
+        urls = ['/api/students', '/api/courses', '/api/timeblocks', '/api/courses/{}'.format(course.id)]
+        first_counts = [ self.count_queries(self.get_json, url)[1] for url in urls ]
+
+        # more rows, and constraints of each, don't take more queries
+        for student in TestUtil.generate_students(6):
+            db.session.add(CoursesStudent(course_id=course.id, student_id=student.id, priority='mandatory'))
+        for teacher in TestUtil.generate_teachers(3):
+            db.session.add(CoursesTeacher(course_id=course.id, teacher_id=teacher.id, priority='low'))
+        db.session.commit()
+        timeblock = Timeblock.query.order_by(Timeblock.id).first()
+        for student in Student.query.all():
+            db.session.add(StudentsTimeblock(student_id=student.id, timeblock_id=timeblock.id, active=True))
+        db.session.commit()
+        # (the days of the timeblocks come from timeblock_cache, once loaded)
+        self.get_json('/api/timeblocks?constraints=false')
+        counts = [ self.count_queries(self.get_json, url)[1] for url in urls ]
+        self.assertEqual(counts, first_counts)
+
+        students = self.get_json('/api/students')
+        self.assertEqual(len(students), 10)
+        self.assertEqual([ (t['value'], t['days']) for t in students[0]['timeblock'] ],
+                         [ (str(timeblock), ['Monday', 'Wednesday', 'Friday']) ])
+        self.assertEqual(len(self.get_json('/api/courses/{}'.format(course.id))['teacher']), 4)
+
+    def wait_for_job(self, job_id, states=ScheduleJob.FINISHED_STATES, timeout=120):
+        start_time = time.time()
+        while time.time() - start_time < timeout:
+            job = self.get_json('/api/schedules/jobs/{}'.format(job_id))
+            if job['state'] in states:
+                return job
+            time.sleep(0.2)
+        self.fail("Schedule job {} wasn't {} in {} seconds".format(job_id, states, timeout))
+
+    def test_schedule_jobs(self):
+        self.build_dataset()
+        # there is one worker (config.schedule_job_workers), the second job waits for the first
+        first = self.post_json('/api/schedules', {})['job']
+        second = self.post_json('/api/schedules', {})['job']
+        self.assertEqual((first['state'], second['state']), ('running', 'queued'))
+        cancelled = self.post_json('/api/schedules/jobs/{}/cancel'.format(second['id']), {})
+        self.assertEqual(cancelled['state'], 'cancelled')
+
+        first = self.wait_for_job(first['id'])
+        self.assertEqual(first['state'], 'succeeded')
+        self.assertGreater(first['check_count'], 0)
+        self.assertIsNotNone(Schedule.query.get(first['schedule_id']))
+        self.assertEqual([ job['id'] for job in self.get_json('/api/schedules/jobs') ], [second['id'], first['id']])
+
+        # a running job is stopped, a finished one can't be cancelled
+        third = self.post_json('/api/schedules', {})['job']
+        # it starts once the first job's worker has exited
+        self.wait_for_job(third['id'], ('running',))
+        cancelled = self.post_json('/api/schedules/jobs/{}/cancel'.format(third['id']), {})
+        self.assertEqual(cancelled['state'], 'cancelled')
+        response = self.app.post('/api/schedules/jobs/{}/cancel'.format(third['id']), headers=self.headers)
+        self.assertEqual(response.status_code, 400)
+
+    def test_job_progress(self):
+        # the progress is written without committing what the scheduler has in its session
+        job = ScheduleJob(state='running', created_at=datetime.now())
+        db.session.add(job)
+        db.session.commit()
+        db.session.add(Day(name='Holiday'))
+        JobProgress(job.id)(5, 3)
+        db.session.rollback()
+        self.assertEqual(Day.query.filter_by(name='Holiday').count(), 0)
+        self.assertEqual((job.check_count, job.class_count), (5, 3))
+
+    def test_recover_jobs(self):
+        # jobs running in workers this process didn't start: one still alive, one gone and one
+        # whose pid was given to another process since
+        alive = subprocess.Popen(['sleep', '60'], start_new_session=True)
+        gone = subprocess.Popen(['true'])
+        gone.wait()
+        started = process_start_time(alive.pid)
+        for pid, pid_start_time in [(alive.pid, started), (gone.pid, None), (alive.pid, started - 1)]:
+            db.session.add(ScheduleJob(state='running', pid=pid, pid_start_time=pid_start_time,
+                                       created_at=datetime.now()))
+        db.session.commit()
+        alive_id, gone_id, reused_id = [ job.id for job in ScheduleJob.query.order_by(ScheduleJob.id) ]
+
+        queue = ScheduleJobQueue()
+        try:
+            queue.dispatch()
+            self.assertEqual(ScheduleJob.query.get(alive_id).state, 'running')
+            self.assertEqual(ScheduleJob.query.get(gone_id).state, 'failed')
+            self.assertEqual(ScheduleJob.query.get(reused_id).state, 'failed')
+
+            # cancelling a job whose pid was reused doesn't signal the process that has it now
+            reused = ScheduleJob(state='running', pid=alive.pid, pid_start_time=started - 1,
+                                 created_at=datetime.now())
+            db.session.add(reused)
+            db.session.commit()
+            self.assertEqual(queue.cancel(reused.id).state, 'cancelled')
+            time.sleep(0.2)
+            self.assertIsNone(alive.poll())
+        finally:
+            alive.kill()
+            alive.wait()
+        queue.dispatch()
+        self.assertEqual(ScheduleJob.query.get(alive_id).state, 'failed')
+
+if __name__ == '__main__':
+    unittest.main()
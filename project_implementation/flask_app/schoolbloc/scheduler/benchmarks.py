@@ -0,0 +1,713 @@
+"""
+Benchmarks for the scheduler. They run against scratch copies of the sample databases in
+schoolbloc/testing, so they never touch the app's own database. Run them from the flask_app
+directory:
+
+    python -m schoolbloc.scheduler.benchmarks collisions [--db sample_schedule_75_students.db] [--classes 200] [--encodings pairwise,distinct]
+    python -m schoolbloc.scheduler.benchmarks attributes [--db sample_schedule_90_students.db] [--encodings int,bitvec]
+    python -m schoolbloc.scheduler.benchmarks paths [--courses 3,5,7] [--sections 4] [--encodings choice,enumerate]
+    python -m schoolbloc.scheduler.benchmarks backends [--datasets vg,sample_schedule_75_students.db] [--backends relax,optimize]
+    python -m schoolbloc.scheduler.benchmarks placement [--students 500,2000] [--placements greedy,flow]
+    python -m schoolbloc.scheduler.benchmarks extraction [--db sample_schedule_75_students.db] [--classes 500] [--encodings int,bitvec]
+    python -m schoolbloc.scheduler.benchmarks save [--students 500,2000]
+    python -m schoolbloc.scheduler.benchmarks views [--students 500,2000]
+    python -m schoolbloc.scheduler.benchmarks notes [--notes 2000]
+"""
+import argparse
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from z3 import *
+from schoolbloc import app, db
+
+SAMPLE_DB_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'testing')
+DEFAULT_DB = 'sample_schedule_75_students.db'
+
+
+def use_sample_db(db_name):
+    """
+    Points the app at a scratch copy of one of the sample databases and returns the path of
+    the copy. Must be called before the first query of the process
+    """
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    shutil.copy(os.path.join(SAMPLE_DB_DIR, db_name), path)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    return path
+
+
+def run_isolated(func, *args):
+    """
+    Runs func(*args) in a child process and returns its result, so the memory numbers
+    of one benchmark run aren't mixed with the others
+    """
+    ctx = multiprocessing.get_context('fork')
+    with ctx.Pool(1) as pool:
+        return pool.apply(func, args)
+
+
+def peak_memory_mb():
+    """ The peak resident memory of this process, in MB (ru_maxrss is in KB on Linux) """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def ast_size(constraints):
+    """ The number of distinct z3 terms in the constraints (shared sub terms are counted once) """
+    seen = set()
+    todo = list(constraints)
+    while todo:
+        expr = todo.pop()
+        if expr.get_id() in seen:
+            continue
+        seen.add(expr.get_id())
+        todo.extend(expr.children())
+    return len(seen)
+
+
+def print_table(rows, columns):
+    widths = [ max(len(col), *[ len(str(row[col])) for row in rows ]) for col in columns ]
+    print("  ".join(col.ljust(w) for col, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[col]).ljust(w) for col, w in zip(columns, widths)))
+
+
+# ---------------------------------------------------------------------------------------------
+# collisions: the room/time and teacher/time collision encodings of ScheduleConstraints
+# ---------------------------------------------------------------------------------------------
+
+def add_classes(sched_constraints, class_count):
+    """
+    Adds classes to the courses of sched_constraints, round robin from the most popular
+    course, until there are class_count classes
+    """
+    from schoolbloc.scheduler.class_constraint import ClassConstraint
+
+    courses = sorted(sched_constraints.class_constraints.items(), key=lambda item: -len(item[1]))
+    i = 0
+    while sched_constraints.class_count < class_count:
+        course_id, class_list = courses[i % len(courses)]
+        class_list.append(ClassConstraint(class_list[0].course_constraint))
+        sched_constraints.class_count += 1
+        i += 1
+
+
+def collision_run(db_name, encoding, class_count):
+    """
+    Builds the course and collision constraints (the student course paths are left out, they
+    are the same for every encoding) for the given encoding and solves them
+    """
+    db_path = use_sample_db(db_name)
+    try:
+        return _collision_run(encoding, class_count)
+    finally:
+        os.remove(db_path)
+
+
+def _collision_run(encoding, class_count):
+    from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
+
+    with app.app_context():
+        sched_constraints = ScheduleConstraints(collision_encoding=encoding)
+        if class_count:
+            add_classes(sched_constraints, class_count)
+
+        sched_constraints.prep_z3_classes()
+        course_constraints = sched_constraints.set_courses()
+        start_time = time.time()
+        collision_constraints = sched_constraints.prevent_room_time_collision() + \
+                                sched_constraints.prevent_teacher_time_collision()
+        build_time = time.time() - start_time
+
+        solver = Solver()
+        solver.set(timeout=600000)
+        start_time = time.time()
+        solver.add(course_constraints + collision_constraints)
+        result = solver.check()
+        solve_time = time.time() - start_time
+
+        stats = solver.statistics()
+        z3_memory = stats.get_key_value('max memory') if 'max memory' in stats.keys() else ''
+
+        return { 'encoding': encoding,
+                 'classes': sched_constraints.class_count,
+                 'terms': len(collision_constraints),
+                 'build (s)': round(build_time, 2),
+                 'solve (s)': round(solve_time, 2),
+                 'result': str(result),
+                 'z3 memory (MB)': z3_memory,
+                 'peak rss (MB)': round(peak_memory_mb(), 1) }
+
+
+def bench_collisions(args):
+    from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
+
+    encodings = args.encodings.split(',') if args.encodings else ScheduleConstraints.COLLISION_ENCODINGS
+    rows = [ run_isolated(collision_run, args.db, encoding, args.classes) for encoding in encodings ]
+    print_table(rows, ['encoding', 'classes', 'terms', 'build (s)', 'solve (s)', 'result',
+                       'z3 memory (MB)', 'peak rss (MB)'])
+
+
+# ---------------------------------------------------------------------------------------------
+# attributes: the int and bitvec encodings of the class attributes (teacher, room, time, course)
+# ---------------------------------------------------------------------------------------------
+
+def attribute_run(db_name, encoding):
+    """ Builds the full constraint set with the given attribute encoding and solves it """
+    db_path = use_sample_db(db_name)
+    try:
+        return _attribute_run(db_name, encoding)
+    finally:
+        os.remove(db_path)
+
+
+def _attribute_run(db_name, encoding):
+    from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
+
+    with app.app_context():
+        start_time = time.time()
+        sched_constraints = ScheduleConstraints(attribute_encoding=encoding)
+        constraints = sched_constraints.get_constraints()
+        build_time = time.time() - start_time
+
+        solver = Solver()
+        solver.set(timeout=600000)
+        start_time = time.time()
+        solver.add(constraints)
+        result = solver.check()
+        solve_time = time.time() - start_time
+
+        return { 'db': db_name,
+                 'encoding': encoding,
+                 'classes': sched_constraints.class_count,
+                 'build (s)': round(build_time, 2),
+                 'solve (s)': round(solve_time, 2),
+                 'result': str(result),
+                 'peak rss (MB)': round(peak_memory_mb(), 1) }
+
+
+def bench_attributes(args):
+    from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
+
+    encodings = args.encodings.split(',') if args.encodings else ScheduleConstraints.ATTRIBUTE_ENCODINGS
+    rows = [ run_isolated(attribute_run, args.db, encoding) for encoding in encodings ]
+    print_table(rows, ['db', 'encoding', 'classes', 'build (s)', 'solve (s)', 'result', 'peak rss (MB)'])
+
+
+# ---------------------------------------------------------------------------------------------
+# paths: the choice and enumerate encodings of the student course path constraints
+# ---------------------------------------------------------------------------------------------
+
+def path_run(db_name, encoding, course_count, section_count):
+    """
+    Builds and solves the course path constraints of a student taking course_count courses
+    with section_count classes each
+    """
+    db_path = use_sample_db(db_name)
+    try:
+        return _path_run(encoding, course_count, section_count)
+    finally:
+        os.remove(db_path)
+
+
+def _path_run(encoding, course_count, section_count):
+    from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints, StudentRequirements, RequirementProfile
+
+    with app.app_context():
+        sched_constraints = ScheduleConstraints(path_encoding=encoding)
+
+        course_ids = sorted(sched_constraints.class_constraints.keys())[:course_count]
+        for course_id in course_ids:
+            add_classes_to_course(sched_constraints, course_id, section_count)
+        profile = RequirementProfile(course_ids)
+        profile.student_requirements.append(StudentRequirements(0, course_ids, []))
+        sched_constraints.requirement_profiles = { profile.course_ids: profile }
+        sched_constraints.prep_z3_classes()
+        course_constraints = sched_constraints.set_courses()
+
+        start_time = time.time()
+        path_constraints = sched_constraints.ensure_course_timeblock_paths()
+        build_time = time.time() - start_time
+
+        solver = Solver()
+        solver.set(timeout=600000)
+        start_time = time.time()
+        solver.add(course_constraints + path_constraints)
+        result = solver.check()
+        solve_time = time.time() - start_time
+
+        return { 'encoding': encoding,
+                 'courses': course_count,
+                 'sections': section_count,
+                 'terms': ast_size(path_constraints),
+                 'build (s)': round(build_time, 2),
+                 'solve (s)': round(solve_time, 2),
+                 'result': str(result),
+                 'peak rss (MB)': round(peak_memory_mb(), 1) }
+
+
+def add_classes_to_course(sched_constraints, course_id, class_count):
+    """ Adds (or removes) classes of the course until it has class_count of them """
+    from schoolbloc.scheduler.class_constraint import ClassConstraint
+
+    class_list = sched_constraints.class_constraints[course_id]
+    sched_constraints.class_count += class_count - len(class_list)
+    while len(class_list) < class_count:
+        class_list.append(ClassConstraint(class_list[0].course_constraint))
+    del class_list[class_count:]
+
+
+def bench_paths(args):
+    from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
+
+    encodings = args.encodings.split(',') if args.encodings else ScheduleConstraints.PATH_ENCODINGS
+    course_counts = [ int(n) for n in args.courses.split(',') ]
+    rows = [ run_isolated(path_run, args.db, encoding, course_count, args.sections)
+             for course_count in course_counts for encoding in encodings ]
+    print_table(rows, ['encoding', 'courses', 'sections', 'terms', 'build (s)', 'solve (s)', 'result',
+                       'peak rss (MB)'])
+
+
+# ---------------------------------------------------------------------------------------------
+# backends: Scheduler.make_schedule (relaxing a preference at a time) against OptimizeScheduler
+# ---------------------------------------------------------------------------------------------
+
+BACKENDS = ('relax', 'optimize')
+
+# the datasets of full_tests.py, by the name of the FullScheduleTests method building them
+FULL_TEST_DATASETS = {
+    'vg': 'build_vg_dataset',
+}
+
+
+def backend_run(dataset, backend):
+    """
+    Makes a schedule for the dataset (a FULL_TEST_DATASETS name or a sample database) with
+    the given backend
+    """
+    if dataset in FULL_TEST_DATASETS:
+        fd, db_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + db_path
+    else:
+        db_path = use_sample_db(dataset)
+    try:
+        return _backend_run(dataset, backend)
+    finally:
+        os.remove(db_path)
+
+
+def _backend_run(dataset, backend):
+    from schoolbloc.scheduler.full_tests import FullScheduleTests
+    from schoolbloc.scheduler.models import ScheduledClass
+    from schoolbloc.scheduler.scheduler import Scheduler, SchedulerNoSolution
+    from schoolbloc.scheduler.optimize_scheduler import OptimizeScheduler
+
+    with app.app_context():
+        if dataset in FULL_TEST_DATASETS:
+            tests = FullScheduleTests()
+            tests.reset_db()
+            getattr(tests, FULL_TEST_DATASETS[dataset])()
+
+        scheduler = OptimizeScheduler() if backend == 'optimize' else Scheduler()
+        start_time = time.time()
+        try:
+            scheduler.make_schedule()
+            result = 'scheduled'
+        except SchedulerNoSolution:
+            result = 'no solution'
+        total_time = time.time() - start_time
+
+        return { 'dataset': dataset,
+                 'backend': backend,
+                 'result': result,
+                 'classes': ScheduledClass.query.count(),
+                 'solver checks': scheduler.check_count,
+                 'total (s)': round(total_time, 2),
+                 'peak rss (MB)': round(peak_memory_mb(), 1) }
+
+
+def bench_backends(args):
+    backends = args.backends.split(',') if args.backends else BACKENDS
+    rows = [ run_isolated(backend_run, dataset, backend)
+             for dataset in args.datasets.split(',') for backend in backends ]
+    print_table(rows, ['dataset', 'backend', 'result', 'classes', 'solver checks', 'total (s)', 'peak rss (MB)'])
+
+
+# ---------------------------------------------------------------------------------------------
+# placement: Scheduler.place_students with the greedy and the flow placement
+# ---------------------------------------------------------------------------------------------
+
+def placement_run(db_name, placement, student_count, course_count, courses_per_student):
+    """
+    Places student_count students, each taking courses_per_student of course_count courses,
+    in a random mapping with a spare class for each course (classes of 30 students in the
+    timeblocks of the sample database)
+    """
+    db_path = use_sample_db(db_name)
+    try:
+        return _placement_run(placement, student_count, course_count, courses_per_student)
+    finally:
+        os.remove(db_path)
+
+
+def random_mapping(student_count, course_count, courses_per_student):
+    """
+    The classes and the requirement profiles of student_count students, each taking
+    courses_per_student of course_count courses, with a spare class of 30 students for each
+    course in the timeblocks of the database
+    """
+    import math
+    import random
+    from schoolbloc.scheduler.models import Timeblock
+    from schoolbloc.scheduler.schedule_constraints import StudentRequirements, RequirementProfile
+    from schoolbloc.scheduler.schedule_data import ScheduleClass
+
+    rand = random.Random(0)
+    timeblock_ids = [ t.id for t in Timeblock.query.all() ]
+    profiles = {}
+    demand = dict((course_id, 0) for course_id in range(1, course_count + 1))
+    for student_id in range(1, student_count + 1):
+        course_ids = sorted(rand.sample(sorted(demand.keys()), courses_per_student))
+        for course_id in course_ids:
+            demand[course_id] += 1
+        key = frozenset(course_ids)
+        if key not in profiles:
+            profiles[key] = RequirementProfile(course_ids)
+        profiles[key].student_requirements.append(StudentRequirements(student_id, course_ids, []))
+
+    classes = []
+    for course_id, count in sorted(demand.items()):
+        for i in range(int(math.ceil(count / 30.0)) + 1):
+            classes.append(ScheduleClass(course_id, 0, 0, rand.choice(timeblock_ids), 30, 0))
+    return classes, profiles
+
+
+def _placement_run(placement, student_count, course_count, courses_per_student):
+    from schoolbloc.scheduler.schedule_data import ScheduleData
+    from schoolbloc.scheduler.scheduler import Scheduler
+
+    with app.app_context():
+        classes, profiles = random_mapping(student_count, course_count, courses_per_student)
+        schedule = ScheduleData(classes)
+
+        start_time = time.time()
+        collisions = Scheduler(placement=placement).place_students(schedule, profiles.values())
+        total_time = time.time() - start_time
+
+        seats_taken = {}
+        for sch_class in classes:
+            for student in sch_class.students:
+                seats_taken[student.id] = seats_taken.get(student.id, 0) + 1
+        return { 'placement': placement,
+                 'students': student_count,
+                 'classes': len(classes),
+                 'result': 'placed' if len(collisions) == 0 else 'collisions',
+                 'fully placed': len([ n for n in seats_taken.values() if n == courses_per_student ]),
+                 'placements': schedule.placement_count,
+                 'total (s)': round(total_time, 2),
+                 'peak rss (MB)': round(peak_memory_mb(), 1) }
+
+
+def bench_placement(args):
+    from schoolbloc.scheduler.scheduler import Scheduler
+
+    placements = args.placements.split(',') if args.placements else Scheduler.PLACEMENTS
+    rows = [ run_isolated(placement_run, args.db, placement, int(student_count), args.course_count,
+                          args.courses_per_student)
+             for student_count in args.students.split(',') for placement in placements ]
+    print_table(rows, ['placement', 'students', 'classes', 'result', 'fully placed', 'placements', 'total (s)', 'peak rss (MB)'])
+
+
+# ---------------------------------------------------------------------------------------------
+# extraction: reading the classes of a mapping out of the z3 model (Scheduler.gen_sched_classes)
+# ---------------------------------------------------------------------------------------------
+
+def extraction_run(db_name, encoding, class_count):
+    """
+    Solves the course constraints of class_count classes and reads the classes out of the
+    model, an evaluate per attribute and two queries per class against gen_sched_classes
+    """
+    db_path = use_sample_db(db_name)
+    try:
+        return _extraction_run(encoding, class_count)
+    finally:
+        os.remove(db_path)
+
+
+def _extraction_run(encoding, class_count):
+    from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
+    from schoolbloc.scheduler.scheduler import Scheduler
+
+    with app.app_context():
+        sched_constraints = ScheduleConstraints(attribute_encoding=encoding)
+        add_classes(sched_constraints, class_count)
+        sched_constraints.prep_z3_classes()
+        solver = Solver()
+        solver.add(sched_constraints.set_courses())
+        result = solver.check()
+        model = solver.model()
+        scheduler = Scheduler(attribute_encoding=encoding)
+
+        start_time = time.time()
+        evaluated = evaluate_each_attribute(model, sched_constraints)
+        evaluate_time = time.time() - start_time
+
+        start_time = time.time()
+        schedule = scheduler.gen_sched_classes(model, sched_constraints)
+        batch_time = time.time() - start_time
+
+        batched = sorted((c.course_id, c.room_id, c.teacher_id, c.timeblock_id, c.max_student_count, c.min_student_count)
+                         for class_list in schedule.scheduled_classes.values() for c in class_list)
+        return { 'encoding': encoding,
+                 'classes': sched_constraints.class_count,
+                 'result': str(result),
+                 'evaluate (s)': round(evaluate_time, 3),
+                 'batch (s)': round(batch_time, 3),
+                 'same classes': sorted(evaluated) == batched }
+
+
+def evaluate_each_attribute(model, sched_constraints):
+    """ the classes of the model read an attribute at a time, like gen_sched_classes used to """
+    classes = []
+    for i in range(sched_constraints.class_count):
+        course_id = sched_constraints.db_id('course', model.evaluate(sched_constraints.course(i)))
+        room_id = sched_constraints.db_id('room', model.evaluate(sched_constraints.room(i)))
+        teacher_id = sched_constraints.db_id('teacher', model.evaluate(sched_constraints.teacher(i)))
+        time_id = sched_constraints.db_id('time', model.evaluate(sched_constraints.time(i)))
+        classes.append((course_id, room_id, teacher_id, time_id,
+                        sched_constraints.snapshot.max_student_count(course_id),
+                        sched_constraints.snapshot.min_student_count(course_id)))
+    return classes
+
+
+def bench_extraction(args):
+    from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
+
+    encodings = args.encodings.split(',') if args.encodings else ScheduleConstraints.ATTRIBUTE_ENCODINGS
+    rows = [ run_isolated(extraction_run, args.db, encoding, args.classes or 500) for encoding in encodings ]
+    print_table(rows, ['encoding', 'classes', 'result', 'evaluate (s)', 'batch (s)', 'same classes'])
+
+
+# ---------------------------------------------------------------------------------------------
+# save: ScheduleData.save a row at a time and in bulk
+# ---------------------------------------------------------------------------------------------
+
+def save_run(db_name, bulk, student_count, course_count, courses_per_student):
+    """
+    Saves the schedule of student_count students placed in a random mapping (see
+    random_mapping), counting the statements sent to the database
+    """
+    db_path = use_sample_db(db_name)
+    try:
+        return _save_run(bulk, student_count, course_count, courses_per_student)
+    finally:
+        os.remove(db_path)
+
+
+def placed_random_mapping(student_count, course_count, courses_per_student):
+    """
+    The ScheduleData of a random mapping (see random_mapping) with its students placed, and
+    real teachers, rooms and students behind its classes so it can be saved
+    """
+    from schoolbloc.scheduler.models import Classroom, Student, Teacher
+    from schoolbloc.scheduler.schedule_data import ScheduleData
+    from schoolbloc.scheduler.scheduler import Scheduler
+
+    classes, profiles = random_mapping(student_count, course_count, courses_per_student)
+    teacher_ids = [ t.id for t in Teacher.query.all() ]
+    room_ids = [ r.id for r in Classroom.query.all() ]
+    for i, sch_class in enumerate(classes):
+        sch_class.teacher_id = teacher_ids[i % len(teacher_ids)]
+        sch_class.room_id = room_ids[i % len(room_ids)]
+    first_id = (db.session.query(db.func.max(Student.id)).scalar() or 0) + 1
+    db.session.bulk_insert_mappings(Student, [ { 'id': i, 'uid': 'bench_{}'.format(i), 'first_name': 'bench',
+                                                 'last_name': str(i), 'user_token': 'bench_{}'.format(i) }
+                                               for i in range(first_id, student_count + 1) ])
+    db.session.commit()
+    schedule = ScheduleData(classes)
+    Scheduler(placement='flow').place_students(schedule, profiles.values())
+    return schedule
+
+
+def count_statements(func, *args):
+    """ returns what func returned, the number of statements it sent to the database and its time """
+    from sqlalchemy import event
+
+    statements = []
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(db.engine, 'before_cursor_execute', count_statement)
+    start_time = time.time()
+    try:
+        result = func(*args)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_statement)
+    return result, len(statements), time.time() - start_time
+
+
+def _save_run(bulk, student_count, course_count, courses_per_student):
+    from schoolbloc.scheduler.models import ScheduledClassesStudent
+
+    with app.app_context():
+        schedule = placed_random_mapping(student_count, course_count, courses_per_student)
+        saved_count = ScheduledClassesStudent.query.count()
+        _, statement_count, total_time = count_statements(schedule.save, bulk)
+
+        return { 'save': 'bulk' if bulk else 'each',
+                 'students': student_count,
+                 'classes': sum(len(class_list) for class_list in schedule.scheduled_classes.values()),
+                 'class students': ScheduledClassesStudent.query.count() - saved_count,
+                 'statements': statement_count,
+                 'total (s)': round(total_time, 2) }
+
+
+def bench_save(args):
+    rows = [ run_isolated(save_run, args.db, bulk, int(student_count), args.course_count,
+                          args.courses_per_student)
+             for student_count in args.students.split(',') for bulk in (False, True) ]
+    print_table(rows, ['save', 'students', 'classes', 'class students', 'statements', 'total (s)'])
+
+
+# ---------------------------------------------------------------------------------------------
+# views: Schedule.student_serialize and the relationship walk it replaced
+# ---------------------------------------------------------------------------------------------
+
+def views_run(db_name, student_count, course_count, courses_per_student):
+    """
+    Saves the schedule of student_count students placed in a random mapping, then serializes
+    its student view both ways, counting the statements sent to the database
+    """
+    db_path = use_sample_db(db_name)
+    try:
+        return _views_run(student_count, course_count, courses_per_student)
+    finally:
+        os.remove(db_path)
+
+
+def walk_student_view(schedule_id):
+    """ the student view as it was built, through the lazy loaded relationships """
+    from schoolbloc.scheduler.models import Schedule
+
+    students = {}
+    for sch_class in Schedule.query.get(schedule_id).scheduled_classes:
+        for student in sch_class.students:
+            students.setdefault(student.id, []).append(
+                (str(sch_class.classroom), str(sch_class.course), str(sch_class.teacher),
+                 [ day.strip() for day in sch_class.days.split(',') ]))
+    return students
+
+
+def _views_run(student_count, course_count, courses_per_student):
+    from schoolbloc.scheduler.models import Schedule
+
+    with app.app_context():
+        schedule_id = placed_random_mapping(student_count, course_count, courses_per_student).save()
+        rows = []
+        db.session.expire_all()
+        walked, walk_statements, walk_time = count_statements(walk_student_view, schedule_id)
+        rows.append({ 'view': 'relationships', 'students': student_count,
+                      'statements': walk_statements, 'total (s)': round(walk_time, 2), 'same view': '-' })
+
+        db.session.expire_all()
+        schedule = Schedule.query.get(schedule_id)
+        view, statement_count, total_time = count_statements(schedule.student_serialize)
+        same = walked == dict((s['id'], [ (c['classroom'], c['course'], c['teacher'], c['days']) for c in s['classes'] ])
+                              for s in view['students'])
+        rows.append({ 'view': 'student_serialize', 'students': student_count, 'statements': statement_count,
+                      'total (s)': round(total_time, 2), 'same view': same })
+        return rows
+
+
+def bench_views(args):
+    rows = []
+    for student_count in args.students.split(','):
+        rows.extend(run_isolated(views_run, args.db, int(student_count), args.course_count,
+                                 args.courses_per_student))
+    print_table(rows, ['view', 'students', 'statements', 'total (s)', 'same view'])
+
+
+# ---------------------------------------------------------------------------------------------
+# notes: log_note committing each notification and buffering them
+# ---------------------------------------------------------------------------------------------
+
+def notes_run(db_name, buffered, note_count):
+    """ Logs note_count notifications, as the scheduler's loops do, and times it """
+    db_path = use_sample_db(db_name)
+    try:
+        return _notes_run(buffered, note_count)
+    finally:
+        os.remove(db_path)
+
+
+def _notes_run(buffered, note_count):
+    import contextlib
+    from datetime import datetime
+    from schoolbloc.scheduler.models import Notification
+    import schoolbloc.scheduler.scheduler_util as SchedUtil
+
+    def commit_note(type, subject, description):
+        # what log_note did before the notifications were buffered
+        db.session.add(Notification(type=type, subject=subject, description=description, created_at=datetime.now()))
+        db.session.commit()
+
+    log = SchedUtil.log_note if buffered else commit_note
+    with app.app_context(), open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        saved_count = Notification.query.count()
+        start_time = time.time()
+        for i in range(note_count):
+            log("info", "Scheduler", "Generating mapping {}".format(i))
+        log_time = time.time() - start_time
+        SchedUtil.flush_notes()
+        total_time = time.time() - start_time
+
+        return { 'notes': 'buffered' if buffered else 'commit',
+                 'logged': note_count,
+                 'saved': Notification.query.count() - saved_count,
+                 'log_note (ms)': round(1000 * log_time / note_count, 3),
+                 'total (s)': round(total_time, 2) }
+
+
+def bench_notes(args):
+    rows = [ run_isolated(notes_run, args.db, buffered, args.notes) for buffered in (False, True) ]
+    print_table(rows, ['notes', 'logged', 'saved', 'log_note (ms)', 'total (s)'])
+
+
+BENCHMARKS = {
+    'collisions': bench_collisions,
+    'attributes': bench_attributes,
+    'paths': bench_paths,
+    'backends': bench_backends,
+    'placement': bench_placement,
+    'extraction': bench_extraction,
+    'save': bench_save,
+    'views': bench_views,
+    'notes': bench_notes,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Scheduler benchmarks")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--db', default=DEFAULT_DB, help="sample database in schoolbloc/testing")
+    parser.add_argument('--classes', type=int, default=0,
+                        help="add classes until there are this many (0 keeps the computed count)")
+    parser.add_argument('--encodings', help="comma separated encodings to compare (default: all)")
+    parser.add_argument('--courses', default='2,3,4,5,6,7', help="comma separated course counts (paths)")
+    parser.add_argument('--sections', type=int, default=4, help="classes per course (paths)")
+    parser.add_argument('--datasets', default=','.join(sorted(FULL_TEST_DATASETS.keys())),
+                        help="comma separated full_tests datasets or sample databases (backends)")
+    parser.add_argument('--backends', help="comma separated backends to compare (backends, default: all)")
+    parser.add_argument('--students', default='500,2000', help="comma separated student counts (placement, save, views)")
+    parser.add_argument('--course-count', type=int, default=24, help="number of courses (placement, save, views)")
+    parser.add_argument('--courses-per-student', type=int, default=8, help="courses each student takes (placement, save, views)")
+    parser.add_argument('--placements', help="comma separated placements to compare (placement, default: all)")
+    parser.add_argument('--notes', type=int, default=2000, help="notifications logged (notes)")
+    args = parser.parse_args(argv)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
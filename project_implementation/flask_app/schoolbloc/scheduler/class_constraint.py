@@ -1,18 +1,20 @@
 from schoolbloc.scheduler.models import *
 from schoolbloc.scheduler.teacher_constraint import TeacherConstraint
 from schoolbloc.scheduler.classroom_constraint import ClassroomConstraint
+from schoolbloc.scheduler.constraint_snapshot import ConstraintSnapshot
 import schoolbloc.scheduler.scheduler_util as SchedUtil
 
-class ClassConstraint:
-    def __init__(self, course_id, course_name):
+class CourseConstraint:
+    def __init__(self, course_id, snapshot=None):
         """
-        Represents the constraints applied to a single class. These objects are generated by the 
-        Scheduler and used to hold known constraints for a class (for example, it's course).
+        The constraints shared by every class of a course (the teachers, classrooms and timeblocks
+        the course can use). They only depend on the course, so one CourseConstraint is built per
+        course and scheduling run (see cached) and each ClassConstraint refers to it. The object
+        is never modified after it is built, relaxations are kept by the classes.
         """
         self.course_id = course_id
-        self.course_name = course_name
-        self.z3_index = 0
-        self.student_count = 0
+        self.snapshot = snapshot or ConstraintSnapshot()
+        self.course_name = self.snapshot.course_name(course_id)
 
         self.mand_teacher_constraints = []
         self.high_teacher_constraints = []
@@ -28,44 +30,154 @@ class ClassConstraint:
 
         self.subject_ids = []
 
-        # now apply the constraints to this class
+        # now apply the constraints to this course
         self.calc_subject_ids()
         self.calc_constraints()
 
+    @classmethod
+    def cached(cls, course_id, snapshot):
+        """ Returns the CourseConstraint for the course, building it once per snapshot """
+        key = (cls, course_id)
+        if key not in snapshot.constraint_cache:
+            snapshot.constraint_cache[key] = cls(course_id, snapshot)
+        return snapshot.constraint_cache[key]
+
+    def calc_subject_ids(self):
+        self.subject_ids = list(self.snapshot.course_subjects.get(self.course_id, []))
+    
+    def calc_constraints(self):
+        snapshot = self.snapshot
+
+        # first calculate the timeblock and classroom id lists
+        self.mand_timeblock_ids = snapshot.lookup(snapshot.course_timeblocks, self.course_id, 'mandatory') + \
+                                  snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'mandatory')
+        self.high_timeblock_ids = snapshot.lookup(snapshot.course_timeblocks, self.course_id, 'high') + \
+                                  snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'high')
+        self.low_timeblock_ids = snapshot.lookup(snapshot.course_timeblocks, self.course_id, 'low') + \
+                                 snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'low')
+        # remove the 'Not' constraints
+        not_timeblock_ids = snapshot.lookup(snapshot.course_timeblocks, self.course_id, 'not') + \
+                            snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'not')
+
+        # if our low id set is empty. we assume all timeblocks are in the low set
+        if len(self.low_timeblock_ids) == 0: 
+            self.low_timeblock_ids = list(snapshot.timeblock_ids)
+
+        self.mand_timeblock_ids = set(self.mand_timeblock_ids) - set(not_timeblock_ids)
+        self.high_timeblock_ids = set(self.high_timeblock_ids) - set(not_timeblock_ids)
+        self.low_timeblock_ids = set(self.low_timeblock_ids) - set(not_timeblock_ids)
+
+        # now calculate the classrooms
+        mand_classroom_ids = snapshot.lookup(snapshot.course_classrooms, self.course_id, 'mandatory') + \
+                             snapshot.lookup_subjects(snapshot.subject_classrooms, self.subject_ids, 'mandatory')
+        high_classroom_ids = snapshot.lookup(snapshot.course_classrooms, self.course_id, 'high') + \
+                             snapshot.lookup_subjects(snapshot.subject_classrooms, self.subject_ids, 'high')
+        low_classroom_ids = snapshot.lookup(snapshot.course_classrooms, self.course_id, 'low') + \
+                            snapshot.lookup_subjects(snapshot.subject_classrooms, self.subject_ids, 'low')
+        not_classroom_ids = snapshot.lookup(snapshot.course_classrooms, self.course_id, 'not') + \
+                            snapshot.lookup_subjects(snapshot.subject_classrooms, self.subject_ids, 'not')
+        
+        # if our low id set is empty. we assume all timeblocks are in the low set
+        if len(low_classroom_ids) == 0:
+            low_classroom_ids = list(snapshot.classroom_ids)
+
+        mand_classroom_ids = set(mand_classroom_ids) - set(not_classroom_ids)
+        high_classroom_ids = set(high_classroom_ids) - set(not_classroom_ids)
+        low_classroom_ids = set(low_classroom_ids) - set(not_classroom_ids)
+
+
+        # now make a set of ClassroomConstraints from each list
+        self.mand_classroom_constraints = [ ClassroomConstraint.cached(c_id, snapshot) for c_id in mand_classroom_ids ]
+        self.high_classroom_constraints = [ ClassroomConstraint.cached(c_id, snapshot) for c_id in high_classroom_ids ]
+        self.low_classroom_constraints = [ ClassroomConstraint.cached(c_id, snapshot) for c_id in low_classroom_ids ]
+
+        # now calculate the Teacher ids, only the teachers mapped to the course itself constrain it
+        mand_teacher_ids = snapshot.lookup(snapshot.course_teachers, self.course_id, 'mandatory')
+        high_teacher_ids = snapshot.lookup(snapshot.course_teachers, self.course_id, 'high')
+        low_teacher_ids = snapshot.lookup(snapshot.course_teachers, self.course_id, 'low')
+        not_teacher_ids = snapshot.lookup(snapshot.course_teachers, self.course_id, 'not')
+
+        # if our low id set is empty. we assume all teachers are in the low set
+        if len(low_teacher_ids) == 0:
+            low_teacher_ids = list(snapshot.teacher_ids)
+
+
+        mand_teacher_ids = set(mand_teacher_ids) - set(not_teacher_ids)
+        high_teacher_ids = set(high_teacher_ids) - set(not_teacher_ids)
+        low_teacher_ids = set(low_teacher_ids) - set(not_teacher_ids)
+
+        # now make a set of TeacherConstraints from each list
+        self.mand_teacher_constraints = [ TeacherConstraint.cached(t_id, snapshot) for t_id in mand_teacher_ids ]
+        self.high_teacher_constraints = [ TeacherConstraint.cached(t_id, snapshot) for t_id in high_teacher_ids ]
+        self.low_teacher_constraints = [ TeacherConstraint.cached(t_id, snapshot) for t_id in low_teacher_ids ]
+
+
+class ClassConstraint:
+    def __init__(self, course_constraint):
+        """
+        Represents the constraints applied to a single class. These objects are generated by the 
+        Scheduler and used to hold known constraints for a class (for example, it's course).
+        The constraints themselves come from the CourseConstraint shared by all the classes of
+        the course, the class only keeps its z3 index, student count and the set of constraints
+        that have been relaxed for it.
+
+        relaxed holds a key for every high priority constraint that was dropped for this class:
+        ('teacher',), ('classroom',) and ('timeblock',) for the course constraints,
+        ('teacher', teacher_id, 'classroom' | 'timeblock') for the teacher constraints and
+        ([ 'teacher', teacher_id, ] 'classroom', classroom_id, 'timeblock') for the classroom
+        constraints
+        """
+        self.course_constraint = course_constraint
+        self.z3_index = 0
+        self.student_count = 0
+        self.relaxed = set()
+
+    @property
+    def course_id(self):
+        return self.course_constraint.course_id
+
+    @property
+    def course_name(self):
+        return self.course_constraint.course_name
+
     def relax_constraints(self):
         #TODO should take a more intellegent approach to this, but for now, blindly grab one and relax it
-        if len(self.mand_teacher_constraints) == 0:
-            if len(self.high_teacher_constraints) > 0:
+        course = self.course_constraint
+        relaxed = self.relaxed
+
+        if len(course.mand_teacher_constraints) == 0:
+            if len(course.high_teacher_constraints) > 0 and ('teacher',) not in relaxed:
                 msg = "Relaxing the course->teacher constraints for class {} (course: {} {})".format(
                         self.z3_index, self.course_id, self.course_name)
                 SchedUtil.log_note("info", "Scheduler", msg)
                     
-                self.high_teacher_constraints = []
+                relaxed.add(('teacher',))
                 return
             else:
-                for tc in self.low_teacher_constraints:
-                    if tc.can_relax_constraints():
-                        tc.relax_constraints(self.z3_index)
+                for tc in course.low_teacher_constraints:
+                    if tc.can_relax_constraints(relaxed):
+                        tc.relax_constraints(self.z3_index, relaxed)
                         return
 
-        if len(self.mand_classroom_constraints) == 0:
-            if len(self.high_classroom_constraints) > 0:
+        if len(course.mand_classroom_constraints) == 0:
+            if len(course.high_classroom_constraints) > 0 and ('classroom',) not in relaxed:
                 msg = "Relaxing the course->classroom constraints for class {} (course: {} {})".format(
                     self.z3_index, self.course_id, self.course_name)
                 SchedUtil.log_note("info", "Scheduler", msg)
-                self.high_classroom_constraints = []
+                relaxed.add(('classroom',))
                 return 
             else:
-                for cc in self.low_classroom_constraints:
-                    if cc.can_relax_constraints():
-                        cc.relax_constraints(self.z3_index)
+                for cc in course.low_classroom_constraints:
+                    if cc.can_relax_constraints(relaxed):
+                        cc.relax_constraints(self.z3_index, relaxed)
                         return 
 
-        if len(self.mand_timeblock_ids) == 0 and len(self.high_timeblock_ids) > 0:
+        if len(course.mand_timeblock_ids) == 0 and len(course.high_timeblock_ids) > 0 and \
+                ('timeblock',) not in relaxed:
             msg = "Relaxing the course->timeblock constraints for class {} (course: {} {})".format(
                     self.z3_index, self.course_id, self.course_name)
             SchedUtil.log_note("info", "Scheduler", msg)
-            self.high_timeblock_ids = []
+            relaxed.add(('timeblock',))
             return 
 
         return False
@@ -75,207 +187,98 @@ class ClassConstraint:
         Returns true if this class or its descendants contains high priority constraints that can 
         fall back to low priority constraints
         """
-        if len(self.mand_teacher_constraints) == 0:
-            if len(self.high_teacher_constraints) > 0:
+        course = self.course_constraint
+        relaxed = self.relaxed
+
+        if len(course.mand_teacher_constraints) == 0:
+            if len(course.high_teacher_constraints) > 0 and ('teacher',) not in relaxed:
                 return True
             else:
-                for tc in self.low_teacher_constraints:
-                    if tc.can_relax_constraints():
+                for tc in course.low_teacher_constraints:
+                    if tc.can_relax_constraints(relaxed):
                         return True
 
-        if len(self.mand_classroom_constraints) == 0:
-            if len(self.high_classroom_constraints) > 0:
+        if len(course.mand_classroom_constraints) == 0:
+            if len(course.high_classroom_constraints) > 0 and ('classroom',) not in relaxed:
                 return True
             else:
-                for cc in self.low_classroom_constraints:
-                    if cc.can_relax_constraints():
+                for cc in course.low_classroom_constraints:
+                    if cc.can_relax_constraints(relaxed):
                         return True
 
-        if len(self.mand_timeblock_ids) == 0 and len(self.high_timeblock_ids) > 0:
+        if len(course.mand_timeblock_ids) == 0 and len(course.high_timeblock_ids) > 0 and \
+                ('timeblock',) not in relaxed:
             return True
 
         return False
 
            
     
-    def get_teacher_constraints(self):
-        if len(self.mand_teacher_constraints) > 0:
-            return self.mand_teacher_constraints
-        elif len(self.high_teacher_constraints) > 0:
-            return self.high_teacher_constraints
+    def relax_preference(self, key):
+        """
+        Relaxes the high priority constraint of the given relax key (see relaxed), for when the
+        scheduler knows which one is in the way
+        """
+        if key[0] == 'teacher' and len(key) == 3:
+            msg = "Relaxing the teacher->{} constraints for class {} (teacher: {})".format(key[2], self.z3_index, key[1])
+        elif len(key) > 1:
+            msg = "Relaxing the classroom->timeblock constraints for class {} (classroom: {})".format(
+                self.z3_index, key[-2])
         else:
-            return self.low_teacher_constraints
-
-    def get_classroom_constraints(self):
-        if len(self.mand_classroom_constraints) > 0:
-            return self.mand_classroom_constraints
-        elif len(self.high_classroom_constraints) > 0:
-            return self.high_classroom_constraints
+            msg = "Relaxing the course->{} constraints for class {} (course: {} {})".format(
+                key[0], self.z3_index, self.course_id, self.course_name)
+        SchedUtil.log_note("info", "Scheduler", msg)
+        self.relaxed.add(key)
+
+    # the getters use the relaxations of the class unless they are given another set of them
+    def get_teacher_constraints(self, relaxed=None):
+        relaxed = self.relaxed if relaxed is None else relaxed
+        course = self.course_constraint
+        if len(course.mand_teacher_constraints) > 0:
+            return course.mand_teacher_constraints
+        elif len(course.high_teacher_constraints) > 0 and ('teacher',) not in relaxed:
+            return course.high_teacher_constraints
         else:
-            return self.low_classroom_constraints
-
-    def get_timeblock_ids(self):
-        if len(self.mand_timeblock_ids) > 0:
-            return self.mand_timeblock_ids
-        elif len(self.high_timeblock_ids) > 0:
-            return self.high_timeblock_ids
+            return course.low_teacher_constraints
+
+    def get_classroom_constraints(self, relaxed=None):
+        relaxed = self.relaxed if relaxed is None else relaxed
+        course = self.course_constraint
+        if len(course.mand_classroom_constraints) > 0:
+            return course.mand_classroom_constraints
+        elif len(course.high_classroom_constraints) > 0 and ('classroom',) not in relaxed:
+            return course.high_classroom_constraints
         else:
-            return self.low_timeblock_ids
-
-    def get_teacher_ids(self):
-        return [ t.teacher_id for t in self.get_teacher_constraints() ]
-
-    def get_classroom_ids(self):
-        return [ c.classroom_id for c in self.get_classroom_constraints() ]
-        
-    def calc_subject_ids(self):
-        course_subject_list = CoursesSubject.query.filter_by(course_id=self.course_id).all()
-        self.subject_ids = [ cs.subject_id for cs in course_subject_list ]
-    
-    def calc_constraints(self):
-        # first calculate the timeblock and classroom id lists
-        self.mand_timeblock_ids = [ ct.timeblock_id for ct in 
-                        CoursesTimeblock.query.filter_by(priority='mandatory', 
-                                                            course_id=self.course_id,
-                                                            active=True).all() ]
-        self.high_timeblock_ids = [ ct.timeblock_id for ct in 
-                        CoursesTimeblock.query.filter_by(priority='high', 
-                                                            course_id=self.course_id,
-                                                            active=True).all() ]
-        self.low_timeblock_ids = [ ct.timeblock_id for ct in 
-                        CoursesTimeblock.query.filter_by(priority='low', 
-                                                            course_id=self.course_id,
-                                                            active=True).all() ]
-        # remove the 'Not' constraints
-        not_timeblock_ids = [ ct.timeblock_id for ct in 
-                        CoursesTimeblock.query.filter_by(priority='not', 
-                                                            course_id=self.course_id,
-                                                            active=True).all() ]
-        
-        for subject_id in self.subject_ids:
-            self.mand_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='mandatory', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-            self.high_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='high', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-            self.low_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='low', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-            # remove the 'Not' constraints
-            not_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='not', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-
-        # if our low id set is empty. we assume all timeblocks are in the low set
-        if len(self.low_timeblock_ids) == 0: 
-            self.low_timeblock_ids = [ t.id for t in Timeblock.query.all() ]
-
-        self.mand_timeblock_ids = set(self.mand_timeblock_ids) - set(not_timeblock_ids)
-        self.high_timeblock_ids = set(self.high_timeblock_ids) - set(not_timeblock_ids)
-        self.low_timeblock_ids = set(self.low_timeblock_ids) - set(not_timeblock_ids)
-
-        # now calculate the classrooms
-        mand_classroom_ids = [ ct.classroom_id for ct in 
-                               ClassroomsCourse.query.filter_by(priority='mandatory', 
-                                                                 course_id=self.course_id,
-                                                                 active=True).all() ]
-        high_classroom_ids = [ ct.classroom_id for ct in 
-                               ClassroomsCourse.query.filter_by(priority='high', 
-                                                                 course_id=self.course_id,
-                                                                 active=True).all() ]
-        low_classroom_ids = [ ct.classroom_id for ct in 
-                               ClassroomsCourse.query.filter_by(priority='low', 
-                                                                 course_id=self.course_id,
-                                                                 active=True).all() ]
-
-        not_classroom_ids = [ ct.classroom_id for ct in 
-                               ClassroomsCourse.query.filter_by(priority='not', 
-                                                                 course_id=self.course_id,
-                                                                 active=True).all() ]
-
-        for subject_id in self.subject_ids:
-            mand_classroom_ids += [ cs.classroom_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='mandatory', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-            high_classroom_ids += [ cs.classroom_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='high', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-            low_classroom_ids += [ cs.classroom_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='low', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-            not_classroom_ids += [ cs.classroom_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='not', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-        
-        # if our low id set is empty. we assume all timeblocks are in the low set
-        if len(low_classroom_ids) == 0:
-            low_classroom_ids = [ c.id for c in Classroom.query.all() ]
-
-        mand_classroom_ids = set(mand_classroom_ids) - set(not_classroom_ids)
-        high_classroom_ids = set(high_classroom_ids) - set(not_classroom_ids)
-        low_classroom_ids = set(low_classroom_ids) - set(not_classroom_ids)
+            return course.low_classroom_constraints
+
+    def get_timeblock_ids(self, relaxed=None):
+        relaxed = self.relaxed if relaxed is None else relaxed
+        course = self.course_constraint
+        if len(course.mand_timeblock_ids) > 0:
+            return course.mand_timeblock_ids
+        elif len(course.high_timeblock_ids) > 0 and ('timeblock',) not in relaxed:
+            return course.high_timeblock_ids
+        else:
+            return course.low_timeblock_ids
 
+    def get_teacher_ids(self, relaxed=None):
+        return [ t.teacher_id for t in self.get_teacher_constraints(relaxed) ]
 
-        # now make a set of ClassroomConstraints from each list
-        self.mand_classroom_constraints = [ ClassroomConstraint(c_id) for c_id in mand_classroom_ids ]
-        self.high_classroom_constraints = [ ClassroomConstraint(c_id) for c_id in high_classroom_ids ]
-        self.low_classroom_constraints = [ ClassroomConstraint(c_id) for c_id in low_classroom_ids ]
-
-        # now calculate the Teacher ids
-        mand_teacher_ids = [ ct.teacher_id for ct in 
-                               CoursesTeacher.query.filter_by(priority='mandatory', 
-                                                                 course_id=self.course_id,
-                                                                 active=True).all() ]
-        high_teacher_ids = [ ct.teacher_id for ct in 
-                               CoursesTeacher.query.filter_by(priority='high', 
-                                                                 course_id=self.course_id,
-                                                                 active=True).all() ]
-        low_teacher_ids = [ ct.teacher_id for ct in 
-                               CoursesTeacher.query.filter_by(priority='low', 
-                                                                 course_id=self.course_id,
-                                                                 active=True).all() ]
-        not_teacher_ids = [ ct.teacher_id for ct in 
-                               CoursesTeacher.query.filter_by(priority='not', 
-                                                                 course_id=self.course_id,
-                                                                 active=True).all() ]
-        for subject_id in self.subject_ids:
-            mand_teacher_ids += [ cs.teacher_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='mandatory', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-            high_teacher_ids += [ cs.teacher_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='high', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-            low_teacher_ids += [ cs.teacher_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='low', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-            not_teacher_ids += [ cs.teacher_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='not', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
+    def get_classroom_ids(self, relaxed=None):
+        return [ c.classroom_id for c in self.get_classroom_constraints(relaxed) ]
 
-        # if our low id set is empty. we assume all timeblocks are in the low set
-        if len(low_teacher_ids) == 0:
-            low_teacher_ids = [ c.id for c in Classroom.query.all() ]
+    # the teacher and classroom constraints are shared, so their view for this class has to be
+    # asked for through the class
+    def get_teacher_classroom_constraints(self, teacher_constraint, relaxed=None):
+        return teacher_constraint.get_classroom_constraints(self.relaxed if relaxed is None else relaxed)
 
+    def get_teacher_classroom_ids(self, teacher_constraint, relaxed=None):
+        return teacher_constraint.get_classroom_ids(self.relaxed if relaxed is None else relaxed)
 
-        mand_teacher_ids = set(mand_teacher_ids) - set(not_teacher_ids)
-        high_teacher_ids = set(high_teacher_ids) - set(not_teacher_ids)
-        low_teacher_ids = set(low_teacher_ids) - set(not_teacher_ids)
+    def get_teacher_timeblock_ids(self, teacher_constraint, relaxed=None):
+        return teacher_constraint.get_timeblock_ids(self.relaxed if relaxed is None else relaxed)
 
-        # now make a set of TeacherConstraints from each list
-        self.mand_teacher_constraints = [ TeacherConstraint(t_id) for t_id in mand_teacher_ids ]
-        self.high_teacher_constraints = [ TeacherConstraint(t_id) for t_id in high_teacher_ids ]
-        self.low_teacher_constraints = [ TeacherConstraint(t_id) for t_id in low_teacher_ids ]
+    def get_teacher_classroom_timeblock_ids(self, teacher_constraint, classroom_constraint, relaxed=None):
+        return teacher_constraint.get_classroom_timeblock_ids(classroom_constraint,
+                                                              self.relaxed if relaxed is None else relaxed)
 
@@ -1,9 +1,16 @@
 from schoolbloc.scheduler.models import *
+from schoolbloc.scheduler.constraint_snapshot import ConstraintSnapshot
 import schoolbloc.scheduler.scheduler_util as SchedUtil
 
 class ClassroomConstraint:
-    def __init__(self, classroom_id):
+    def __init__(self, classroom_id, snapshot=None):
+        """
+        Holds the timeblock constraints of a classroom. The object is never modified after it
+        is built, relaxations are recorded in the relaxed set of the class they apply to and
+        passed in by the caller (see ClassConstraint)
+        """
         self.classroom_id = classroom_id
+        self.snapshot = snapshot or ConstraintSnapshot()
         self.subject_ids = []
 
         self.mand_timeblock_ids = []
@@ -13,79 +20,63 @@ class ClassroomConstraint:
         self.calc_subject_ids()
         self.calc_timeblock_constraints()
 
+    @classmethod
+    def cached(cls, classroom_id, snapshot):
+        """ Returns the ClassroomConstraint for the classroom, building it once per snapshot """
+        key = (cls, classroom_id)
+        if key not in snapshot.constraint_cache:
+            snapshot.constraint_cache[key] = cls(classroom_id, snapshot)
+        return snapshot.constraint_cache[key]
 
-    def relax_constraints(self, class_id):
-        if len(self.mand_timeblock_ids) == 0 and len(self.high_timeblock_ids) > 0:
+    def relax_key(self, prefix=()):
+        return prefix + ('classroom', self.classroom_id, 'timeblock')
+
+    def relax_constraints(self, class_id, relaxed, prefix=()):
+        if self.can_relax_constraints(relaxed, prefix):
             SchedUtil.log_note("info", "Scheduler", "Relaxing the classroom->timeblock constraints for class {} (classroom: {})".format(
                     class_id, self.classroom_id))
-            self.high_classroom_ids = []
+            relaxed.add(self.relax_key(prefix))
             return 
 
         return False
 
-    def can_relax_constraints(self):
+    def can_relax_constraints(self, relaxed=frozenset(), prefix=()):
         """
-        Returns true if this teacher or its descendants contains high priority constraints that can
+        Returns true if this classroom contains high priority constraints that can
         fall back to low priority constraints
         """
 
         if len(self.mand_timeblock_ids) == 0 and len(self.high_timeblock_ids) > 0:
-                return True
+                return self.relax_key(prefix) not in relaxed
 
         return False
 
-    def get_timeblock_ids(self):
+    def get_timeblock_ids(self, relaxed=frozenset(), prefix=()):
         if len(self.mand_timeblock_ids) > 0:
             return self.mand_timeblock_ids
-        elif len(self.high_timeblock_ids) > 0:
+        elif len(self.high_timeblock_ids) > 0 and self.relax_key(prefix) not in relaxed:
             return self.high_timeblock_ids
         else:
             return self.low_timeblock_ids
 
     def calc_subject_ids(self):
-        cs_list = ClassroomsSubject.query.filter_by(classroom_id=self.classroom_id).all()
-        self.subject_ids = [ cs.subject_id for cs in cs_list ] 
-
-    def calc_timeblock_constraints(self, input_mand_ids=None, input_high_ids=None, input_low_ids=None):
+        self.subject_ids = list(self.snapshot.classroom_subjects.get(self.classroom_id, []))
 
-        self.mand_timeblock_ids = [ ct.timeblock_id for ct in 
-                        ClassroomsTimeblock.query.filter_by(priority='mandatory', 
-                                                            classroom_id=self.classroom_id,
-                                                            active=True).all() ]
-        self.high_timeblock_ids = [ ct.timeblock_id for ct in 
-                        ClassroomsTimeblock.query.filter_by(priority='high', 
-                                                            classroom_id=self.classroom_id,
-                                                            active=True).all() ]
-        self.low_timeblock_ids = [ ct.timeblock_id for ct in 
-                        ClassroomsTimeblock.query.filter_by(priority='low', 
-                                                            classroom_id=self.classroom_id,
-                                                            active=True).all() ]
-        not_timeblock_ids = [ ct.timeblock_id for ct in 
-                        ClassroomsTimeblock.query.filter_by(priority='not', 
-                                                            classroom_id=self.classroom_id,
-                                                            active=True).all() ]
-        for subject_id in self.subject_ids:
-            self.mand_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='mandatory', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-            self.high_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='high', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-            self.low_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='low', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-            not_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='not', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
+    def calc_timeblock_constraints(self):
+        snapshot = self.snapshot
+        self.mand_timeblock_ids = snapshot.lookup(snapshot.classroom_timeblocks, self.classroom_id, 'mandatory') + \
+                                  snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'mandatory')
+        self.high_timeblock_ids = snapshot.lookup(snapshot.classroom_timeblocks, self.classroom_id, 'high') + \
+                                  snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'high')
+        self.low_timeblock_ids = snapshot.lookup(snapshot.classroom_timeblocks, self.classroom_id, 'low') + \
+                                 snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'low')
+        not_timeblock_ids = snapshot.lookup(snapshot.classroom_timeblocks, self.classroom_id, 'not') + \
+                            snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'not')
 
         # if our low id set is empty. we assume all timeblocks are in the low set
         if len(self.low_timeblock_ids) == 0: 
-            self.low_timeblock_ids = [ t.id for t in Timeblock.query.all() ]
+            self.low_timeblock_ids = list(snapshot.timeblock_ids)
 
         self.mand_timeblock_ids = set(self.mand_timeblock_ids) - set(not_timeblock_ids)
         self.high_timeblock_ids = set(self.high_timeblock_ids) - set(not_timeblock_ids)
-        self.low_timeblock_ids = set(self.low_timeblock_ids) - set(not_timeblock_ids)
\ No newline at end of file
+        self.low_timeblock_ids = set(self.low_timeblock_ids) - set(not_timeblock_ids)
@@ -0,0 +1,110 @@
+from schoolbloc.scheduler.models import *
+from schoolbloc.config import config
+
+
+class ConstraintSnapshot:
+    """
+    An in memory copy of every fact and constraint mapping table the scheduler reads.
+
+    The constraint classes (ClassConstraint, TeacherConstraint, ClassroomConstraint and
+    StudentConstraint) used to query the mapping tables once per priority for every object
+    they built. The snapshot loads each table with a single query and indexes the rows by
+    (entity_id, priority), so building the constraints for a scheduling run costs a handful
+    of queries no matter how many students, classes or teachers are involved.
+    """
+    PRIORITIES = ('mandatory', 'high', 'low', 'not')
+
+    def __init__(self):
+        # Facts
+        self.timeblock_ids = [ t_id for (t_id,) in db.session.query(Timeblock.id).order_by(Timeblock.id) ]
+        self.classroom_ids = [ c_id for (c_id,) in db.session.query(Classroom.id).order_by(Classroom.id) ]
+        self.teacher_ids = [ t_id for (t_id,) in db.session.query(Teacher.id).order_by(Teacher.id) ]
+        self.student_ids = [ s_id for (s_id,) in db.session.query(Student.id).order_by(Student.id) ]
+
+        # course_id => (name, min_student_count, max_student_count)
+        self.courses = {}
+        for c_id, name, min_count, max_count in db.session.query(Course.id, Course.name,
+                                                                 Course.min_student_count,
+                                                                 Course.max_student_count):
+            self.courses[c_id] = (name, min_count, max_count)
+
+        # Subject membership. These were never filtered on the active flag or the
+        # priority, so neither are the snapshots of them
+        self.course_subjects = self._group(CoursesSubject, 'course_id', 'subject_id')
+        self.subject_courses = self._group(CoursesSubject, 'subject_id', 'course_id')
+        self.teacher_subjects = self._group(TeachersSubject, 'teacher_id', 'subject_id')
+        self.classroom_subjects = self._group(ClassroomsSubject, 'classroom_id', 'subject_id')
+        self.student_student_groups = self._group(StudentsStudentGroup, 'student_id', 'student_group_id')
+
+        # Prioritized constraints, keyed by (entity_id, priority)
+        self.course_timeblocks = self._index(CoursesTimeblock, 'course_id', 'timeblock_id')
+        self.course_classrooms = self._index(ClassroomsCourse, 'course_id', 'classroom_id')
+        self.course_teachers = self._index(CoursesTeacher, 'course_id', 'teacher_id')
+        self.subject_timeblocks = self._index(SubjectsTimeblock, 'subject_id', 'timeblock_id')
+        self.subject_classrooms = self._index(ClassroomsSubject, 'subject_id', 'classroom_id')
+        self.teacher_timeblocks = self._index(TeachersTimeblock, 'teacher_id', 'timeblock_id')
+        self.teacher_classrooms = self._index(ClassroomsTeacher, 'teacher_id', 'classroom_id')
+        self.classroom_timeblocks = self._index(ClassroomsTimeblock, 'classroom_id', 'timeblock_id')
+
+        # Student requirements were read without checking the active flag. The subject
+        # requirements are kept in subject order, which decides the order the student's
+        # courses are requested in
+        self.student_courses = self._index(CoursesStudent, 'student_id', 'course_id', active_only=False)
+        self.student_subjects = self._index(StudentsSubject, 'student_id', 'subject_id',
+                                            active_only=False, order_column='subject_id')
+        self.student_group_courses = self._index(CoursesStudentGroup, 'student_group_id', 'course_id',
+                                                 active_only=False)
+        self.student_group_subjects = self._index(StudentGroupsSubject, 'student_group_id', 'subject_id',
+                                                  active_only=False, order_column='subject_id')
+
+        # Constraint objects built from this snapshot (CourseConstraint, TeacherConstraint and
+        # ClassroomConstraint), keyed by (class, id). See their cached() methods
+        self.constraint_cache = {}
+
+    @staticmethod
+    def _group(orm, key_column, value_column):
+        """
+        Returns a dict of key_column value => list of value_column values for every row in
+        the given mapping table, in insertion (id) order
+        """
+        index = {}
+        query = db.session.query(getattr(orm, key_column), getattr(orm, value_column)).order_by(orm.id)
+        for key, value in query:
+            index.setdefault(key, []).append(value)
+        return index
+
+    @staticmethod
+    def _index(orm, key_column, value_column, active_only=True, order_column='id'):
+        """
+        Returns a dict of (key_column value, priority) => list of value_column values for
+        the given mapping table, ordered by order_column (insertion order by default)
+        """
+        index = {}
+        query = db.session.query(getattr(orm, key_column), getattr(orm, value_column), orm.priority)
+        if active_only:
+            query = query.filter(orm.active == True)
+        for key, value, priority in query.order_by(getattr(orm, order_column), orm.id):
+            index.setdefault((key, priority), []).append(value)
+        return index
+
+    @staticmethod
+    def lookup(index, entity_id, priority):
+        """ Returns the ids stored in an index for the entity and priority (empty list if none) """
+        return index.get((entity_id, priority), [])
+
+    @staticmethod
+    def lookup_subjects(index, subject_ids, priority):
+        """ Returns the ids stored in an index for each of the subjects at the given priority """
+        ids = []
+        for subject_id in subject_ids:
+            ids += index.get((subject_id, priority), [])
+        return ids
+
+    def course_name(self, course_id):
+        return self.courses[course_id][0]
+
+    def min_student_count(self, course_id):
+        return self.courses[course_id][1] or config.default_min_class_size
+
+    def max_student_count(self, course_id):
+        return self.courses[course_id][2] or config.default_max_class_size
@@ -0,0 +1,331 @@
+import unittest
+import tempfile
+import os
+import itertools
+from unittest import mock
+from z3 import *
+from schoolbloc import app, db
+from schoolbloc.scheduler.models import *
+from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
+from schoolbloc.scheduler.schedule_data import ScheduleClass, ScheduleCollision
+from schoolbloc.scheduler.scheduler import SchedulerNoSolution
+from schoolbloc.scheduler.portfolio_scheduler import PortfolioScheduler
+from schoolbloc.scheduler.optimize_scheduler import OptimizeScheduler
+from schoolbloc.scheduler.test_util import SchedulerTestUtilities as TestUtil
+
+
+class ConstraintTests(unittest.TestCase):
+    """ Tests building the scheduler constraints from the DB """
+
+    def setUp(self):
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        self.reset_db()
+
+    def tearDown(self):
+        os.close(self.db_fd)
+        os.unlink(app.config['DATABASE'])
+
+    def reset_db(self):
+        db.drop_all()
+        db.create_all()
+        for name in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']:
+            db.session.add(Day(name=name))
+        db.session.commit()
+
+    def build_dataset(self, student_count=6, max_student_count=2):
+        """
+        One course with a high priority teacher (falling back to two low priority ones)
+        and enough students to need several classes of it
+        """
+        TestUtil.generate_timeblocks()
+        self.teachers = TestUtil.generate_teachers(3)
+        self.classrooms = [ Classroom(room_number=r) for r in [101, 102, 103] ]
+        for r in self.classrooms: db.session.add(r)
+        db.session.flush()
+        self.course = Course(name="Algebra", max_student_count=max_student_count)
+        db.session.add(self.course)
+        db.session.flush()
+        self.students = TestUtil.generate_students(student_count)
+
+        db.session.add(CoursesTeacher(course_id=self.course.id, teacher_id=self.teachers[0].id, priority='high'))
+        for teacher in self.teachers[1:]:
+            db.session.add(CoursesTeacher(course_id=self.course.id, teacher_id=teacher.id, priority='low'))
+        for student in self.students:
+            db.session.add(CoursesStudent(course_id=self.course.id, student_id=student.id, priority='mandatory'))
+        db.session.commit()
+
+    def test_classes_share_course_constraint(self):
+        self.build_dataset()
+        sched_constraints = ScheduleConstraints()
+
+        classes = sched_constraints.class_constraints[self.course.id]
+        self.assertEqual(len(classes), 2)
+        self.assertIs(classes[0].course_constraint, classes[1].course_constraint)
+
+        class_count = sched_constraints.class_count
+        sched_class = ScheduleClass(self.course.id, self.classrooms[0].id, self.teachers[0].id, 1, 2, 0)
+        sched_constraints.add_class_from_collisions([ScheduleCollision(None, sched_class, 'timeblock')])
+        self.assertEqual(sched_constraints.class_count, class_count + 1)
+        self.assertIs(classes[-1].course_constraint, classes[0].course_constraint)
+
+    def test_relaxing_one_class(self):
+        self.build_dataset()
+        sched_constraints = ScheduleConstraints()
+        first, second = sched_constraints.class_constraints[self.course.id][:2]
+
+        self.assertEqual(first.get_teacher_ids(), [self.teachers[0].id])
+        self.assertTrue(first.can_relax_constraints())
+
+        first.relax_constraints()
+        self.assertEqual(sorted(first.get_teacher_ids()), sorted(t.id for t in self.teachers[1:]))
+        self.assertEqual(second.get_teacher_ids(), [self.teachers[0].id])
+        self.assertFalse(first.can_relax_constraints())
+        self.assertTrue(second.can_relax_constraints())
+
+    def test_low_teachers_default_to_every_teacher(self):
+        self.build_dataset()
+        CoursesTeacher.query.delete()
+        # more classrooms than teachers, so classroom ids can't pass for teacher ids
+        for r in [104, 105, 106]:
+            db.session.add(Classroom(room_number=r))
+        db.session.commit()
+
+        sched_constraints = ScheduleConstraints()
+        class_const = sched_constraints.class_constraints[self.course.id][0]
+        self.assertEqual(sorted(class_const.get_teacher_ids()), sorted(t.id for t in self.teachers))
+
+    def test_encodings(self):
+        # one classroom and teacher, so every class has to be in its own timeblock
+        self.build_dataset(student_count=8)
+        classroom = self.classrooms[0]
+        db.session.add(ClassroomsCourse(course_id=self.course.id, classroom_id=classroom.id, priority='mandatory'))
+        db.session.commit()
+
+        for attr_encoding in ScheduleConstraints.ATTRIBUTE_ENCODINGS:
+            for encoding in ScheduleConstraints.COLLISION_ENCODINGS:
+                sched_constraints = ScheduleConstraints(collision_encoding=encoding, attribute_encoding=attr_encoding)
+                sched_constraints.prep_z3_classes()
+                solver = Solver()
+                solver.add(sched_constraints.set_courses())
+                solver.add(sched_constraints.prevent_room_time_collision())
+                solver.add(sched_constraints.prevent_teacher_time_collision())
+                self.assertEqual(solver.check(), sat)
+
+                model = solver.model()
+                for i in range(sched_constraints.class_count):
+                    self.assertEqual(sched_constraints.db_id('room', model.evaluate(sched_constraints.room(i))),
+                                     classroom.id)
+                    self.assertEqual(sched_constraints.db_id('teacher', model.evaluate(sched_constraints.teacher(i))),
+                                     self.teachers[0].id)
+                times = [ sched_constraints.db_id('time', model.evaluate(sched_constraints.time(i)))
+                          for i in range(sched_constraints.class_count) ]
+                self.assertEqual(len(set(times)), sched_constraints.class_count, (attr_encoding, encoding))
+
+        with self.assertRaises(ValueError):
+            ScheduleConstraints(collision_encoding='unknown')
+        with self.assertRaises(ValueError):
+            ScheduleConstraints(attribute_encoding='unknown')
+
+    def test_path_encodings(self):
+        # the first course is in the first timeblock, so the students need a class of the
+        # second course (which needs two classes) in the second one
+        self.build_dataset(student_count=3, max_student_count=5)
+        second_course = Course(name="Geometry", max_student_count=1)
+        db.session.add(second_course)
+        db.session.flush()
+        timeblock_ids = [ t.id for t in Timeblock.query.order_by(Timeblock.id).limit(2) ]
+        db.session.add(CoursesTimeblock(course_id=self.course.id, timeblock_id=timeblock_ids[0], priority='mandatory'))
+        for t_id in timeblock_ids:
+            db.session.add(CoursesTimeblock(course_id=second_course.id, timeblock_id=t_id, priority='mandatory'))
+        for student in self.students:
+            db.session.add(CoursesStudent(course_id=second_course.id, student_id=student.id, priority='mandatory'))
+        db.session.commit()
+
+        for encoding in ScheduleConstraints.PATH_ENCODINGS:
+            for attr_encoding in ScheduleConstraints.ATTRIBUTE_ENCODINGS:
+                sched_constraints = ScheduleConstraints(path_encoding=encoding, attribute_encoding=attr_encoding)
+                solver = Solver()
+                solver.add(sched_constraints.get_constraints())
+                self.assertEqual(solver.check(), sat)
+
+                self.assertEqual(len(sched_constraints.class_constraints[second_course.id]), 2)
+                model = solver.model()
+                course_times = [ [ sched_constraints.db_id('time', model.evaluate(sched_constraints.time(c.z3_index)))
+                                   for c in sched_constraints.class_constraints[course_id] ]
+                                 for course_id in [self.course.id, second_course.id] ]
+                paths = [ path for path in itertools.product(*course_times) if len(set(path)) == len(path) ]
+                self.assertTrue(len(paths) > 0, (encoding, attr_encoding))
+
+    def test_requirement_profiles(self):
+        # every student requires the same courses, so they all share one profile
+        self.build_dataset(student_count=3, max_student_count=5)
+        second_course = Course(name="Geometry", max_student_count=5)
+        db.session.add(second_course)
+        db.session.flush()
+        for student in self.students:
+            db.session.add(CoursesStudent(course_id=second_course.id, student_id=student.id, priority='mandatory'))
+        db.session.commit()
+
+        sched_constraints = ScheduleConstraints()
+        self.assertEqual(len(sched_constraints.requirement_profiles), 1)
+        profile = list(sched_constraints.requirement_profiles.values())[0]
+        self.assertEqual(profile.course_ids, frozenset([self.course.id, second_course.id]))
+        self.assertEqual(profile.student_count, 3)
+        self.assertEqual(sorted(s.student_id for s in profile.student_requirements),
+                         sorted(s.id for s in self.students))
+
+        sched_constraints.prep_z3_classes()
+        sched_constraints.set_courses()
+        self.assertEqual(len(sched_constraints.ensure_course_timeblock_paths()), 1)
+
+    def test_incremental(self):
+        # one classroom, so every class has to be in its own timeblock
+        self.build_dataset(student_count=4)
+        classroom = self.classrooms[0]
+        db.session.add(ClassroomsCourse(course_id=self.course.id, classroom_id=classroom.id, priority='mandatory'))
+        db.session.commit()
+
+        for encoding in ScheduleConstraints.COLLISION_ENCODINGS:
+            sched_constraints = ScheduleConstraints(collision_encoding=encoding, incremental=True)
+            solver = Solver()
+            solver.add(sched_constraints.take_new_constraints())
+            self.assertEqual(solver.check(sched_constraints.assumptions()), sat)
+            self.assertEqual(sched_constraints.take_new_constraints(), [])
+
+            # only the new class's constraints are handed over, behind new guards
+            old_guards = sched_constraints.assumptions()
+            sched_class = ScheduleClass(self.course.id, classroom.id, self.teachers[0].id, 1, 2, 0)
+            sched_constraints.add_class_from_collisions([ScheduleCollision(None, sched_class, 'timeblock')])
+            new_constraints = sched_constraints.take_new_constraints()
+            if encoding == 'pairwise':
+                # the class, the profile needing its course, and its room and teacher pairs
+                self.assertEqual(len(new_constraints), 2 + 2 * (sched_constraints.class_count - 1))
+            solver.add(new_constraints)
+            self.assertEqual(solver.check(sched_constraints.assumptions()), sat)
+            self.assertNotEqual(set(g.get_id() for g in old_guards),
+                                set(g.get_id() for g in sched_constraints.assumptions()))
+
+            model = solver.model()
+            times = [ model.evaluate(sched_constraints.time(i)).as_long() for i in range(sched_constraints.class_count) ]
+            self.assertEqual(len(set(times)), sched_constraints.class_count, encoding)
+
+            # a relaxed class lets go of the high priority teacher
+            first = sched_constraints.class_constraints[self.course.id][0]
+            sched_constraints.relax_constraints()
+            solver.add(sched_constraints.take_new_constraints())
+            solver.add(sched_constraints.teacher(first.z3_index) != self.teachers[0].id)
+            self.assertEqual(solver.check(sched_constraints.assumptions()), sat)
+
+            # a mapping with the same class times is ruled out
+            sched_constraints.exclude_class_times(model)
+            solver.add(sched_constraints.take_new_constraints())
+            self.assertEqual(solver.check(sched_constraints.assumptions()), sat)
+            model = solver.model()
+            self.assertNotEqual([ model.evaluate(sched_constraints.time(i)).as_long()
+                                  for i in range(sched_constraints.class_count) ], times)
+
+    def relaxation_checks(self, relaxation):
+        """ checks (and relaxes) the constraints until there is a mapping, returns the number of checks """
+        sched_constraints = ScheduleConstraints(incremental=True, relaxation=relaxation)
+        solver = Solver()
+        checks = 0
+        while True:
+            solver.add(sched_constraints.take_new_constraints())
+            checks += 1
+            if solver.check(sched_constraints.assumptions()) == sat:
+                return checks, sched_constraints
+            if relaxation == 'core':
+                self.assertTrue(sched_constraints.relax_core(solver.unsat_core()))
+            else:
+                sched_constraints.relax_constraints()
+
+    def build_preference_dataset(self):
+        """
+        The high priority teacher only has one timeblock, but the five classes are in one
+        classroom (so they each need their own timeblock) and they all start out with them
+        """
+        self.build_dataset(student_count=13)
+        db.session.add(ClassroomsCourse(course_id=self.course.id, classroom_id=self.classrooms[0].id, priority='mandatory'))
+        timeblock = Timeblock.query.order_by(Timeblock.id).first()
+        db.session.add(TeachersTimeblock(teacher_id=self.teachers[0].id, timeblock_id=timeblock.id, priority='mandatory'))
+        db.session.commit()
+
+    def test_core_relaxation(self):
+        self.build_preference_dataset()
+
+        first_checks, sched_constraints = self.relaxation_checks('first')
+        core_checks, sched_constraints = self.relaxation_checks('core')
+        self.assertEqual(first_checks, 5)
+        self.assertTrue(core_checks < first_checks, core_checks)
+
+        # only the course->teacher preferences were relaxed, and at most one class kept it
+        classes = sched_constraints.class_constraints[self.course.id]
+        self.assertEqual(len(classes), 5)
+        for class_const in classes:
+            self.assertTrue(class_const.relaxed <= set([('teacher',)]))
+        self.assertTrue(len([ c for c in classes if ('teacher',) not in c.relaxed ]) <= 1)
+
+        with self.assertRaises(ValueError):
+            ScheduleConstraints(relaxation='core')
+
+    def test_soft_relaxation(self):
+        self.build_preference_dataset()
+        sched_constraints = ScheduleConstraints(relaxation='soft')
+        preferences = sched_constraints.soft_preferences()
+        self.assertEqual(len(preferences), 5)
+        self.assertEqual(set(weight for pref, weight in preferences), set([3]))
+
+        # the best mapping gives the high priority teacher to exactly one class
+        solver = Optimize()
+        solver.add(sched_constraints.get_constraints())
+        for pref, weight in preferences:
+            solver.add_soft(pref, weight)
+        self.assertEqual(solver.check(), sat)
+        model = solver.model()
+        teacher_ids = [ model.evaluate(sched_constraints.teacher(i)).as_long() for i in range(sched_constraints.class_count) ]
+        self.assertEqual(teacher_ids.count(self.teachers[0].id), 1)
+        self.assertEqual(len([ p for p, w in preferences if is_true(model.evaluate(p, model_completion=True)) ]), 1)
+
+    def test_optimize_encodings(self):
+        # the classes share one timeblock, so all but one of them have to let go of the high
+        # priority teacher and classroom
+        self.build_dataset(student_count=9, max_student_count=3)
+        timeblock = Timeblock.query.order_by(Timeblock.id).first()
+        db.session.add(CoursesTimeblock(course_id=self.course.id, timeblock_id=timeblock.id, priority='mandatory'))
+        db.session.add(ClassroomsCourse(course_id=self.course.id, classroom_id=self.classrooms[0].id, priority='high'))
+        db.session.commit()
+
+        for attr_encoding, encoding in [ ('bitvec', 'pairwise'), ('int', 'pseudo_boolean'), ('bitvec', 'pseudo_boolean') ]:
+            schedule_id = OptimizeScheduler(collision_encoding=encoding, attribute_encoding=attr_encoding).make_schedule()
+            classes = ScheduledClass.query.filter_by(schedule_id=schedule_id).all()
+            self.assertTrue(len(classes) > 1)
+            teacher_times = set((c.teacher_id, c.start_time) for c in classes)
+            room_times = set((c.classroom_id, c.start_time) for c in classes)
+            self.assertEqual(len(teacher_times), len(classes), (attr_encoding, encoding))
+            self.assertEqual(len(room_times), len(classes), (attr_encoding, encoding))
+
+
+    def test_portfolio(self):
+        self.build_dataset()
+        configurations = [ {'seed': 1}, {'tactic': 'qflia', 'seed': 2} ]
+        self.assertRaises(ValueError, PortfolioScheduler, [ {'tactic': 'qflia', 'relaxation': 'core', 'incremental': True} ])
+
+        portfolio = PortfolioScheduler(configurations)
+        portfolio.make_schedule()
+        self.assertIn(portfolio.winner, configurations)
+        self.assertEqual(Schedule.query.count(), 1)
+        self.assertEqual(ScheduledClassesStudent.query.count(), len(self.students))
+
+    def test_portfolio_exited_racer(self):
+        # a racer killed before putting its result doesn't leave the race waiting for it
+        self.build_dataset()
+        portfolio = PortfolioScheduler([ {'seed': 1} ])
+        with mock.patch('schoolbloc.scheduler.portfolio_scheduler.run_configuration', lambda *args: os._exit(1)):
+            self.assertRaises(SchedulerNoSolution, portfolio.make_schedule)
+        self.assertIsNone(portfolio.winner)
+
+
+if __name__ == '__main__':
+    unittest.main()
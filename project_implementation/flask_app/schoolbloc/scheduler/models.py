@@ -3,11 +3,13 @@ import random
 import string
 
 from collections import OrderedDict
+from datetime import datetime
 
 from schoolbloc import db, app
 from sqlalchemy import event, UniqueConstraint
 from sqlalchemy.engine import Engine
 from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.orm import joinedload, subqueryload
 
 log = logging.getLogger(__name__)
 
@@ -807,45 +809,129 @@ class Schedule(db.Model, SqlalchemySerializer):
         ret['name'] = self.name
         ret['created_at'] = str(self.created_at)
         if expanded:
-            ret['classes'] = [s.serialize() for s in self.scheduled_classes]
+            # the rooms, courses, teachers and students of every class in two queries
+            classes = ScheduledClass.query.filter_by(schedule_id=self.id)\
+                                          .order_by(ScheduledClass.id)\
+                                          .options(joinedload('classroom'), joinedload('course'),
+                                                   joinedload('teacher'),
+                                                   subqueryload('scheduled_classes_student').joinedload('student'))
+            ret['classes'] = [s.serialize() for s in classes]
         return ret
 
+    def class_query(self):
+        """ The classes of this schedule with their course, room and teacher, a row per class (see class_view) """
+        return db.session.query(ScheduledClass.id, ScheduledClass.start_time, ScheduledClass.end_time,
+                                ScheduledClass.days, ScheduledClass.course_id, Course.name,
+                                ScheduledClass.classroom_id, Classroom.room_number,
+                                ScheduledClass.teacher_id, Teacher.first_name, Teacher.last_name)\
+                         .join(Course, ScheduledClass.course_id == Course.id)\
+                         .join(Classroom, ScheduledClass.classroom_id == Classroom.id)\
+                         .join(Teacher, ScheduledClass.teacher_id == Teacher.id)\
+                         .filter(ScheduledClass.schedule_id == self.id)
+
+    @staticmethod
+    def class_view(row):
+        """ A class_query row as the class is listed in the timetables """
+        (class_id, start_time, end_time, days, course_id, course_name, classroom_id, room_number,
+         teacher_id, teacher_first_name, teacher_last_name) = row[:11]
+        return {
+            'classroom': str(room_number),
+            'classroom_id': classroom_id,
+            'course': course_name,
+            'course_id': course_id,
+            'teacher': "{} {}".format(teacher_first_name, teacher_last_name),
+            'teacher_id': teacher_id,
+            'start_time': start_time,
+            'end_time': end_time,
+            'days': [day.strip() for day in days.split(',')]
+        }
+
     def student_serialize(self):
         ret = OrderedDict()
         ret['id'] = self.id
         ret['name'] = self.name
         ret['created_at'] = str(self.created_at)
 
+        # A row for each student of each class, so the whole view is read with one query
+        rows = self.class_query()\
+                   .add_columns(Student.id, Student.first_name, Student.last_name)\
+                   .join(ScheduledClassesStudent, ScheduledClassesStudent.scheduled_class_id == ScheduledClass.id)\
+                   .join(Student, ScheduledClassesStudent.student_id == Student.id)\
+                   .order_by(ScheduledClass.id, ScheduledClassesStudent.id)
+
+        # class id => the class as it is listed for each of its students
+        classes = {}
         # This is a dict just for the sake of adding new classes for students
         # efficiently. When we return this, we will convert it back into a list
         # with just the values of the students in there (having an int as the
         # key is invalid json)
         students = {}
-        for sch_class in self.scheduled_classes:
-            for student in sch_class.students:
-                if student.id not in students:
-                    students[student.id] = OrderedDict()
-                    students[student.id]['id'] = student.id
-                    students[student.id]['first_name'] = student.first_name
-                    students[student.id]['last_name'] = student.last_name
-                    students[student.id]['classes'] = []
-
-                students[student.id]['classes'].append({
-                    'classroom': str(sch_class.classroom),
-                    'classroom_id': sch_class.classroom.id,
-                    'course': str(sch_class.course),
-                    'course_id': sch_class.course_id,
-                    'teacher': str(sch_class.teacher),
-                    'teacher_id': sch_class.teacher_id,
-                    'start_time': sch_class.start_time,
-                    'end_time': sch_class.end_time,
-                    'days': [day.strip() for day in sch_class.days.split(',')]
-                })
+        for row in rows:
+            class_id = row[0]
+            if class_id not in classes:
+                classes[class_id] = self.class_view(row)
+
+            student_id, first_name, last_name = row[11:]
+            if student_id not in students:
+                students[student_id] = OrderedDict()
+                students[student_id]['id'] = student_id
+                students[student_id]['first_name'] = first_name
+                students[student_id]['last_name'] = last_name
+                students[student_id]['classes'] = []
+            students[student_id]['classes'].append(classes[class_id])
 
         # Where we convert it back into a list, for reasons mentioned above
         ret['students'] = [s for s in students.values()]
         return ret
 
+    def student_timetable(self, student):
+        """ The classes of one student in this schedule, looked up by the student's index """
+        ret = OrderedDict()
+        ret['id'] = self.id
+        ret['name'] = self.name
+        ret['created_at'] = str(self.created_at)
+
+        rows = self.class_query()\
+                   .join(ScheduledClassesStudent, ScheduledClassesStudent.scheduled_class_id == ScheduledClass.id)\
+                   .filter(ScheduledClassesStudent.student_id == student.id)\
+                   .order_by(ScheduledClass.id)
+        ret['student'] = OrderedDict()
+        ret['student']['id'] = student.id
+        ret['student']['first_name'] = student.first_name
+        ret['student']['last_name'] = student.last_name
+        ret['student']['classes'] = [self.class_view(row) for row in rows]
+        return ret
+
+    def teacher_timetable(self, teacher):
+        """ The classes one teacher teaches in this schedule, with their students """
+        ret = OrderedDict()
+        ret['id'] = self.id
+        ret['name'] = self.name
+        ret['created_at'] = str(self.created_at)
+
+        rows = self.class_query().filter(ScheduledClass.teacher_id == teacher.id).order_by(ScheduledClass.id).all()
+        class_students = {}
+        if rows:
+            students = db.session.query(ScheduledClassesStudent.scheduled_class_id, Student.id,
+                                        Student.first_name, Student.last_name)\
+                                 .join(Student, ScheduledClassesStudent.student_id == Student.id)\
+                                 .filter(ScheduledClassesStudent.scheduled_class_id.in_([row[0] for row in rows]))\
+                                 .order_by(ScheduledClassesStudent.id)
+            for class_id, student_id, first_name, last_name in students:
+                class_students.setdefault(class_id, []).append(
+                    {'value': "{} {}".format(first_name, last_name), 'id': student_id})
+
+        ret['teacher'] = OrderedDict()
+        ret['teacher']['id'] = teacher.id
+        ret['teacher']['first_name'] = teacher.first_name
+        ret['teacher']['last_name'] = teacher.last_name
+        ret['teacher']['classes'] = []
+        for row in rows:
+            sch_class = self.class_view(row)
+            sch_class['students'] = class_students.get(row[0], [])
+            ret['teacher']['classes'].append(sch_class)
+        return ret
+
 
 class ScheduledClass(db.Model, SqlalchemySerializer):
     """
@@ -854,6 +940,8 @@ class ScheduledClass(db.Model, SqlalchemySerializer):
     A scheduled class is a combination of Teacher, Time, Classroom, Course, and Students
     """
     __tablename__ = 'scheduled_classes'
+    # a teacher's classes in a schedule (see Schedule.teacher_timetable)
+    __table_args__ = (db.Index('_schedule_teacher_ix', 'schedule_id', 'teacher_id'),)
     id = db.Column(db.Integer, primary_key=True)
     start_time = db.Column(db.Integer, nullable=False)  # time in 24 hr format (i.e. 1454)
     end_time = db.Column(db.Integer, nullable=False)
@@ -910,6 +998,9 @@ class ScheduledClassesStudent(db.Model, SqlalchemySerializer):
     This link means the student is a member of the scheduled class
     """
     __tablename__ = 'scheduled_classes_students'
+    # a student's classes (see Schedule.student_timetable) and a class's students
+    __table_args__ = (db.Index('_student_scheduled_class_ix', 'student_id', 'scheduled_class_id'),
+                      db.Index('_scheduled_class_student_ix', 'scheduled_class_id', 'student_id'))
     id = db.Column(db.Integer, primary_key=True)
     scheduled_class_id = db.Column(db.Integer, db.ForeignKey('scheduled_classes.id', ondelete="CASCADE"), nullable=False)
     student_id = db.Column(db.Integer, db.ForeignKey('students.id', ondelete="CASCADE"), nullable=False)
@@ -921,6 +1012,71 @@ class ScheduledClassesStudent(db.Model, SqlalchemySerializer):
         return "{} {}".format(self.scheduled_class, self.student)
 
 
+class ScheduleView(db.Model, SqlalchemySerializer):
+    """
+    ORM object for a serialized view of a schedule ('class' or 'student'), the zlib compressed
+    JSON written when the schedule is saved (see schedule_views)
+    """
+    __tablename__ = 'schedule_views'
+    __table_args__ = (UniqueConstraint('schedule_id', 'name', name='_schedule_view_uc'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('schedules.id', ondelete="CASCADE"), nullable=False)
+    name = db.Column(db.String(20), nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+
+class ScheduleJob(db.Model, SqlalchemySerializer):
+    """
+    ORM object for a run of the scheduler started through the api (see schedule_jobs)
+
+    A job is queued until a worker process is free, then running, and ends up succeeded
+    (with the schedule it made), failed or cancelled
+    """
+    __tablename__ = 'schedule_jobs'
+    STATES = ('queued', 'running', 'succeeded', 'failed', 'cancelled')
+    FINISHED_STATES = ('succeeded', 'failed', 'cancelled')
+
+    id = db.Column(db.Integer, primary_key=True)
+    state = db.Column(db.String(20), nullable=False, default='queued')
+    portfolio = db.Column(db.Boolean, nullable=False, default=False)
+    # progress, the solver checks so far and the classes of the current mapping
+    check_count = db.Column(db.Integer, nullable=False, default=0)
+    class_count = db.Column(db.Integer)
+    message = db.Column(db.String(255))
+    pid = db.Column(db.Integer)
+    # when the worker process started (see schedule_jobs.process_start_time), so a process
+    # given the worker's pid after it exited isn't taken for it
+    pid_start_time = db.Column(db.BigInteger)
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    schedule_id = db.Column(db.Integer, db.ForeignKey('schedules.id', ondelete="SET NULL"))
+
+    schedule = db.relationship('Schedule')
+
+    def finish(self, state, message, schedule_id=None):
+        """ ends the job in one of the FINISHED_STATES (the caller commits) """
+        self.state = state
+        self.message = message[:255]
+        self.schedule_id = schedule_id
+        self.finished_at = datetime.now()
+
+    def serialize(self):
+        ret = OrderedDict()
+        ret['id'] = self.id
+        ret['state'] = self.state
+        ret['portfolio'] = self.portfolio
+        ret['check_count'] = self.check_count
+        ret['class_count'] = self.class_count
+        ret['message'] = self.message
+        ret['schedule_id'] = self.schedule_id
+        for name in ['created_at', 'started_at', 'finished_at']:
+            value = getattr(self, name)
+            ret[name] = str(value) if value is not None else None
+        return ret
+
+
 class Notification(db.Model, SqlalchemySerializer):
     """
     ORM object representing a single notifications.
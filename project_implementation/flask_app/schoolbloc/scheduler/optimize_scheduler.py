@@ -0,0 +1,83 @@
+from z3 import *
+from schoolbloc.scheduler.scheduler import Scheduler, SchedulerNoSolution
+from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
+import schoolbloc.scheduler.scheduler_util as SchedUtil
+
+
+class OptimizeScheduler(Scheduler):
+    """
+    A Scheduler that gives the high priority constraints to a z3 Optimize as weighted soft
+    constraints (see ScheduleConstraints.soft_preferences). A single check finds the mapping
+    that keeps the most preferences, instead of relaxing them a round at a time. Classes are
+    still added when the students can't be placed.
+    """
+
+    def __init__(self, collision_encoding='pairwise', attribute_encoding='int', path_encoding='choice',
+                 placement='greedy'):
+        Scheduler.__init__(self, collision_encoding=collision_encoding,
+                           attribute_encoding=attribute_encoding,
+                           path_encoding=path_encoding,
+                           placement=placement)
+        self.solver = Optimize()
+        self.solver.set(timeout=300000) # 5 min
+
+    def make_schedule(self):
+        """ Finds the schedule keeping the most preferences and saves it, returns its id """
+        try:
+            return self.optimize_schedule()
+        finally:
+            SchedUtil.flush_notes()
+
+    def optimize_schedule(self):
+
+        SchedUtil.log_note("info", "Scheduler", "Scheduler started (optimizing the preferences)")
+        sched_constraints = ScheduleConstraints(collision_encoding=self.collision_encoding,
+                                                attribute_encoding=self.attribute_encoding,
+                                                path_encoding=self.path_encoding,
+                                                relaxation='soft')
+        self.solver.push()
+
+        for i in range(50):
+            collisions = []
+
+            SchedUtil.log_note("info", "Scheduler", "Attempting to solve using {} classes".format(sched_constraints.class_count))
+            for j in range(20): # try 20 different z3 mappings
+                SchedUtil.log_note("info", "Scheduler", "Generating a mapping of teachers, courses, classrooms and timeblocks")
+                if self.check(sched_constraints) != sat:
+                    SchedUtil.log_note("error", "Scheduler", "No valid mapping exists for current constraint set")
+                    raise SchedulerNoSolution('Not satisfiable')
+
+                model = self.solver.model()
+                self.log_kept_preferences(model, sched_constraints)
+                schedule = self.gen_sched_classes(model, sched_constraints)
+                collisions = self.place_students(schedule, sched_constraints.requirement_profiles.values())
+                if len(collisions) == 0:
+                    SchedUtil.log_note("success", "Scheduler",
+                                       "Solution found after {} solver checks, saving schedule now".format(self.check_count))
+                    return schedule.save()
+
+                # the optimum doesn't change, so the next check would find the same mapping
+                sched_constraints.exclude_class_times(model)
+                SchedUtil.log_note("warning", "Scheduler", "Failed placing students, attempting again with a new mapping")
+
+            SchedUtil.log_note("warning", "Scheduler", "Failed placing students, adding another class and trying again")
+            sched_constraints.add_class_from_collisions(collisions)
+
+        SchedUtil.log_note("error", "Scheduler", "Scheduler failed to place students")
+        raise SchedulerNoSolution('Failed to place students')
+
+    def check(self, sched_constraints):
+        """ Checks the current constraints of sched_constraints, weighing their preferences """
+        self.check_count += 1
+        self.set_constraints(sched_constraints.get_constraints())
+        for pref, weight in sched_constraints.soft_preferences():
+            self.solver.add_soft(pref, weight)
+        return self.solver.check()
+
+    def log_kept_preferences(self, model, sched_constraints):
+        preferences = sched_constraints.soft_preferences()
+        if len(preferences) == 0:
+            return
+        kept = [ pref for pref, weight in preferences if is_true(model.evaluate(pref, model_completion=True)) ]
+        msg = "Valid mapping found keeping {} of the {} preferences".format(len(kept), len(preferences))
+        SchedUtil.log_note("info", "Scheduler", msg)
@@ -0,0 +1,225 @@
+import unittest
+import tempfile
+import os
+import random
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor
+from schoolbloc import app, db
+from schoolbloc.scheduler.models import *
+from schoolbloc.scheduler.schedule_constraints import StudentRequirements, RequirementProfile
+from schoolbloc.scheduler.schedule_data import ScheduleClass, ScheduleStudent, ScheduleData
+from schoolbloc.scheduler.student_placement import MaxFlow, FlowPlacement
+from schoolbloc.scheduler.scheduler import Scheduler
+from schoolbloc.scheduler.test_util import SchedulerTestUtilities as TestUtil
+
+
+def exit_worker(*args):
+    """ a placement that kills its worker process """
+    os._exit(1)
+
+
+class PlacementTests(unittest.TestCase):
+    """ Tests placing students in the classes of a mapping """
+
+    def setUp(self):
+        self.db_fd, app.config['DATABASE'] = tempfile.mkstemp()
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        # the objects the earlier tests left in the session have the ids the rows of this one get
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        for name in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']:
+            db.session.add(Day(name=name))
+        db.session.commit()
+        TestUtil.generate_timeblocks()
+        self.timeblock_ids = [ t.id for t in Timeblock.query.order_by(Timeblock.id).all() ]
+
+    def tearDown(self):
+        os.close(self.db_fd)
+        os.unlink(app.config['DATABASE'])
+
+    def profiles(self, student_courses):
+        """ the RequirementProfiles of students requiring the given lists of course ids """
+        profiles = {}
+        for student_id, course_ids in enumerate(student_courses):
+            key = frozenset(course_ids)
+            if key not in profiles:
+                profiles[key] = RequirementProfile(course_ids)
+            profiles[key].student_requirements.append(StudentRequirements(student_id + 1, course_ids, []))
+        return list(profiles.values())
+
+    def test_max_flow(self):
+        network = MaxFlow(4)
+        edges = [ network.add_edge(0, 2, 2), network.add_edge(0, 3, 1), network.add_edge(2, 3, 1),
+                  network.add_edge(2, 1, 1), network.add_edge(3, 1, 2) ]
+        self.assertEqual(network.max_flow(0, 1), 3)
+        self.assertEqual([ network.flow(e) for e in edges ], [2, 1, 1, 1, 2])
+
+    def test_timeblock_bits(self):
+        first, second = self.timeblock_ids[:2]
+        a_first = ScheduleClass(1, 1, 1, first, 2, 0)
+        b_first = ScheduleClass(2, 2, 2, first, 2, 0)
+        b_second = ScheduleClass(2, 2, 2, second, 2, 0)
+        schedule = ScheduleData([a_first, b_first, b_second])
+        self.assertEqual(len(set(schedule.timeblock_bits.values())), len(self.timeblock_ids))
+
+        student = ScheduleStudent(1, [1, 2], [])
+        self.assertIsNone(a_first.add_student(student))
+        self.assertEqual(b_first.add_student(student).collision_type, 'timeblock')
+        self.assertIsNone(b_second.add_student(student))
+        self.assertIs(student.class_in(a_first.timeblock_bit), a_first)
+        self.assertEqual(student.occupied, a_first.timeblock_bit | b_second.timeblock_bit)
+
+        a_first.drop_student(student)
+        self.assertTrue(student.is_free(a_first.timeblock_bit))
+        self.assertIsNone(student.class_in(a_first.timeblock_bit))
+        self.assertEqual(student.classes, [b_second])
+
+    def test_places_what_the_greedy_order_cant(self):
+        # placing the first student first takes the class the second student needs
+        first, second = self.timeblock_ids[:2]
+        a_first = ScheduleClass(1, 1, 1, first, 1, 0)
+        a_second = ScheduleClass(1, 1, 1, second, 1, 0)
+        b_second = ScheduleClass(2, 2, 2, second, 1, 0)
+        schedule = ScheduleData([a_first, a_second, b_second])
+        profiles = self.profiles([[1], [1, 2]])
+
+        self.assertEqual(schedule.schedule_student(1, [1], []), [])
+        self.assertNotEqual(schedule.schedule_student(2, [1, 2], []), [])
+        schedule.clear_all_students()
+
+        self.assertEqual(Scheduler(placement='flow').place_students(schedule, profiles), [])
+        self.assertEqual([ s.id for s in a_first.students ], [2])
+        self.assertEqual([ s.id for s in a_second.students ], [1])
+        self.assertEqual([ s.id for s in b_second.students ], [2])
+        self.assertRaises(ValueError, Scheduler, placement='ordered')
+
+    def test_local_search(self):
+        # the second student is in the timeblock of the second course's only class, and the
+        # other class of the first course is full, so the students have to swap
+        first, second = self.timeblock_ids[:2]
+        a_first = ScheduleClass(1, 1, 1, first, 1, 0)
+        a_second = ScheduleClass(1, 1, 1, second, 1, 0)
+        b_second = ScheduleClass(2, 2, 2, second, 1, 0)
+        schedule = ScheduleData([a_first, a_second, b_second])
+        placement = FlowPlacement(schedule, self.profiles([[1], [1, 2]]))
+        placement.add(placement.students[1], a_first)
+        placement.add(placement.students[2], a_second)
+
+        unplaced = placement.place_course(2)
+        self.assertEqual(len(unplaced), 1)
+        self.assertEqual(placement.search(unplaced), [])
+        self.assertEqual([ [ s.id for s in c.students ] for c in [a_first, a_second, b_second] ], [[2], [1], [2]])
+
+    def test_repair(self):
+        # the greedy order puts the first student in the class the second one needs, the repair
+        # swaps them instead of starting over
+        first, second = self.timeblock_ids[:2]
+        a_first = ScheduleClass(1, 1, 1, first, 1, 0)
+        a_second = ScheduleClass(1, 1, 1, second, 1, 0)
+        b_second = ScheduleClass(2, 2, 2, second, 1, 0)
+        schedule = ScheduleData([a_first, a_second, b_second])
+        profiles = self.profiles([[1], [1, 2]])
+
+        self.assertEqual(Scheduler(placement='repair').place_students(schedule, profiles), [])
+        self.assertEqual([ [ s.id for s in c.students ] for c in [a_first, a_second, b_second] ], [[2], [1], [2]])
+        # the first student, the second one's backtracked try, its free seat and the swap
+        self.assertEqual(schedule.placement_count, 6)
+
+    def test_class_capacity(self):
+        # two one seat classes for three students: moving a student of a full class only helps
+        # when it frees a seat, swapping two students leaves the class full
+        first, second = self.timeblock_ids[:2]
+        a_first = ScheduleClass(1, 1, 1, first, 1, 0)
+        a_second = ScheduleClass(1, 1, 1, second, 1, 0)
+        schedule = ScheduleData([a_first, a_second])
+        collisions = Scheduler(placement='repair').place_students(schedule, self.profiles([[1], [1], [1]]))
+        self.assertEqual(len(set(c.student.id for c in collisions)), 1)
+        self.assertEqual([ len(c.students) for c in [a_first, a_second] ], [1, 1])
+
+        # the search after the flow ran into the same swap
+        classes = [ ScheduleClass(course_id, 1, 1, self.timeblock_ids[t], max_students, 0)
+                    for course_id, t, max_students in [ (1, 3, 1), (1, 2, 3), (1, 1, 2), (2, 3, 2), (2, 0, 1),
+                                                        (2, 3, 1), (3, 3, 1), (3, 0, 2), (4, 3, 3), (4, 1, 1),
+                                                        (4, 1, 2) ] ]
+        profiles = self.profiles([[2, 3, 4, 1], [4, 2, 3, 1], [2, 4], [4, 2]])
+        Scheduler(placement='flow').place_students(ScheduleData(classes), profiles)
+        for sch_class in classes:
+            self.assertTrue(len(sch_class.students) <= sch_class.max_student_count)
+
+        # random mappings, no placement may put more students in a class than it has seats for
+        rand = random.Random(1)
+        for case in range(300):
+            classes = [ ScheduleClass(course_id, 1, 1, rand.choice(self.timeblock_ids[:4]), rand.randint(1, 3), 0)
+                        for course_id in [1, 2, 3, 4] for i in range(rand.randint(1, 3)) ]
+            student_courses = [ rand.sample([1, 2, 3, 4], rand.randint(1, 4)) for i in range(rand.randint(2, 10)) ]
+            for placement in Scheduler.PLACEMENTS:
+                schedule = ScheduleData(classes)
+                schedule.clear_all_students()
+                Scheduler(placement=placement).place_students(schedule, self.profiles(student_courses))
+                for sch_class in classes:
+                    self.assertTrue(len(sch_class.students) <= sch_class.max_student_count, (case, placement))
+
+    def test_place_mappings(self):
+        # both courses in the same timeblock, and in different ones
+        first, second = self.timeblock_ids[:2]
+        same = ScheduleData([ ScheduleClass(1, 1, 1, first, 2, 0), ScheduleClass(2, 2, 2, first, 2, 0) ])
+        apart = ScheduleData([ ScheduleClass(1, 1, 1, first, 2, 0), ScheduleClass(2, 2, 2, second, 2, 0) ])
+        scheduler = Scheduler(parallel_mappings=2)
+        with ProcessPoolExecutor(max_workers=2) as pool:
+            schedule, collisions = scheduler.place_mappings(pool, [same, apart], self.profiles([[1, 2], [1, 2]]))
+        self.assertIs(schedule, apart)
+        self.assertEqual(collisions, [])
+        for class_list in apart.scheduled_classes.values():
+            self.assertEqual([ s.id for s in class_list[0].students ], [1, 2])
+
+        # the mappings of a pool whose worker died are placed in this process, and so are the
+        # ones submitted after it broke
+        with mock.patch('schoolbloc.scheduler.scheduler.place_mapping', exit_worker):
+            with ProcessPoolExecutor(max_workers=2) as pool:
+                for attempt in range(2):
+                    same.clear_all_students()
+                    apart.clear_all_students()
+                    schedule, collisions = scheduler.place_mappings(pool, [same, apart], self.profiles([[1, 2], [1, 2]]))
+                    self.assertIs(schedule, apart)
+                    self.assertEqual(collisions, [])
+                    for class_list in apart.scheduled_classes.values():
+                        self.assertEqual([ s.id for s in class_list[0].students ], [1, 2])
+        self.assertRaises(ValueError, Scheduler, parallel_mappings=0)
+
+    def test_infeasible(self):
+        # two students for one seat, and two courses only taught in the same timeblock
+        first = self.timeblock_ids[0]
+        schedule = ScheduleData([ ScheduleClass(1, 1, 1, first, 1, 0) ])
+        collisions = FlowPlacement(schedule, self.profiles([[1], [1]])).place()
+        self.assertEqual([ (c.student.id, c.collision_type) for c in collisions ], [(2, 'full class')])
+
+        schedule = ScheduleData([ ScheduleClass(1, 1, 1, first, 5, 0), ScheduleClass(2, 2, 2, first, 5, 0) ])
+        collisions = FlowPlacement(schedule, self.profiles([[1, 2], [1, 2], [1]])).place()
+        self.assertEqual(sorted(set(c.student.id for c in collisions)), [1, 2])
+
+    def test_bulk_save(self):
+        first, second = self.timeblock_ids[:2]
+        for name in ['Algebra', 'Biology']:
+            db.session.add(Course(name=name))
+        for room_number in [101, 102]:
+            db.session.add(Classroom(room_number=room_number))
+        TestUtil.generate_teachers(2)
+        TestUtil.generate_students(2)
+        for bulk in (False, True):
+            schedule = ScheduleData([ ScheduleClass(1, 1, 1, first, 2, 0), ScheduleClass(2, 2, 2, second, 2, 0) ])
+            self.assertEqual(Scheduler().place_students(schedule, self.profiles([[1, 2], [2]])), [])
+            schedule.save(bulk=bulk)
+
+        saved = []
+        for db_schedule in Schedule.query.order_by(Schedule.id).all():
+            saved.append(sorted((c.course_id, c.start_time, c.end_time, c.days, sorted(s.student_id for s in c.scheduled_classes_student))
+                                for c in db_schedule.scheduled_classes))
+        self.assertEqual(len(saved), 2)
+        self.assertEqual(saved[0], saved[1])
+        self.assertEqual([ len(class_students) for course_id, start, end, days, class_students in saved[1] ], [1, 2])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import multiprocessing
+import queue
+import time
+from schoolbloc import db
+from schoolbloc.scheduler.scheduler import Scheduler, SchedulerNoSolution
+from schoolbloc.scheduler.schedule_data import ScheduleClass, ScheduleStudent, ScheduleData
+import schoolbloc.scheduler.scheduler_util as SchedUtil
+
+
+class PortfolioScheduler:
+    """
+    Races several Scheduler configurations (z3 tactics, seeds, encodings and placements) in
+    separate processes. The first schedule found is saved and the other processes are
+    stopped. The winning configuration is logged and kept in self.winner, so the defaults can
+    be tuned to the data.
+    """
+
+    # the Scheduler keyword arguments of the configurations raced by default
+    CONFIGURATIONS = [
+        {},
+        {'seed': 1},
+        {'tactic': 'qflia', 'seed': 2},
+        {'attribute_encoding': 'bitvec', 'collision_encoding': 'distinct'},
+        {'incremental': True, 'placement': 'repair'},
+    ]
+    # the seconds between the checks for processes that died without a result
+    POLL_INTERVAL = 1
+
+    def __init__(self, configurations=None, timeout=None):
+        """
+        :param configurations: a list of Scheduler keyword arguments (CONFIGURATIONS by default)
+        :param timeout: the seconds to wait for a schedule, None waits until every configuration
+                        finished (or its process exited)
+        """
+        self.configurations = list(configurations or PortfolioScheduler.CONFIGURATIONS)
+        for configuration in self.configurations:
+            # raises ValueError on bad options before any process is started
+            Scheduler(**configuration)
+        self.timeout = timeout
+        self.winner = None
+
+    def make_schedule(self):
+        """ Saves the schedule of the first configuration that finds one, returns its id """
+        SchedUtil.log_note("info", "Scheduler", "Racing {} scheduler configurations".format(len(self.configurations)))
+        ctx = multiprocessing.get_context('fork')
+        results = ctx.Queue()
+        processes = [ ctx.Process(target=run_configuration, args=(i, configuration, results))
+                      for i, configuration in enumerate(self.configurations) ]
+        start_time = time.time()
+        for process in processes:
+            process.daemon = True
+            process.start()
+
+        try:
+            # the configurations that haven't put a result on the queue yet
+            racing = set(range(len(processes)))
+            while len(racing) > 0:
+                wait = PortfolioScheduler.POLL_INTERVAL
+                if self.timeout is not None:
+                    wait = min(wait, max(0, self.timeout - (time.time() - start_time)))
+                # checked before reading, a process puts its result on the queue before it exits
+                exited = all(not processes[i].is_alive() for i in racing)
+                try:
+                    index, class_tuples, class_students, message = results.get(timeout=wait)
+                except queue.Empty:
+                    if exited:
+                        for i in sorted(racing):
+                            msg = "Configuration {} exited with code {} without a result".format(
+                                self.configurations[i], processes[i].exitcode)
+                            SchedUtil.log_note("warning", "Scheduler", msg)
+                        break
+                    if self.timeout is not None and time.time() - start_time >= self.timeout:
+                        SchedUtil.log_note("error", "Scheduler", "No configuration found a schedule in {} seconds".format(self.timeout))
+                        raise SchedulerNoSolution('Timed out')
+                    continue
+
+                racing.discard(index)
+                if class_tuples is None:
+                    msg = "Configuration {} failed: {}".format(self.configurations[index], message)
+                    SchedUtil.log_note("warning", "Scheduler", msg)
+                    continue
+
+                self.winner = self.configurations[index]
+                msg = "Configuration {} won after {:.1f} seconds ({})".format(self.winner, time.time() - start_time, message)
+                SchedUtil.log_note("success", "Scheduler", msg)
+                return self.to_schedule_data(class_tuples, class_students).save()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+            SchedUtil.flush_notes()
+
+        SchedUtil.log_note("error", "Scheduler", "Every configuration failed")
+        raise SchedulerNoSolution('Not satisfiable')
+
+    def to_schedule_data(self, class_tuples, class_students):
+        classes = [ ScheduleClass(*class_tuple) for class_tuple in class_tuples ]
+        schedule = ScheduleData(classes)
+        students = {}
+        for sch_class, student_ids in zip(classes, class_students):
+            for student_id in student_ids:
+                if student_id not in students:
+                    students[student_id] = ScheduleStudent(student_id, [], [])
+                sch_class.students.append(students[student_id])
+                students[student_id].add_class(sch_class)
+        return schedule
+
+
+def run_configuration(index, configuration, results):
+    """
+    Builds a schedule with one configuration in a portfolio process and puts (index, class
+    tuples, student ids of each class, message) on the results queue, with None class tuples
+    when it failed
+    """
+    # the process's notifications need their own DB connections, not the scheduler's
+    db.engine.dispose()
+    SchedUtil.reset_notes()
+    try:
+        scheduler = Scheduler(**configuration)
+        schedule = scheduler.build_schedule()
+    except Exception as e:
+        results.put((index, None, None, "{}: {}".format(type(e).__name__, e)))
+        return
+
+    classes = [ c for class_list in schedule.scheduled_classes.values() for c in class_list ]
+    class_tuples = [ (c.course_id, c.room_id, c.teacher_id, c.timeblock_id, c.max_student_count, c.min_student_count)
+                     for c in classes ]
+    class_students = [ [ student.id for student in c.students ] for c in classes ]
+    results.put((index, class_tuples, class_students, "{} solver checks".format(scheduler.check_count)))
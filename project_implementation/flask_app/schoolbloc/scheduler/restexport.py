@@ -1,13 +1,19 @@
 import logging
-from flask import request
+from collections import OrderedDict, namedtuple
+from flask import Response, json, request, stream_with_context
 from flask.ext.restful import Resource, abort
+from sqlalchemy.orm import subqueryload
 from sqlalchemy.orm.exc import NoResultFound
 from schoolbloc import db
 from sqlalchemy.exc import IntegrityError
+import schoolbloc.scheduler.timeblock_cache as timeblock_cache
 
 
 log = logging.getLogger(__name__)
 
+# the rows the list endpoints read and serialize at a time
+STREAM_BATCH_SIZE = 500
+
 
 def _find_constraint_mapping_table(orm, constraint_str):
     """
@@ -62,6 +68,60 @@ def _get_constraint_foreign_name(orm, constraint):
     return foreign_name
 
 
+# A constraint of an orm's __restconstraints__: name is the orm's relationship to the mapping
+# table (mapping_orm), foreign_name the mapping table's relationship to the foreign table and
+# columns the mapping table's own data columns (active, priority, etc)
+RestConstraint = namedtuple('RestConstraint', ['name', 'foreign_name', 'mapping_orm', 'columns'])
+
+
+def get_rest_constraints(orm):
+    """
+    Works out the RestConstraints of an orm, once when it is registered (see
+    register_rest_orm) rather than for each row served
+    """
+    constraints = []
+    for constraint in getattr(orm, '__restconstraints__', []):
+        mapping_orm = orm.__mapper__.relationships.get(constraint).mapper.class_
+        columns = [ column.name for column in mapping_orm.__table__.columns.values()
+                    if not column.foreign_keys and not column.primary_key ]
+        constraints.append(RestConstraint(constraint, _get_constraint_foreign_name(orm, constraint),
+                                          mapping_orm, columns))
+    return constraints
+
+
+def _constraint_loaders(orm, constraints):
+    """
+    Loader options reading the mapping rows of the constraints, and their foreign rows, in
+    a query per constraint for all the rows of a query
+    """
+    return [ subqueryload(getattr(orm, c.name)).joinedload(getattr(c.mapping_orm, c.foreign_name))
+             for c in constraints ]
+
+
+def _serialize_constraints(orm_object, constraints, ret):
+    """ Adds the foreign rows of each constraint, with the mapping's data, to a serialized row """
+    for constraint in constraints:
+        foreign_serialized = []
+        for mapper_orm in getattr(orm_object, constraint.name):
+            # Data from foreign orm
+            foreign_orm = getattr(mapper_orm, constraint.foreign_name)
+            serialized = {
+                'id': foreign_orm.id,
+                'value': str(foreign_orm),
+            }
+
+            # Constraint orm data
+            for column in constraint.columns:
+                serialized[column] = getattr(mapper_orm, column)
+
+            # Special case for timeblocks, we need to pass back the days this
+            # timeblock is associated with as well.
+            if foreign_orm.__tablename__ == 'timeblocks':
+                serialized['days'] = timeblock_cache.days(foreign_orm.id)
+            foreign_serialized.append(serialized)
+        ret[constraint.foreign_name] = foreign_serialized
+
+
 def _get_constraint_key_column_names(base_orm, foreign_orm):
     # Get the column names for the foreign key ids in this constraint
     for column in foreign_orm.__mapper__.columns.values():
@@ -75,6 +135,27 @@ def _get_constraint_key_column_names(base_orm, foreign_orm):
     return this_id_name, foreign_id_name
 
 
+def _get_int_arg(name):
+    """ The value of an optional, non negative integer query arg """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        abort(400, message="{} must be an integer".format(name))
+    if value < 0:
+        abort(400, message="{} must not be negative".format(name))
+    return value
+
+
+def _select_fields(serialized, fields):
+    """ Keeps the requested keys of a serialized row (all of them without fields) """
+    if not fields:
+        return serialized
+    return OrderedDict((key, value) for key, value in serialized.items() if key in fields)
+
+
 def _generate_parser(orm):
     """
     Adds all the columns of this orm to a parser
@@ -124,40 +205,28 @@ def _generate_parser(orm):
 
 
 class TestRest(Resource):
+    # the RestConstraints of orm, set by register_rest_orm
+    constraints = ()
 
     def get(self, orm_id):
         get_constraints = request.args.get('constraints')
-        orm_object = self._get_or_abort(orm_id)
-        ret = orm_object.serialize()
         if not hasattr(self.orm, '__restconstraints__'):
-            return ret
+            return self._get_or_abort(orm_id).serialize()
         if get_constraints and get_constraints.lower() == 'false':
+            orm_object = self._get_or_abort(orm_id)
+            ret = orm_object.serialize()
             # Hackish case for timeblocks call. Insert days if constraints=false
             if orm_object.__tablename__ == 'timeblocks':
-                ret['days'] = [str(tbd.day) for tbd in orm_object.timeblocks_days]
+                ret['days'] = timeblock_cache.days(orm_object.id)
             return ret
-        for constraint in orm_object.__restconstraints__:
-            foreign_name = _get_constraint_foreign_name(self.orm, constraint)
-            foreign_serialized = []
-            for mapper_orm in getattr(orm_object, constraint):
-                # Data from foreign orm
-                foreign_orm = getattr(mapper_orm, foreign_name)
-                serialized = {
-                    'id': foreign_orm.id,
-                    'value': str(foreign_orm),
-                }
-
-                # Constraint orm data
-                for column in mapper_orm.__table__.columns.values():
-                    if not column.foreign_keys and not column.primary_key:
-                        serialized[column.name] = getattr(mapper_orm, column.name)
-
-                # Special case for timeblocks, we need to pass back the days this
-                # timeblock is associated with as well.
-                if foreign_orm.__tablename__ == 'timeblocks':
-                    serialized['days'] = [str(tbd.day) for tbd in foreign_orm.timeblocks_days]
-                foreign_serialized.append(serialized)
-            ret[foreign_name] = foreign_serialized
+        # loads the mapping and foreign rows of every constraint along with the row, a query
+        # per constraint
+        orm_object = self.orm.query.options(*_constraint_loaders(self.orm, self.constraints))\
+                                   .filter(self.orm.id == orm_id).first()
+        if not orm_object:
+            abort(404, message="ID {} not found".format(orm_id))
+        ret = orm_object.serialize()
+        _serialize_constraints(orm_object, self.constraints, ret)
         return ret
 
     def put(self, orm_id):
@@ -276,39 +345,71 @@ class TestRest(Resource):
 
 
 class TestRestList(Resource):
+    # the RestConstraints of orm, set by register_rest_orm
+    constraints = ()
 
     def get(self):
+        """
+        Lists the rows in id order, streaming the JSON list as the rows are read. Takes the
+        optional query args constraints=false, limit and offset, after_id (only the rows
+        after this id, the last of the previous page) and fields (the comma separated keys
+        to return)
+        """
         get_constraints = request.args.get('constraints')
-        ret = []
-        orm_objects = self.orm.query.all()
-        for orm_object in orm_objects:
-            tmp_ret = orm_object.serialize()
-            if not hasattr(self.orm, '__restconstraints__'):
-                ret.append(tmp_ret)
-                continue
-            if get_constraints and get_constraints.lower() == 'false':
-                if orm_object.__tablename__ == 'timeblocks':
-                    tmp_ret['days'] = [str(tbd.day) for tbd in orm_object.timeblocks_days]
-                ret.append(tmp_ret)
-                continue
-            for constraint in orm_object.__restconstraints__:
-                foreign_name = _get_constraint_foreign_name(self.orm, constraint)
-                foreign_serialized = []
-                for mapper_orm in getattr(orm_object, constraint):
-                    foreign_orm = getattr(mapper_orm, foreign_name)
-                    serialized = {
-                        'id': foreign_orm.id,
-                        'value': str(foreign_orm),
-                    }
-                    for column in mapper_orm.__table__.columns.values():
-                        if not column.foreign_keys and not column.primary_key:
-                            serialized[column.name] = getattr(mapper_orm, column.name)
-                    if foreign_orm.__tablename__ == 'timeblocks':
-                        serialized['days'] = [str(tbd.day) for tbd in foreign_orm.timeblocks_days]
-                    foreign_serialized.append(serialized)
-                tmp_ret[foreign_name] = foreign_serialized
-            ret.append(tmp_ret)
-        return ret
+        with_constraints = not (get_constraints and get_constraints.lower() == 'false')
+        limit = _get_int_arg('limit')
+        offset = _get_int_arg('offset')
+        after_id = _get_int_arg('after_id')
+        fields = request.args.get('fields')
+        if fields:
+            fields = set(field.strip() for field in fields.split(','))
+
+        # the constraints listed, loaded along with each batch of rows
+        constraints = None
+        if hasattr(self.orm, '__restconstraints__') and with_constraints:
+            constraints = [ c for c in self.constraints if not fields or c.foreign_name in fields ]
+        query = self.orm.query.order_by(self.orm.id)
+        if constraints:
+            query = query.options(*_constraint_loaders(self.orm, constraints))
+        if after_id is not None:
+            query = query.filter(self.orm.id > after_id)
+        if offset:
+            query = query.offset(offset)
+
+        def generate():
+            yield '['
+            for i, orm_object in enumerate(self._iter_rows(query, limit)):
+                serialized = self._serialize(orm_object, constraints, fields)
+                yield (', ' if i else '') + json.dumps(serialized)
+            yield ']\n'
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+    def _iter_rows(self, query, limit):
+        """ The rows of the query (up to limit), read STREAM_BATCH_SIZE at a time """
+        count = 0
+        last_id = None
+        while limit is None or count < limit:
+            batch_size = STREAM_BATCH_SIZE if limit is None else min(STREAM_BATCH_SIZE, limit - count)
+            batch_query = query
+            if last_id is not None:
+                # the next batch starts after the last row, not at an offset
+                batch_query = query.offset(None).filter(self.orm.id > last_id)
+            batch = batch_query.limit(batch_size).all()
+            for orm_object in batch:
+                yield orm_object
+            count += len(batch)
+            if len(batch) < batch_size:
+                return
+            last_id = batch[-1].id
+
+    def _serialize(self, orm_object, constraints, fields):
+        tmp_ret = orm_object.serialize()
+        if constraints is None:
+            if orm_object.__tablename__ == 'timeblocks':
+                tmp_ret['days'] = timeblock_cache.days(orm_object.id)
+        else:
+            _serialize_constraints(orm_object, constraints, tmp_ret)
+        return _select_fields(tmp_ret, fields)
 
     def post(self):
         parser = _generate_parser(self.orm)
@@ -2,11 +2,13 @@
 from z3 import *
 from schoolbloc.scheduler.models import *
 from schoolbloc.config import config
-from schoolbloc.scheduler.class_constraint import ClassConstraint
+from schoolbloc.scheduler.class_constraint import ClassConstraint, CourseConstraint
 from schoolbloc.scheduler.student_constraint import StudentConstraint
+from schoolbloc.scheduler.constraint_snapshot import ConstraintSnapshot
 #from schoolbloc.scheduler.scheduler import SchedulerNoSolution
 import math
 import time
+from collections import OrderedDict
 import schoolbloc.scheduler.scheduler_util as SchedUtil
 
 # make the class z3 data type and define its constructor
@@ -22,6 +24,14 @@ SchClass.declare('SchClass', ('teacher', IntSort()),
                              ('course', IntSort()))
 
 SchClass = SchClass.create()
+# the SchClass fields in the order of the constructor's arguments
+SCHCLASS_FIELDS = [ SchClass.accessor(0, k).name() for k in range(SchClass.constructor(0).arity()) ]
+
+# a (resource, time) pair, used by the 'distinct' collision encoding. Distinct slots are compared
+# as datatype values, an arithmetic resource * base + time slot left z3 doing integer arithmetic
+Slot = Datatype('Slot')
+Slot.declare('slot', ('resource', IntSort()), ('time', IntSort()))
+Slot = Slot.create()
 
 class ScheduleConstraints:
     """
@@ -68,14 +78,76 @@ class ScheduleConstraints:
 
         return path_list
 
-    def __init__(self):
+    # ways of encoding the room/time and teacher/time collision constraints:
+    # pairwise       - an If(room_i == room_j, time_i != time_j) term for each pair of classes
+    # distinct       - a (room, time) Slot for each class, all constrained with one Distinct
+    # pseudo_boolean - an AtMost(1) cardinality constraint for each (room, time) a class could use
+    COLLISION_ENCODINGS = ('pairwise', 'distinct', 'pseudo_boolean')
+
+    # ways of encoding the teacher, room, time and course of a class:
+    # int    - the IntSort fields of a SchClass constant hold the DB ids
+    # bitvec - a bit-vector per class and attribute holds the index of the DB id in a dense
+    #          domain of the ids the classes can use (see prep_attribute_domains)
+    ATTRIBUTE_ENCODINGS = ('int', 'bitvec')
+    ATTRIBUTES = ('teacher', 'room', 'time', 'course')
+
+    # ways of making sure each student can take all their courses without timeblock collisions:
+    # choice    - a section choice variable per (course list, course) and a Distinct over the
+    #             times of the chosen sections. Grows linearly with the number of sections
+    # enumerate - an Or over every combination of sections (gen_course_path_list). Grows
+    #             exponentially with the number of courses
+    PATH_ENCODINGS = ('choice', 'enumerate')
+
+    # ways of picking the high priority constraints to relax when there is no mapping:
+    # first - the first one that can be relaxed (see ClassConstraint.relax_constraints)
+    # core  - every high priority constraint of a class gets a Bool the solver assumes, and
+    #         the ones in the unsat core are relaxed (see relax_core). Needs the incremental mode
+    # soft  - the same Bools, left for a z3 Optimize objective to weigh (see soft_preferences)
+    RELAXATIONS = ('first', 'core', 'soft')
+
+    # the weight of keeping a preference of the soft relaxation, by the length of its relax key
+    # (see ClassConstraint): the course preferences count for more than the teacher ones, and
+    # those for more than the teacher's classroom ones
+    PREFERENCE_WEIGHTS = { 1: 3, 3: 2, 5: 1 }
+
+    def __init__(self, collision_encoding='pairwise', attribute_encoding='int', path_encoding='choice',
+                 incremental=False, relaxation='first'):
+        """
+        incremental keeps the constraints of one solver up to date instead of rebuilding them
+        all after each relaxation or added class. The constraints that can be replaced are
+        guarded by a Bool the solver is asked to assume (see guard, take_new_constraints and
+        assumptions), so the solver keeps what it learned about the rest.
+        """
+        if collision_encoding not in ScheduleConstraints.COLLISION_ENCODINGS:
+            raise ValueError("Unknown collision encoding: {}".format(collision_encoding))
+        if attribute_encoding not in ScheduleConstraints.ATTRIBUTE_ENCODINGS:
+            raise ValueError("Unknown attribute encoding: {}".format(attribute_encoding))
+        if path_encoding not in ScheduleConstraints.PATH_ENCODINGS:
+            raise ValueError("Unknown path encoding: {}".format(path_encoding))
+        if relaxation not in ScheduleConstraints.RELAXATIONS:
+            raise ValueError("Unknown relaxation: {}".format(relaxation))
+        if relaxation == 'core' and not incremental:
+            raise ValueError("The core relaxation needs the incremental mode")
+
+        self.collision_encoding = collision_encoding
+        self.attribute_encoding = attribute_encoding
+        self.path_encoding = path_encoding
+        self.incremental = incremental
+        self.relaxation = relaxation
         self.class_count = 0
         self.db_constraints = [] # the list of z3 constraints generated from the DB
         self.course_time_constraints = {} # constraints generated from course-time collisions. student_id => constraint list
-        self.course_index_list_cache = []
         self.class_constraints = {}
         self.student_constraints = []
         self.student_requirement_set = [] # list of StudentRequirement objects
+        self.requirement_profiles = OrderedDict() # frozenset of course ids => RequirementProfile
+        self.new_constraints = [] # incremental mode: the constraints not handed to the solver yet
+        self.guards = {} # incremental mode: key of a replaceable constraint set => its current guard
+        self.guard_count = 0
+        self.preferences = {} # core and soft relaxations: (z3 index, relax key) => (ClassConstraint, Bool)
+
+        # every fact and mapping table the constraints need, loaded once for this run
+        self.snapshot = ConstraintSnapshot()
 
         self.prep_class_constraints()
         self.reset_constraints()
@@ -108,11 +180,136 @@ class ScheduleConstraints:
             for class_constraint in class_constraints:
                 if class_constraint.can_relax_constraints():
                     class_constraint.relax_constraints()
+                    if self.incremental:
+                        self.guard_class(class_constraint)
                     return 
 
+    def take_new_constraints(self):
+        """
+        incremental mode: returns the constraints made since the last call, the solver
+        already has the ones before them
+        """
+        constraints, self.new_constraints = self.new_constraints, []
+        return constraints
+
+    def assumptions(self):
+        """
+        incremental mode: the guards the solver has to assume (see guard) and, for the core
+        relaxation, the preferences: kept ones are assumed, relaxed ones are assumed not to be
+        """
+        assumptions = list(self.guards.values())
+        if self.relaxation == 'core':
+            for class_const, key, pref in self.preferences.values():
+                assumptions.append(Not(pref) if key in class_const.relaxed else pref)
+        return assumptions
+
+    def soft_preferences(self):
+        """ soft relaxation: the Bools of the preferences, with their weights (see PREFERENCE_WEIGHTS) """
+        return [ (pref, ScheduleConstraints.PREFERENCE_WEIGHTS[len(key)])
+                 for class_const, key, pref in self.preferences.values() ]
+
+    def relax_core(self, core):
+        """
+        core relaxation: relaxes the preferences in the unsat core of the last check. Returns
+        False if there are none (the constraints can't be satisfied by relaxing them)
+        """
+        core_ids = set(c.get_id() for c in core)
+        relaxed = [ (class_const, key) for class_const, key, pref in self.preferences.values()
+                    if pref.get_id() in core_ids and key not in class_const.relaxed ]
+        if len(relaxed) == 0:
+            return False
+
+        msg = "The unsat core has {} of the {} preferences, relaxing them".format(len(relaxed), len(self.preferences))
+        SchedUtil.log_note("info", "Scheduler", msg)
+        classes = []
+        for class_const, key in relaxed:
+            class_const.relax_preference(key)
+            if class_const not in classes:
+                classes.append(class_const)
+        for class_const in classes:
+            self.guard_class(class_const)
+        return True
+
+    def guard(self, key, constraints):
+        """
+        incremental mode: adds the constraints behind a new guard, replacing the constraints
+        of the previous guard of key (which is no longer assumed, so they stop counting)
+        """
+        self.guard_count += 1
+        guard = Bool("guard_%s" % self.guard_count)
+        self.guards[key] = guard
+        self.new_constraints += [ Implies(guard, And(constraints)) ]
+
+    def guard_class(self, class_const):
+        """ incremental mode: replaces the course constraints of the class, after it was relaxed """
+        self.guard(('class', class_const.z3_index), self.class_course_constraints(class_const))
+        if self.collision_encoding == 'pseudo_boolean':
+            # the candidate (resource, time) pairs depend on what the classes can use
+            self.guard(('collisions',), self.prevent_room_time_collision() + self.prevent_teacher_time_collision())
+
+    def exclude_class_times(self, model):
+        """
+        Rules out the class times of the model. Placing the students only depends on the courses
+        and times of the classes, so every mapping with the same times fails just like this one
+        did. They are ruled out until a class is added (or, without the incremental mode, until
+        the constraints are reset).
+        """
+        times = [ model.evaluate(self.time(i), model_completion=True) for i in range(self.class_count) ]
+        exclusion = Or([ self.time(i) != times[i] for i in range(self.class_count) ])
+        if not self.incremental:
+            self.db_constraints.append(exclusion)
+            return
+
+        if ('mappings',) not in self.guards:
+            self.guard(('mappings',), [])
+        self.new_constraints += [ Implies(self.guards[('mappings',)], exclusion) ]
+
 
     def prep_z3_classes(self):
-        self.z3_classes = [Const("class_%s" % (i + 1), SchClass) for i in range(self.class_count)] 
+        if self.attribute_encoding == 'bitvec':
+            self.prep_attribute_domains()
+            self.z3_attributes = dict((attr, []) for attr in ScheduleConstraints.ATTRIBUTES)
+        else:
+            self.z3_classes = []
+        for i in range(self.class_count):
+            self.prep_z3_class(i)
+
+    def prep_z3_class(self, i):
+        """ makes the z3 variables of class i """
+        if self.attribute_encoding == 'bitvec':
+            for attr in ScheduleConstraints.ATTRIBUTES:
+                self.z3_attributes[attr].append(BitVec("class_%s_%s" % (i + 1, attr), self.domain_widths[attr]))
+        else:
+            self.z3_classes.append(Const("class_%s" % (i + 1), SchClass))
+
+    def prep_attribute_domains(self):
+        """
+        Builds the translation tables of the bitvec attribute encoding. The domain of an attribute
+        is the sorted list of DB ids any class can currently use, and a class attribute holds an
+        index into it. Ids only named by the deeper (teacher and classroom) constraints are left
+        out, set_courses already keeps the classes from using them. With the core and soft
+        relaxations they hold the ids a class gets by letting go of its preferences (see
+        usable_ids). The incremental mode never rebuilds the domains, so they also hold the ids
+        the classes can use once relaxed.
+        """
+        ids = dict((attr, set()) for attr in ScheduleConstraints.ATTRIBUTES)
+        for course_id, class_const_list in self.class_constraints.items():
+            ids['course'].add(course_id)
+            for class_const in class_const_list:
+                ids['teacher'].update(self.usable_ids(class_const, ('teacher',), class_const.get_teacher_ids))
+                ids['room'].update(self.usable_ids(class_const, ('classroom',), class_const.get_classroom_ids))
+                ids['time'].update(self.usable_ids(class_const, ('timeblock',), class_const.get_timeblock_ids))
+            if self.incremental:
+                course = class_const_list[0].course_constraint
+                ids['teacher'].update(t.teacher_id for t in course.high_teacher_constraints + course.low_teacher_constraints)
+                ids['room'].update(c.classroom_id for c in course.high_classroom_constraints + course.low_classroom_constraints)
+                ids['time'].update(course.high_timeblock_ids | course.low_timeblock_ids)
+
+        self.domains = dict((attr, sorted(attr_ids)) for attr, attr_ids in ids.items())
+        self.domain_indexes = dict((attr, dict((db_id, index) for index, db_id in enumerate(domain)))
+                                   for attr, domain in self.domains.items())
+        self.domain_widths = dict((attr, max(1, (len(domain) - 1).bit_length()))
+                                  for attr, domain in self.domains.items())
 
     def prep_implied_constraints(self):
         self.db_constraints += self.set_courses()
@@ -123,6 +320,53 @@ class ScheduleConstraints:
         self.db_constraints += self.prevent_teacher_time_collision()
         self.db_constraints += self.ensure_course_timeblock_paths()
 
+    def prep_guarded_constraints(self):
+        """
+        incremental mode: makes the same constraints as prep_implied_constraints, guarding the ones
+        that are replaced when a class is relaxed or added. Pairwise collisions are never replaced,
+        an added class only adds its own pairs
+        """
+        self.new_constraints = []
+        self.guards = {}
+        self.number_classes()
+        for course_id, class_const_list in self.class_constraints.items():
+            for class_const in class_const_list:
+                self.guard(('class', class_const.z3_index), self.class_course_constraints(class_const))
+
+        self.check_fact_utilization()
+        if self.collision_encoding == 'pairwise':
+            self.new_constraints += self.prevent_room_time_collision() + self.prevent_teacher_time_collision()
+        else:
+            self.guard(('collisions',), self.prevent_room_time_collision() + self.prevent_teacher_time_collision())
+
+        for profile_id, profile in enumerate(self.requirement_profiles.values()):
+            self.guard(('profile', profile_id), self.add_timeblock_constraints_for_profile(profile, profile_id))
+
+    def append_class(self, class_const):
+        """
+        incremental mode: gives an added class the next z3 index and makes the constraints that
+        involve it: its course constraints, its collisions with the other classes and the course
+        paths of the profiles needing its course
+        """
+        i = self.class_count - 1
+        class_const.z3_index = i
+        self.prep_z3_class(i)
+        self.guard(('class', i), self.class_course_constraints(class_const))
+
+        self.check_fact_utilization()
+        if self.collision_encoding == 'pairwise':
+            self.new_constraints += self.pairwise_collision_constraints('room', first=i) + \
+                                    self.pairwise_collision_constraints('teacher', first=i)
+        else:
+            self.guard(('collisions',), self.prevent_room_time_collision() + self.prevent_teacher_time_collision())
+
+        for profile_id, profile in enumerate(self.requirement_profiles.values()):
+            if class_const.course_id in profile.course_ids:
+                self.guard(('profile', profile_id), self.add_timeblock_constraints_for_profile(profile, profile_id))
+
+        # the ruled out mappings didn't have this class
+        self.guards.pop(('mappings',), None)
+
     #def prep_db_constraints(self):
     #    self.db_constraints += self.constrain_room_time()
     #    self.db_constraints += self.constrain_teacher_time()
@@ -137,8 +381,12 @@ class ScheduleConstraints:
         """
         start_time = time.time()
         self.db_constraints = []
+        self.preferences = {}
         self.prep_z3_classes()
-        self.prep_implied_constraints()
+        if self.incremental:
+            self.prep_guarded_constraints()
+        else:
+            self.prep_implied_constraints()
         #self.prep_db_constraints()
         # print("reset constraints ( {} min )".format(round((time.time() - start_time)/60)))
 
@@ -148,26 +396,27 @@ class ScheduleConstraints:
         """
         self.class_constraints = {}
         self.class_count = 0
-        timeblock_count = Timeblock.query.count()
+        snapshot = self.snapshot
+        timeblock_count = len(snapshot.timeblock_ids)
 
-        for student in Student.query.all():
+        for student_id in snapshot.student_ids:
             # make a list of the required course ids for the student
-            student_constraint = StudentConstraint(student.id)
+            student_constraint = StudentConstraint(student_id, snapshot)
 
             req_courses = student_constraint.get_course_ids(timeblock_count)
-            student_reqs = StudentRequirements(student.id, req_courses, [])
+            student_reqs = StudentRequirements(student_id, req_courses, [])
             self.student_requirement_set.append(student_reqs)
+            self.add_to_requirement_profile(student_reqs)
 
             # detect if the student is over scheduled
-            ScheduleConstraints.check_if_student_is_overscheduled(student, req_courses)
+            ScheduleConstraints.check_if_student_is_overscheduled(student_id, req_courses, timeblock_count)
             # now go through the list and create courses when needed
             for course_id in req_courses:
-                # max_stud_count = int(ScheduleConstraints.max_student_count(course_id) * .9)
-                max_stud_count = int(ScheduleConstraints.max_student_count(course_id))
-                course = Course.query.get(course_id)
+                # max_stud_count = int(snapshot.max_student_count(course_id) * .9)
+                max_stud_count = int(snapshot.max_student_count(course_id))
 
                 if course_id not in self.class_constraints:
-                    new_class = ClassConstraint(course_id, course.name)
+                    new_class = ClassConstraint(CourseConstraint.cached(course_id, snapshot))
                     self.class_constraints[course_id] = [new_class]
                     self.class_count += 1
                 
@@ -175,20 +424,26 @@ class ScheduleConstraints:
                     self.class_constraints[course_id][0].student_count += 1
                 
                 else:
-                    new_class = ClassConstraint(course_id, course.name)
+                    new_class = ClassConstraint(CourseConstraint.cached(course_id, snapshot))
                     self.class_constraints[course_id].insert(0, new_class)
                     self.class_count += 1
 
+    def add_to_requirement_profile(self, student_reqs):
+        """ Adds the student to the RequirementProfile of their set of required courses """
+        key = frozenset(student_reqs.required_course_ids)
+        if key not in self.requirement_profiles:
+            self.requirement_profiles[key] = RequirementProfile(student_reqs.required_course_ids)
+        self.requirement_profiles[key].student_requirements.append(student_reqs)
+
     @staticmethod
-    def check_if_student_is_overscheduled(student, required_courses):
-        timeblock_count = Timeblock.query.count()
+    def check_if_student_is_overscheduled(student_id, required_courses, timeblock_count):
         if len(required_courses) > timeblock_count:
             msg = "Student {} course requirements ({}) are greater than the available number of timeblocks ({})".format(
-                student.id, len(required_courses), timeblock_count)
+                student_id, len(required_courses), timeblock_count)
             SchedUtil.log_note("error", "Scheduler", msg)
             raise SchedulerNoSolution(msg)
         elif len(required_courses) < timeblock_count:
-            msg = "Student {} course requirements are less than the number of timeblocks".format(student.id)
+            msg = "Student {} course requirements are less than the number of timeblocks".format(student_id)
             SchedUtil.log_note("warning", "Scheduler", msg)
             
     def gen_constraints_from_collisions(self, collisions):
@@ -226,10 +481,12 @@ class ScheduleConstraints:
         :param collisions: A list of collision objects generated from the last attempt at scheduling
         :return: None (use self.get_constraints() to see the results of this action)
         """
-        # find the most popular course among the collisions
+        # find the most popular course among the collisions, full classes only count when
+        # they're all there is (the flow placement reports courses without enough seats so)
+        only_full = all(col.collision_type == 'full class' for col in collisions)
         course_collision_list = {}
         for col in collisions:
-            if col.collision_type == 'full class':
+            if col.collision_type == 'full class' and not only_full:
                 continue
             course_id = col.scheduled_class.course_id
             if course_id not in course_collision_list:
@@ -245,14 +502,16 @@ class ScheduleConstraints:
 
         # now add a class for that collisions course
         course_id = best_collision.scheduled_class.course_id
-        course = Course.query.get(course_id)
-        new_class = ClassConstraint(course_id, course.name)
+        new_class = ClassConstraint(CourseConstraint.cached(course_id, self.snapshot))
         self.class_constraints[course_id].append(new_class)
         self.class_count += 1
 
-        msg = "Added another class for the course: {} {}".format(course.id, course.name)
+        msg = "Added another class for the course: {} {}".format(course_id, new_class.course_name)
         SchedUtil.log_note("info", "Scheduler", msg)
-        self.reset_constraints()
+        if self.incremental:
+            self.append_class(new_class)
+        else:
+            self.reset_constraints()
 
 
     # def add_class_for_course(self, course_id):
@@ -265,31 +524,29 @@ class ScheduleConstraints:
     #     self.class_count += 1
     #     print('\033[91m Added ClassConstraint: {}\033[0m'.format(class_const))
 
-    def add_timeblock_constraints_for_student(self, student_reqs):
+    def add_timeblock_constraints_for_profile(self, profile, profile_id):
         """
-        Go through the courses required by the student and add a constraint that
+        Go through the courses required by the students of the profile and add a constraint that
         prevents timeblock collisions for any of the required courses
 
-        :type student_reqs: StudentRequirements
-        :param student_reqs: The set of student requirements for a single student
+        :type profile: RequirementProfile
+        :param profile: The students requiring the same set of courses
+        :param profile_id: a number identifying the profile, used to name z3 variables
         :rtype: List
         :return: A list of z3 constraints
 
         """
+        if len(profile.required_course_ids) == 0:
+            return []
 
         # build a 2 dimensional array representing the z3 indices of the
         # required courses for the student. where the members if each each inner list 
         # represent the same course
         course_indexes = [[ c.z3_index for c in self.class_constraints[course_id] ]
-                          for course_id in student_reqs.required_course_ids]
-
-        # cache the course_indexes so we can skip this step when we see duplicates
-        for ci in self.course_index_list_cache:
-            if course_indexes == ci:
-                # print("found duplicate course index list, sikipping student {}".format(student_reqs.student_id))
-                return []
+                          for course_id in profile.required_course_ids]
 
-        self.course_index_list_cache.append(course_indexes)
+        if self.path_encoding == 'choice':
+            return self.section_choice_constraints(course_indexes, profile_id)
 
         # print('\033[93m course z3 index set:\n {}\033[0m'.format(course_indexes))
 
@@ -314,6 +571,35 @@ class ScheduleConstraints:
         #     self.course_time_constraints[student_reqs.id] = []
         # self.course_time_constraints[student_reqs.id] += [Or(or_list)]
 
+    def section_choice_constraints(self, course_indexes, list_id):
+        """
+        Returns the constraints that ensure the student can take one class (section) of each
+        course without timeblock conflicts. Each course with more than one class gets a choice
+        variable, and the time of the chosen class is picked out with a chain of Ifs (any value
+        past the last index picks the last class). The chosen times must be distinct.
+
+        :param course_indexes: a list of lists of the z3 indexes of the classes of each course
+        :param list_id: a number identifying the course index list, used to name the variables
+        """
+        chosen_times = []
+        for n, class_indexes in enumerate(course_indexes):
+            chosen_time = self.time(class_indexes[-1])
+            if len(class_indexes) > 1:
+                choice = self.section_choice("choice_%s_%s" % (list_id, n), len(class_indexes))
+                for k in reversed(range(len(class_indexes) - 1)):
+                    chosen_time = If(choice == k, self.time(class_indexes[k]), chosen_time)
+            chosen_times.append(chosen_time)
+
+        if len(chosen_times) < 2:
+            return []
+        return [ Distinct(chosen_times) ]
+
+    def section_choice(self, name, class_count):
+        """ returns a z3 variable for choosing one of class_count classes, matching the attribute encoding """
+        if self.attribute_encoding == 'bitvec':
+            return BitVec(name, max(1, (class_count - 1).bit_length()))
+        return Int(name)
+
     def ensure_course_timeblock_paths(self):
         """
         Returns a list of z3 constraints that ensure there is an available
@@ -321,10 +607,9 @@ class ScheduleConstraints:
         configuration where none of them have Timeblock conflicts)
         """
         const_list = []
-        self.course_index_list_cache = []
-        for student_reqs in self.student_requirement_set:
-            # print("adding timeblock_course z3 constraint for student {}".format(student_reqs.student_id))
-            const_list += self.add_timeblock_constraints_for_student(student_reqs)
+        # students with the same required courses share a profile, and a single constraint
+        for profile_id, profile in enumerate(self.requirement_profiles.values()):
+            const_list += self.add_timeblock_constraints_for_profile(profile, profile_id)
 
         return const_list
 
@@ -338,9 +623,10 @@ class ScheduleConstraints:
 
         for course_id, class_list in self.class_constraints.items():
             # make sure theres enough teachers for the number of courses
-            teacher_ids = class_list[0].get_teacher_ids()
-            timeblock_ids = class_list[0].get_timeblock_ids()
-            classroom_ids = class_list[0].get_classroom_ids()
+            class_const = class_list[0]
+            teacher_ids = self.usable_ids(class_const, ('teacher',), class_const.get_teacher_ids)
+            timeblock_ids = self.usable_ids(class_const, ('timeblock',), class_const.get_timeblock_ids)
+            classroom_ids = self.usable_ids(class_const, ('classroom',), class_const.get_classroom_ids)
 
             timeblock_count = len(timeblock_ids)
             teacher_count = len(teacher_ids)
@@ -427,16 +713,66 @@ class ScheduleConstraints:
     # We setup some shortcuts to the accessors in the class constructor above just to make
     # coding easier and more readable
     def teacher(self, i):
-        return SchClass.teacher(self.z3_classes[i])
+        return self.attribute('teacher', i)
 
     def room(self, i):
-        return SchClass.room(self.z3_classes[i])
+        return self.attribute('room', i)
 
     def course(self, i):
-        return SchClass.course(self.z3_classes[i])
+        return self.attribute('course', i)
 
     def time(self, i):
-        return SchClass.time(self.z3_classes[i])
+        return self.attribute('time', i)
+
+    def attribute(self, attr, i):
+        """ returns the z3 expression holding the given attribute (teacher, room, time or course) of class i """
+        if self.attribute_encoding == 'bitvec':
+            return self.z3_attributes[attr][i]
+        return getattr(SchClass, attr)(self.z3_classes[i])
+
+    def attribute_is(self, attr, i, db_id):
+        """ returns a z3 constraint that is true when the attribute of class i is the given DB id """
+        if self.attribute_encoding == 'bitvec':
+            index = self.domain_indexes[attr].get(db_id)
+            if index is None:
+                # not in the domain, so no class can use this id
+                return BoolVal(False)
+            return self.z3_attributes[attr][i] == index
+        return self.attribute(attr, i) == db_id
+
+    def class_attributes(self, model):
+        """
+        Reads the attributes of every class from the model in one pass. Returns a dict of
+        attribute => the DB ids of the classes, by z3 index
+        """
+        values = {}
+        if self.attribute_encoding == 'bitvec':
+            for attr in ScheduleConstraints.ATTRIBUTES:
+                domain = self.domains[attr]
+                values[attr] = [ domain[self.model_value(model, var).as_long()] for var in self.z3_attributes[attr] ]
+            return values
+
+        for attr in SCHCLASS_FIELDS:
+            values[attr] = []
+        for z3_class in self.z3_classes:
+            # a SchClass(teacher, room, time, course) value
+            class_value = self.model_value(model, z3_class)
+            for k, attr in enumerate(SCHCLASS_FIELDS):
+                values[attr].append(class_value.arg(k).as_long())
+        return values
+
+    def model_value(self, model, const):
+        """ the value of the constant in the model (without going through evaluate when it has one) """
+        value = model[const]
+        if value is None:
+            value = model.evaluate(const, model_completion=True)
+        return value
+
+    def db_id(self, attr, value):
+        """ translates the model value of an attribute (see attribute) back to its DB id """
+        if self.attribute_encoding == 'bitvec':
+            return self.domains[attr][value.as_long()]
+        return value.as_long()
 
     def set_courses(self):
         """
@@ -444,51 +780,169 @@ class ScheduleConstraints:
         courses we need as determined by calc_class_constraints (stored in self.class_constraints)
         """
         cons_list = []
+        self.number_classes()
+        for course_id, class_const_list in self.class_constraints.items():
+            for class_const in class_const_list:
+                cons_list += self.class_course_constraints(class_const)
+
+        return cons_list
+
+    def number_classes(self):
+        """ gives every class its z3 index """
         i = 0
-        # loop through set courses and add constraints for each course
-        # we'll first set the first level of constraints, then set 'If' conditions for the deeper levels
         for course_id, class_const_list in self.class_constraints.items():
             for class_const in class_const_list:
                 class_const.z3_index = i
-                cons_list += [ And(self.course(i) == course_id,
-                                   Or([ self.teacher(i) == t_id for t_id in class_const.get_teacher_ids() ]),
-                                   Or([ self.room(i) == r_id for r_id in class_const.get_classroom_ids() ]),
-                                   Or([ self.time(i) == t_id for t_id in class_const.get_timeblock_ids() ])) ]
-                
-                # set the constraints from teacher to course, room, and time. 
-                # This constraint reads: If the course is this one and the teacher is this one, then 
-                # the rooms and times must be within the set of available rooms and times
-                for teacher_constraint in class_const.get_teacher_constraints():
-                    cons_list += [ If(And(self.course(i) == course_id, self.teacher(i) == teacher_constraint.teacher_id),
-                                      And(Or([ self.room(i) == r_id for r_id in teacher_constraint.get_classroom_ids()]),
-                                          Or([ self.time(i) == t_id for t_id in teacher_constraint.get_timeblock_ids()])),
-                                      True) ]
-
-                    # now do the same for rooms and times
-                    for classroom_constraint in teacher_constraint.get_classroom_constraints():
-                        cons_list += [ If(And(self.course(i) == course_id, 
-                                              self.teacher(i) == teacher_constraint.teacher_id,
-                                              self.room(i) == classroom_constraint.classroom_id),
-                                          Or([ self.time(i) == t_id for t_id in classroom_constraint.get_timeblock_ids() ]),
-                                          True) ] 
                 i += 1
 
+    def class_course_constraints(self, class_const):
+        """
+        Returns the z3 constraints of a single class (see set_courses)
+        """
+        i = class_const.z3_index
+        course_id = class_const.course_id
+        # we'll first set the first level of constraints, then set 'If' conditions for the deeper levels
+        cons_list = [ And(self.attribute_is('course', i, course_id),
+                          self.preferred('teacher', class_const, ('teacher',), class_const.get_teacher_ids),
+                          self.preferred('room', class_const, ('classroom',), class_const.get_classroom_ids),
+                          self.preferred('time', class_const, ('timeblock',), class_const.get_timeblock_ids)) ]
+        
+        # set the constraints from teacher to course, room, and time. 
+        # This constraint reads: If the course is this one and the teacher is this one, then 
+        # the rooms and times must be within the set of available rooms and times
+        for teacher_constraint in self.preferred_items(class_const, ('teacher',), class_const.get_teacher_constraints):
+            tc = teacher_constraint
+            cons_list += [ If(And(self.attribute_is('course', i, course_id),
+                                  self.attribute_is('teacher', i, tc.teacher_id)),
+                              And(self.preferred('room', class_const, tc.relax_key('classroom'),
+                                                 lambda relaxed: class_const.get_teacher_classroom_ids(tc, relaxed)),
+                                  self.preferred('time', class_const, tc.relax_key('timeblock'),
+                                                 lambda relaxed: class_const.get_teacher_timeblock_ids(tc, relaxed))),
+                              True) ]
+
+            # now do the same for rooms and times
+            for classroom_constraint in self.preferred_items(class_const, tc.relax_key('classroom'),
+                    lambda relaxed: class_const.get_teacher_classroom_constraints(tc, relaxed)):
+                cc = classroom_constraint
+                cons_list += [ If(And(self.attribute_is('course', i, course_id), 
+                                      self.attribute_is('teacher', i, tc.teacher_id),
+                                      self.attribute_is('room', i, cc.classroom_id)),
+                                  self.preferred('time', class_const, cc.relax_key(tc.relax_key()),
+                                                 lambda relaxed: class_const.get_teacher_classroom_timeblock_ids(tc, cc, relaxed)),
+                                  True) ] 
+
         return cons_list
 
+    def preferred(self, attr, class_const, key, ids_for):
+        """
+        Returns a z3 constraint that the attribute of the class is one of ids_for(relaxed), where
+        key is the relax key the ids depend on. With the core and soft relaxations a preference the
+        class keeps gets a Bool (see assumptions and soft_preferences): the class uses the high
+        priority ids while it is true and the low priority ones otherwise
+        """
+        i = class_const.z3_index
+        ids = ids_for(class_const.relaxed)
+        constraint = Or([ self.attribute_is(attr, i, db_id) for db_id in ids ])
+        if self.relaxation == 'first' or key in class_const.relaxed:
+            return constraint
+
+        relaxed_ids = ids_for(class_const.relaxed | set([key]))
+        if set(relaxed_ids) == set(ids):
+            # nothing to relax, a mandatory constraint or no high priority one
+            return constraint
+        return If(self.preference(class_const, key),
+                  constraint,
+                  Or([ self.attribute_is(attr, i, db_id) for db_id in relaxed_ids ]))
+
+    def usable_ids(self, class_const, key, ids_for):
+        """
+        The ids ids_for(relaxed) gives the class. With the core and soft relaxations, they also
+        include the ones the class would get by relaxing key (see preferred)
+        """
+        ids = set(ids_for(class_const.relaxed))
+        if self.relaxation != 'first' and key not in class_const.relaxed:
+            ids.update(ids_for(class_const.relaxed | set([key])))
+        return ids
+
+    def preferred_items(self, class_const, key, items_for):
+        """
+        Returns the constraint objects of items_for(relaxed). With the core and soft relaxations, they also
+        include the ones the class would get by relaxing key (see preferred)
+        """
+        items = list(items_for(class_const.relaxed))
+        if self.relaxation != 'first' and key not in class_const.relaxed:
+            items += [ item for item in items_for(class_const.relaxed | set([key])) if item not in items ]
+        return items
+
+    def preference(self, class_const, key):
+        """ core and soft relaxations: returns the Bool of the preference of the class named by the relax key """
+        if (class_const.z3_index, key) not in self.preferences:
+            pref = Bool("pref_%s_%s" % (class_const.z3_index, "_".join(str(k) for k in key)))
+            self.preferences[(class_const.z3_index, key)] = (class_const, key, pref)
+        return self.preferences[(class_const.z3_index, key)][2]
+
 
     def prevent_room_time_collision(self):
         """ returns a list of z3 constraints that prevent a room from being assigned to two 
-            classes that occur at the same time. Ignores rooms with id == 0 """
-        return [ If(And(i != j, self.room(i) == self.room(j)),
-                     self.time(i) != self.time(j), True)
-                  for i in range(self.class_count) for j in range(self.class_count) ]
+            classes that occur at the same time, using the configured collision encoding """
+        if self.collision_encoding == 'distinct':
+            return self.distinct_slot_constraints('room')
+        elif self.collision_encoding == 'pseudo_boolean':
+            return self.at_most_one_constraints('room', ('classroom',), lambda c: c.get_classroom_ids)
+        else:
+            return self.pairwise_collision_constraints('room')
 
     def prevent_teacher_time_collision(self):
         """ returns a list of z3 constraints that prevent a teacher from being assigned to two 
-            classes that occur at the same time. Ignores teachers with id == 0 """
-        return [ If(And(i != j, self.teacher(i) == self.teacher(j)),
-                    self.time(i) != self.time(j), True)
-                  for i in range(self.class_count) for j in range(self.class_count) ]
+            classes that occur at the same time, using the configured collision encoding """
+        if self.collision_encoding == 'distinct':
+            return self.distinct_slot_constraints('teacher')
+        elif self.collision_encoding == 'pseudo_boolean':
+            return self.at_most_one_constraints('teacher', ('teacher',), lambda c: c.get_teacher_ids)
+        else:
+            return self.pairwise_collision_constraints('teacher')
+
+    def pairwise_collision_constraints(self, attr, first=0):
+        """
+        an If term for every pair of classes: if they share the resource, their times differ.
+        Only the pairs with a class from index first on are made
+        """
+        return [ If(self.attribute(attr, i) == self.attribute(attr, j), self.time(i) != self.time(j), True)
+                  for i in range(self.class_count) for j in range(max(i + 1, first), self.class_count) ]
+
+    def distinct_slot_constraints(self, attr):
+        """
+        Maps each class to the Slot (resource id, time id) and requires the slots to be distinct.
+        Two classes share a slot only when they use the same resource at the same time. With the
+        bitvec attribute encoding the slot is the concatenation of the two bit-vectors
+        """
+        if self.class_count < 2:
+            return []
+
+        if self.attribute_encoding == 'bitvec':
+            return [ Distinct([ Concat(self.attribute(attr, i), self.time(i)) for i in range(self.class_count) ]) ]
+        return [ Distinct([ Slot.slot(self.attribute(attr, i), self.time(i)) for i in range(self.class_count) ]) ]
+
+    def at_most_one_constraints(self, attr, key, resource_ids):
+        """
+        Returns an AtMost(1) constraint for every (resource, time) pair that more than one class
+        could be assigned to. resource_ids returns the getter of the resource ids of a
+        ClassConstraint, key is the relax key they depend on (see usable_ids)
+        """
+        candidates = {} # (resource_id, timeblock_id) => list of z3 indexes
+        for course_id, class_const_list in self.class_constraints.items():
+            for class_const in class_const_list:
+                timeblock_ids = self.usable_ids(class_const, ('timeblock',), class_const.get_timeblock_ids)
+                for r_id in self.usable_ids(class_const, key, resource_ids(class_const)):
+                    for t_id in timeblock_ids:
+                        candidates.setdefault((r_id, t_id), []).append(class_const.z3_index)
+
+        cons_list = []
+        for (r_id, t_id), indexes in sorted(candidates.items()):
+            if len(indexes) > 1:
+                cons_list += [ AtMost(*([ And(self.attribute_is(attr, i, r_id), self.attribute_is('time', i, t_id))
+                                          for i in indexes ] + [1])) ]
+        return cons_list
 
 
 class ConstraintConflictException(Exception):
@@ -502,6 +956,23 @@ class StudentRequirements:
         self.optional_course_ids = optional_course_ids
 
 
+class RequirementProfile:
+    def __init__(self, required_course_ids):
+        """
+        The students that require the same set of courses. The course path constraints are made
+        once per profile, so a grade of students with identical requirements costs the same
+        as one student.
+        :param required_course_ids: the required courses, in the order of the first student of the profile
+        """
+        self.course_ids = frozenset(required_course_ids)
+        self.required_course_ids = list(required_course_ids)
+        self.student_requirements = [] # the StudentRequirements of each student in the profile
+
+    @property
+    def student_count(self):
+        return len(self.student_requirements)
+
+
 
 
 
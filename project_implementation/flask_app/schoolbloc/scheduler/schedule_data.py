@@ -1,17 +1,38 @@
-from schoolbloc.scheduler.models import Timeblock, ScheduledClass, Schedule, ScheduledClassesStudent, Day
+from schoolbloc.scheduler.models import ScheduledClass, Schedule, ScheduledClassesStudent
 from schoolbloc import db
+import schoolbloc.scheduler.scheduler_util as SchedUtil
+import schoolbloc.scheduler.timeblock_cache as timeblock_cache
+import schoolbloc.scheduler.schedule_views as schedule_views
 from datetime import datetime
+import time
 
 class ScheduleData:
-    def __init__(self, class_list):
+    def __init__(self, class_list, timeblock_ids=None):
+        """
+        :param class_list: the ScheduleClasses of a mapping
+        :param timeblock_ids: the timeblocks, when they aren't to be loaded from the DB (a
+                              schedule built so can place students but not be saved)
+        """
         self.scheduled_classes = {}
         self.errors = []
-
-        self.timeblocks = {}
-        for timeblock in Timeblock.query.all():
-            self.timeblocks[timeblock.id] = timeblock
+        # the number of times a student was put in a class, by any placement
+        self.placement_count = 0
+
+        # timeblock id => the timeblock's bit in ScheduleStudent.occupied
+        self.timeblock_bits = {}
+        if timeblock_ids is None:
+            # the TimeblockInfos of timeblock_cache, shared with every other schedule
+            self.timeblocks = timeblock_cache.timeblocks()
+            for timeblock_id, info in self.timeblocks.items():
+                self.timeblock_bits[timeblock_id] = info.bit
+        else:
+            self.timeblocks = {}
+            for i, timeblock_id in enumerate(timeblock_ids):
+                self.timeblocks[timeblock_id] = None
+                self.timeblock_bits[timeblock_id] = 1 << i
 
         for cls in class_list:
+            cls.timeblock_bit = self.timeblock_bits[cls.timeblock_id]
             if cls.course_id not in self.scheduled_classes:
                 self.scheduled_classes[cls.course_id] = []
             self.scheduled_classes[cls.course_id].append(cls)
@@ -26,47 +47,76 @@ class ScheduleData:
 
         return rep
 
-    def save(self):
+    def save(self, bulk=True):
+        """
+        Saves the classes and their students as a new Schedule and returns its id
+
+        :param bulk: insert the rows with executemany, reading the class ids back in one query,
+                     instead of flushing a ScheduledClass at a time to get its id
+        """
+        start_time = time.time()
         db_schedule = Schedule(name="Sample Schedule", created_at=datetime.now())
         db.session.add(db_schedule)
         db.session.flush()
-        
+        if bulk:
+            class_count, student_count = self.bulk_save(db_schedule)
+        else:
+            class_count, student_count = self.save_each(db_schedule)
+        # the views the api serves of the schedule, read from the rows just written
+        schedule_views.store(db_schedule)
+        db.session.commit()
+        msg = "Saved {} classes and {} class students in {:.2f}s".format(
+            class_count, student_count, time.time() - start_time)
+        SchedUtil.log_note("info", "Scheduler", msg)
+        return db_schedule.id
+
+    def bulk_save(self, db_schedule):
+        classes = [ c for cls_list in self.scheduled_classes.values() for c in cls_list ]
+        class_rows = []
+        for c in classes:
+            timeblock = self.timeblocks[c.timeblock_id]
+            class_rows.append({ 'schedule_id': db_schedule.id, 'teacher_id': c.teacher_id,
+                                'course_id': c.course_id, 'classroom_id': c.room_id,
+                                'start_time': timeblock.start_time, 'end_time': timeblock.end_time,
+                                'days': timeblock.days_string })
+        db.session.bulk_insert_mappings(ScheduledClass, class_rows)
+
+        # the ids the DB gave the classes of the new schedule, they increase in the order the
+        # rows were inserted
+        class_ids = [ c_id for (c_id,) in db.session.query(ScheduledClass.id)
+                                                    .filter_by(schedule_id=db_schedule.id)
+                                                    .order_by(ScheduledClass.id) ]
+        student_rows = []
+        for c, class_id in zip(classes, class_ids):
+            for stud in c.students:
+                student_rows.append({ 'student_id': stud.id, 'scheduled_class_id': class_id })
+        db.session.bulk_insert_mappings(ScheduledClassesStudent, student_rows)
+        return len(class_rows), len(student_rows)
+
+    def save_each(self, db_schedule):
+        class_count = 0
+        student_count = 0
 
         for course_id, cls_list in self.scheduled_classes.items():
             for c in cls_list:
-                start_time = self.timeblocks[c.timeblock_id].start_time
-                end_time = self.timeblocks[c.timeblock_id].end_time
-                days = []
-                for td in self.timeblocks[c.timeblock_id].timeblocks_days:
-                    days.append(Day.query.get(td.day_id).name)
-                
-                sorted_days = []
-                if "Monday" in days:
-                    sorted_days.append("Monday")
-                if "Tuesday" in days:
-                    sorted_days.append("Tuesday")
-                if "Wednesday" in days:
-                    sorted_days.append("Wednesday")
-                if "Thursday" in days:
-                    sorted_days.append("Thursday")
-                if "Friday" in days:
-                    sorted_days.append("Friday")
-                if "Saturday" in days:
-                    sorted_days.append("Saturday")
-
-                days_string = ", ".join(sorted_days)
+                timeblock = self.timeblocks[c.timeblock_id]
+                start_time = timeblock.start_time
+                end_time = timeblock.end_time
+                days_string = timeblock.days_string
 
                 cls = ScheduledClass(schedule_id=db_schedule.id, teacher_id=c.teacher_id, course_id=c.course_id, 
                                      classroom_id=c.room_id, start_time=start_time, end_time=end_time, days=days_string)
                 db.session.add(cls)
                 db.session.flush()
+                class_count += 1
 
                 # now add the students
                 for stud in c.students:
                     cs = ScheduledClassesStudent(student_id=stud.id, scheduled_class_id=cls.id)
                     db.session.add(cs)
+                    student_count += 1
 
-        db.session.commit()
+        return class_count, student_count
 
 
     # def schedule_student_required_classes(self, student):
@@ -88,7 +138,7 @@ class ScheduleData:
     #     return True
 
     def schedule_student(self, student_id, required_course_ids, optional_course_ids):
-        student = ScheduleStudent(student_id, required_course_ids, optional_course_ids, self.timeblocks)        
+        student = ScheduleStudent(student_id, required_course_ids, optional_course_ids)
         collisions = self.schedule_student_to_courses(student, 0)
         return collisions
 
@@ -120,6 +170,7 @@ class ScheduleData:
                 collisions.append(collision)
                 # add the collision to the list, then try the next class
             else:
+                self.placement_count += 1
                 col_list = self.schedule_student_to_courses(student, course_index + 1)
                 if len(col_list) == 0:
                     # Success!, now reorder the scheduled class list to move this one to the end
@@ -175,11 +226,15 @@ class ScheduleData:
 
 
 class ScheduleClass:
+    __slots__ = ('course_id', 'room_id', 'teacher_id', 'timeblock_id', 'timeblock_bit',
+                 'max_student_count', 'min_student_count', 'students')
+
     def __init__(self, course_id, room_id, teacher_id, timeblock_id, max_students, min_students):
         self.course_id = course_id
         self.room_id = room_id
         self.teacher_id = teacher_id
         self.timeblock_id = timeblock_id
+        self.timeblock_bit = 0 # set by ScheduleData, see ScheduleData.timeblock_bits
         self.max_student_count = max_students
         self.min_student_count = min_students
         self.students = []
@@ -189,27 +244,28 @@ class ScheduleClass:
         if len(self.students) >= self.max_student_count:
             # print("course {} count= {} max={}".format(self.course_id, len(self.students), self.max_student_count))
             return ScheduleCollision(student, self, "full class")
-        if student.timeblock_to_course[self.timeblock_id]:
+        if student.occupied & self.timeblock_bit:
             return ScheduleCollision(student, self, "timeblock")
 
         self.students.append(student)
-        student.timeblock_to_course[self.timeblock_id] = self
+        student.add_class(self)
         return None
 
     def drop_student(self, student):
         self.students.remove(student)
-        student.timeblock_to_course[self.timeblock_id] = None
+        student.drop_class(self)
 
     def drop_all_students(self):
         self.students = []
 
 class ScheduleStudent:
-    def __init__(self, id, required_course_ids, optional_course_ids, timeblocks):
+    __slots__ = ('id', 'required_course_ids', 'optional_course_ids', 'occupied', 'classes')
+
+    def __init__(self, id, required_course_ids, optional_course_ids):
         """
         Student object for building a schedules
 
         :param id: the student model's id
-        :param num_of_timeblocks:  number of blocks in a day
         :param required_courses:   list of required courese ids
         :param optional_courses:   list of optional course ids
         :return:
@@ -217,10 +273,28 @@ class ScheduleStudent:
         self.id = id
         self.required_course_ids = required_course_ids
         self.optional_course_ids = optional_course_ids
-        # map timeblocks to classes
-        self.timeblock_to_course = {}
-        for t_id, timeblock in timeblocks.items():
-            self.timeblock_to_course[t_id] = None 
+        # the bits of the timeblocks the student has a class in (see ScheduleData.timeblock_bits)
+        self.occupied = 0
+        self.classes = []
+
+    def add_class(self, sch_class):
+        self.classes.append(sch_class)
+        self.occupied |= sch_class.timeblock_bit
+
+    def drop_class(self, sch_class):
+        self.classes.remove(sch_class)
+        self.occupied &= ~sch_class.timeblock_bit
+
+    def is_free(self, timeblock_bit):
+        return not self.occupied & timeblock_bit
+
+    def class_in(self, timeblock_bit):
+        """ the student's class in the timeblock, None if they have none """
+        if self.occupied & timeblock_bit:
+            for sch_class in self.classes:
+                if sch_class.timeblock_bit == timeblock_bit:
+                    return sch_class
+        return None
 
     # def get_avail_timeblocks(self):
     #     """
@@ -234,6 +308,8 @@ class ScheduleStudent:
     #     return time_list
 
 class ScheduleCollision:
+    __slots__ = ('student', 'scheduled_class', 'collision_type')
+
     def __init__(self, student, scheduled_class, collision_type):
         """
         Represents a single collision resulting from an attempt so schedule a student
@@ -0,0 +1,178 @@
+"""
+Runs the scheduler for the api in worker processes, at most config.schedule_job_workers at a
+time, and keeps the state and progress of every run in its ScheduleJob row.
+
+Each job is run by the worker CLI (see worker) in a new interpreter and session, so the solver
+and the scheduler's queries share neither the app's GIL nor its DB session. A cancel stops the
+worker along with any processes the scheduler started (the portfolio racers, the placement
+pools) by killing its session's process group.
+"""
+import os
+import signal
+import subprocess
+import sys
+from datetime import datetime
+from threading import Lock, Thread
+from schoolbloc import app, db
+from schoolbloc.config import config
+from schoolbloc.scheduler.models import ScheduleJob
+import schoolbloc.scheduler.scheduler_util as SchedUtil
+from schoolbloc.scheduler.worker import DB_URI_ENV
+
+# the worker is run as a module from the flask_app directory, like the app
+APP_DIR = os.path.dirname(app.root_path)
+
+
+class ScheduleJobQueue:
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or config.schedule_job_workers
+        self.lock = Lock()
+        # job id => the Popen of the worker running the job
+        self.workers = {}
+
+    def submit(self, portfolio=False):
+        """ Queues a job, starting it right away if a worker is free, and returns it """
+        job = ScheduleJob(portfolio=portfolio, created_at=datetime.now())
+        db.session.add(job)
+        db.session.commit()
+        self.dispatch()
+        db.session.refresh(job)
+        return job
+
+    def cancel(self, job_id):
+        """
+        Cancels a queued or running job. Returns the job, or None when there is no such job or
+        it had already finished
+        """
+        with self.lock:
+            db.session.expire_all()
+            job = ScheduleJob.query.get(job_id)
+            if job is None or job.state in ScheduleJob.FINISHED_STATES:
+                return None
+            worker = self.workers.pop(job_id, None)
+            if worker is not None:
+                stop_worker(worker)
+                db.session.refresh(job)
+                if job.state in ScheduleJob.FINISHED_STATES:
+                    # it finished before it was stopped
+                    return None
+            elif job.state == 'running' and worker_alive(job.pid, job.pid_start_time):
+                # run by a worker another app process started
+                kill_worker_group(job.pid)
+            job.state = 'cancelled'
+            job.finished_at = datetime.now()
+            db.session.commit()
+        SchedUtil.log_note("warning", "Scheduler", "Schedule job {} cancelled".format(job_id))
+        self.dispatch()
+        return job
+
+    def dispatch(self):
+        """ Reaps the finished workers, then starts queued jobs while there are free workers """
+        with self.lock:
+            db.session.expire_all()
+            self.recover()
+            for job_id, worker in list(self.workers.items()):
+                if worker.poll() is None:
+                    continue
+                del self.workers[job_id]
+                job = ScheduleJob.query.get(job_id)
+                if job is not None and job.state not in ScheduleJob.FINISHED_STATES:
+                    job.finish('failed', "The worker exited with code {}".format(worker.returncode))
+                    db.session.commit()
+
+            free = self.max_workers - len(self.workers)
+            if free > 0:
+                queued = ScheduleJob.query.filter_by(state='queued').order_by(ScheduleJob.id).limit(free).all()
+                for job in queued:
+                    self.start(job)
+
+    def start(self, job):
+        job.state = 'running'
+        job.started_at = datetime.now()
+        db.session.commit()
+        command = [ sys.executable, '-m', 'schoolbloc.scheduler.worker', '--job', str(job.id) ]
+        # not on the command line, where every user of the host could read its credentials
+        env = dict(os.environ)
+        env[DB_URI_ENV] = app.config['SQLALCHEMY_DATABASE_URI']
+        worker = subprocess.Popen(command, cwd=APP_DIR, env=env, start_new_session=True)
+        self.workers[job.id] = worker
+        job.pid = worker.pid
+        job.pid_start_time = process_start_time(worker.pid)
+        db.session.commit()
+
+        # starts the next queued job when this one's worker exits
+        watcher = Thread(target=self.watch, args=(worker,))
+        watcher.daemon = True
+        watcher.start()
+
+    def recover(self):
+        """
+        fails the running jobs whose worker is gone. The workers this process didn't start (those
+        of another app process, or of one that was restarted) keep their jobs while they run
+        """
+        for job in ScheduleJob.query.filter_by(state='running').all():
+            if job.id in self.workers or worker_alive(job.pid, job.pid_start_time):
+                continue
+            # a worker writes the end of its job before it exits
+            db.session.refresh(job)
+            if job.state == 'running':
+                job.finish('failed', "The worker stopped without finishing the job")
+        db.session.commit()
+
+    def watch(self, worker):
+        worker.wait()
+        try:
+            self.dispatch()
+        finally:
+            db.session.remove()
+
+
+def stop_worker(worker):
+    """ stops a job's worker and the processes it started (its process group) """
+    kill_worker_group(worker.pid)
+    worker.wait()
+
+
+def kill_worker_group(pid):
+    try:
+        os.killpg(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def worker_alive(pid, start_time=None):
+    """
+    true while the process of the worker is running, on this host. With the start time of the
+    worker, a process that was given its pid later isn't taken for it
+    """
+    if pid is None:
+        return False
+    if start_time is not None:
+        return process_start_time(pid) == start_time
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # it runs as another user
+        return True
+    return True
+
+
+def process_start_time(pid):
+    """
+    when a process started, in clock ticks since boot, or None when it isn't running or the
+    start times can't be read (there is no /proc)
+    """
+    try:
+        with open('/proc/{}/stat'.format(pid)) as stat_file:
+            stat = stat_file.read()
+    except (IOError, OSError):
+        return None
+    # the fields after the command name, which is in parentheses and may hold spaces
+    fields = stat[stat.rindex(')') + 2:].split()
+    return int(fields[19])
+
+
+job_queue = ScheduleJobQueue()
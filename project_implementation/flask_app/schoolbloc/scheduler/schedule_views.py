@@ -0,0 +1,77 @@
+"""
+Caches the serialized views of the saved schedules, the JSON of Schedule.serialize(expanded=True)
+('class') and of Schedule.student_serialize ('student') ready to be sent.
+
+A schedule isn't changed once ScheduleData.save has written it, so save stores both views
+then, compressed in ScheduleView rows, where the app (a different process from the scheduler's
+worker) reads them. The app keeps the last config.schedule_view_cache_size views it served in
+memory. Schedules saved before the views were are serialized on their first request. The
+views keep the names the students, teachers, rooms and courses had when they were made, and
+are dropped with their schedule; call evict when deleting one.
+"""
+import json
+import zlib
+from collections import OrderedDict
+from threading import Lock
+from schoolbloc import db
+from schoolbloc.config import config
+from schoolbloc.scheduler.models import Schedule, ScheduleView
+
+VIEWS = ('class', 'student')
+
+_lock = Lock()
+# (schedule id, view name) => the view's JSON, the least recently used first
+_views = OrderedDict()
+
+
+def serialize(schedule, name):
+    """ the JSON of a view of a Schedule """
+    if name == 'class':
+        view = schedule.serialize(expanded=True)
+    else:
+        view = schedule.student_serialize()
+    return json.dumps(view).encode('utf-8')
+
+
+def store(schedule):
+    """ makes and keeps the views of a schedule just saved (the caller commits) """
+    for name in VIEWS:
+        data = serialize(schedule, name)
+        db.session.add(ScheduleView(schedule_id=schedule.id, name=name, data=zlib.compress(data)))
+        remember((schedule.id, name), data)
+
+
+def get(schedule_id, name):
+    """ the JSON of a view of a schedule, None when there is no such schedule """
+    key = (schedule_id, name)
+    with _lock:
+        data = _views.get(key)
+        if data is not None:
+            _views.move_to_end(key)
+            return data
+
+    stored = db.session.query(ScheduleView.data).filter_by(schedule_id=schedule_id, name=name).first()
+    if stored is not None:
+        data = zlib.decompress(stored.data)
+    else:
+        schedule = Schedule.query.get(schedule_id)
+        if schedule is None:
+            return None
+        data = serialize(schedule, name)
+    remember(key, data)
+    return data
+
+
+def evict(schedule_id):
+    """ drops the views of a schedule from memory """
+    with _lock:
+        for name in VIEWS:
+            _views.pop((schedule_id, name), None)
+
+
+def remember(key, data):
+    with _lock:
+        _views[key] = data
+        _views.move_to_end(key)
+        while len(_views) > config.schedule_view_cache_size:
+            _views.popitem(last=False)
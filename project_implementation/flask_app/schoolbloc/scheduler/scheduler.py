@@ -1,10 +1,14 @@
+import os
 import random
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from z3 import *
 from schoolbloc.scheduler.models import *
+from schoolbloc import db
 from schoolbloc.config import config
-from schoolbloc.scheduler.schedule_data import ScheduleClass, ScheduleStudent, ScheduleData
+from schoolbloc.scheduler.schedule_data import ScheduleClass, ScheduleStudent, ScheduleData, ScheduleCollision
 from schoolbloc.scheduler.schedule_constraints import ScheduleConstraints
 from schoolbloc.scheduler.class_constraint import ClassConstraint
+from schoolbloc.scheduler.student_placement import FlowPlacement, RepairPlacement
 import time
 import schoolbloc.scheduler.scheduler_util as SchedUtil
 
@@ -12,12 +16,37 @@ class SchedulerNoSolution(Exception):
     def __init__(self, message):
         self.message = message
     def __str__(self):
-        return repr(self.value)
+        return repr(self.message)
 
 class Scheduler():
 
-    def __init__(self):
-
+    # how the students are placed in the classes of a mapping: a student at a time (starting
+    # over after a failure), a course at a time with max flows (see FlowPlacement), or a
+    # student at a time making room for the ones that don't fit (see RepairPlacement)
+    PLACEMENTS = ('greedy', 'flow', 'repair')
+
+    def __init__(self, collision_encoding='pairwise', attribute_encoding='int', path_encoding='choice',
+                 incremental=False, relaxation='first', placement='greedy', parallel_mappings=1,
+                 tactic=None, seed=0, progress=None):
+        if placement not in Scheduler.PLACEMENTS:
+            raise ValueError("Unknown placement: {}".format(placement))
+        if parallel_mappings < 1:
+            raise ValueError("parallel_mappings must be at least 1, got {}".format(parallel_mappings))
+        if tactic is not None and relaxation == 'core':
+            raise ValueError("The core relaxation needs unsat cores, the solvers of tactics don't give them")
+
+        # see ScheduleConstraints.COLLISION_ENCODINGS, ATTRIBUTE_ENCODINGS and PATH_ENCODINGS
+        self.collision_encoding = collision_encoding
+        self.attribute_encoding = attribute_encoding
+        self.path_encoding = path_encoding
+        # keep one solver (and what it learned) for the whole run, see ScheduleConstraints
+        self.incremental = incremental
+        # see ScheduleConstraints.RELAXATIONS, the core relaxation needs the incremental mode
+        self.relaxation = relaxation
+        self.placement = placement
+        # the number of distinct mappings generated at a time, their students are placed in
+        # that many worker processes (see place_mappings)
+        self.parallel_mappings = parallel_mappings
         self.classes = []
         self.sched_students = []
         # self.req_courses = {}
@@ -27,42 +56,34 @@ class Scheduler():
 
         self.custom_constraints = []
         # Next, ask z3 for a configuration of course, teacher, room, and time.
-        self.solver = Solver()
+        # a z3 tactic (like 'qflia' or 'qfbv') to solve with instead of the default solver, and
+        # the random seed of the solver (see PortfolioScheduler)
+        self.tactic = tactic
+        self.seed = seed
+        if tactic is None:
+            self.solver = Solver()
+        else:
+            self.solver = Tactic(tactic).solver()
         self.solver.set(timeout=300000) # 5 min
+        if seed:
+            self.solver.set(random_seed=seed)
+        self.check_count = 0
+        # called with the check count and the class count after every solver check (see
+        # schedule_jobs)
+        self.progress = progress
+        if self.incremental:
+            # without a fresh solver for each check, random phases (and a new seed for each check)
+            # are what keep the mappings of consecutive checks from being all alike
+            self.solver.set('phase_selection', 5)
+        if self.relaxation == 'core':
+            # the smaller the core, the fewer preferences are given up
+            self.solver.set('core.minimize', True)
 
     def __repr__(self):
         return "<day_start_time={} day_end_time={} break_length={} lunch_start={} lunch_end={} class_duration={}>".format(
             self.day_start_time, self.day_end_time, self.break_length, self.lunch_start, self.lunch_end, self.class_duration)
 
 
-    def max_class_size(self, course_id=None):
-        max_count = config.default_max_class_size
-
-        if course_id: 
-            course = Course.query.get(course_id)
-        else:
-            course = None
-
-        if course and course.max_student_count:
-            max_count = course.max_student_count
-
-        return max_count
-
-    def min_class_size(self, course_id=None):
-        min_count = config.default_min_class_size
-
-        if course_id: 
-            course = Course.query.get(course_id)
-        else:
-            course = None
-
-        if course and course.min_student_count:
-            min_count = course.min_student_count
-
-        return min_count
-
-    
-
     def gen_sched_classes(self, model, sched_constraints):
 
         sch_map = {}
@@ -81,21 +102,17 @@ class Scheduler():
         #print('\033[95m course_id | room_id | teacher_id | time_block \033[0m', file=sys.stderr)
         
         class_list = []
+        # the model values are translated back to DB ids (they're indexes with the bitvec encoding)
+        attributes = sched_constraints.class_attributes(model)
+        snapshot = sched_constraints.snapshot
         for i in range(sched_constraints.class_count):
-            course_id = int(str(model.evaluate(sched_constraints.course(i))))
-            room_id = int(str(model.evaluate(sched_constraints.room(i))))
-            teacher_id = int(str(model.evaluate(sched_constraints.teacher(i))))
-            time_block_index = int(str(model.evaluate(sched_constraints.time(i))))
-
-            #print('\033[92m     {}     |    {}    |      {}     |     {} \033[0m'.format(
-            #      course_id, room_id, teacher_id, time_block_index), file=sys.stderr)
-
+            course_id = attributes['course'][i]
             class_list.append(ScheduleClass(course_id,
-                                            room_id,
-                                            teacher_id,
-                                            time_block_index,
-                                            self.max_class_size(course_id),
-                                            self.min_class_size(course_id)))
+                                            attributes['room'][i],
+                                            attributes['teacher'][i],
+                                            attributes['time'][i],
+                                            snapshot.max_student_count(course_id),
+                                            snapshot.min_student_count(course_id)))
 
         sched_data = ScheduleData(class_list)
         # print("schedule data")
@@ -106,48 +123,86 @@ class Scheduler():
         return sched_data
 
     def make_schedule(self):
-        
+        """ Finds a schedule and saves it, returns the id of the saved Schedule """
+        try:
+            schedule = self.build_schedule()
+            return schedule.save()
+        finally:
+            SchedUtil.flush_notes()
+
+    def build_schedule(self):
+        """ Finds a schedule every student can be placed in and returns its ScheduleData, without saving it """
         SchedUtil.log_note("info", "Scheduler", "Scheduler started")
         # first step, decide how many classes of each course we need
         # this is decided based on the need of the students, and what 
         # teachers and rooms are available for each course.
-        sched_constraints = ScheduleConstraints()
+        sched_constraints = ScheduleConstraints(collision_encoding=self.collision_encoding,
+                                                attribute_encoding=self.attribute_encoding,
+                                                path_encoding=self.path_encoding,
+                                                incremental=self.incremental,
+                                                relaxation=self.relaxation)
 
         # try a bunch of times before resorting to adding a class
         # attempts = int(len(sched_constraints.student_requirement_set) / 10)
-        self.solver.push()
-
+        if not self.incremental:
+            self.solver.push()
+
+        pool = None
+        if self.parallel_mappings > 1:
+            # the workers are forked, they start with the facts read so far
+            pool = ProcessPoolExecutor(max_workers=self.parallel_mappings)
+        try:
+            return self.find_schedule(sched_constraints, pool)
+        finally:
+            if pool is not None:
+                pool.shutdown(wait=False)
+            SchedUtil.flush_notes()
+
+    def find_schedule(self, sched_constraints, pool=None):
+        """
+        Generates mappings (adding classes when they all fail) until the students can be placed
+        in one of them, and returns its ScheduleData. With a pool, parallel_mappings distinct
+        mappings are generated at a time and placed in its worker processes
+        """
         for i in range(50):
             start_time = time.time()
             collisions = []
             
             SchedUtil.log_note("info", "Scheduler", "Attempting to solve using {} classes".format(sched_constraints.class_count))
-            for i in range(20): # try 20 different z3 mappings
-            # find a valid z3 mapping, or quit because none exist
-                SchedUtil.log_note("info", "Scheduler", "Generating a mapping of teachers, courses, classrooms and timeblocks")
-                while True:
-                    self.set_constraints(sched_constraints.get_constraints())
-                    if self.solver.check() != sat:
-                        SchedUtil.log_note("warning", "Scheduler", "Solver could not find a solution for the current constraint set")
-                    
-                        if sched_constraints.can_relax_constraints():
-                            sched_constraints.relax_constraints()
-                            sched_constraints.reset_constraints()
+            for i in range(0, 20, self.parallel_mappings): # try 20 different z3 mappings
+                schedules = []
+                for j in range(self.parallel_mappings):
+                    # find a valid z3 mapping, or quit because none exist
+                    SchedUtil.log_note("info", "Scheduler", "Generating a mapping of teachers, courses, classrooms and timeblocks")
+                    while True:
+                        result = self.check(sched_constraints)
+                        if result != sat:
+                            SchedUtil.log_note("warning", "Scheduler", "Solver could not find a solution for the current constraint set")
+
+                            if not self.relax(sched_constraints, result):
+                                SchedUtil.log_note("error", "Scheduler", "No valid mapping exists for current constraint set")
+                                raise SchedulerNoSolution('Not satisfiable')
                         else:
-                            SchedUtil.log_note("error", "Scheduler", "No valid mapping exists for current constraint set")
-                            raise SchedulerNoSolution('Not satisfiable')
-                    else:
-                        SchedUtil.log_note("info", "Scheduler", "Valid mapping found, attempting to schedule students")
-                        break
+                            SchedUtil.log_note("info", "Scheduler", "Valid mapping found, attempting to schedule students")
+                            break
+
+                    schedules.append(self.gen_sched_classes(self.solver.model(), sched_constraints))
+                    if self.incremental or pool is not None:
+                        # the solver would find the same mapping again (a blocking clause)
+                        sched_constraints.exclude_class_times(self.solver.model())
 
-                schedule = self.gen_sched_classes(self.solver.model(), sched_constraints)
                 # now start assigning students to classes and see if we can find
                 # a place for every student
-                collisions = self.place_students(schedule, sched_constraints.student_requirement_set)
+                profiles = list(sched_constraints.requirement_profiles.values())
+                if pool is not None:
+                    schedule, collisions = self.place_mappings(pool, schedules, profiles)
+                else:
+                    schedule = schedules[0]
+                    collisions = self.place_students(schedule, profiles)
                 if len(collisions) == 0:
-                    SchedUtil.log_note("success", "Scheduler", "Solution found, saving schedule now")
-                    schedule.save()
-                    return
+                    SchedUtil.log_note("success", "Scheduler",
+                                       "Solution found after {} solver checks, saving schedule now".format(self.check_count))
+                    return schedule
                 else:
                     if i < 20:
                         SchedUtil.log_note("warning", "Scheduler", "Failed placing students, attempting again with a new mapping")
@@ -156,13 +211,47 @@ class Scheduler():
             if sched_constraints.can_relax_constraints():
                 SchedUtil.log_note("warning", "Scheduler", "Failed placing students, relaxing constraints and trying again")
                 sched_constraints.relax_constraints()
-                sched_constraints.reset_constraints()    
+                if not self.incremental:
+                    sched_constraints.reset_constraints()
             else:
                 SchedUtil.log_note("warning", "Scheduler", "Failed placing students, adding another class and trying again")
                 sched_constraints.add_class_from_collisions(collisions)
 
         SchedUtil.log_note("error", "Scheduler", "Scheduler failed to place students")
-        raise SchedulerNoSolution()
+        raise SchedulerNoSolution('Failed to place students')
+
+    def check(self, sched_constraints):
+        """
+        Checks the current constraints of sched_constraints. The incremental solver is only given
+        the constraints made since the last check, and assumes the guards of the current ones
+        """
+        self.check_count += 1
+        if self.incremental:
+            self.solver.set(random_seed=self.seed + self.check_count)
+            self.solver.add(sched_constraints.take_new_constraints())
+            result = self.solver.check(sched_constraints.assumptions())
+        else:
+            self.set_constraints(sched_constraints.get_constraints())
+            result = self.solver.check()
+
+        if self.progress is not None:
+            self.progress(self.check_count, sched_constraints.class_count)
+        return result
+
+    def relax(self, sched_constraints, result):
+        """
+        Relaxes the constraints after a check that didn't find a mapping. With the core relaxation
+        the unsat core says which preferences to relax. Returns False if nothing can be relaxed
+        """
+        if self.relaxation == 'core' and result == unsat:
+            return sched_constraints.relax_core(self.solver.unsat_core())
+
+        if not sched_constraints.can_relax_constraints():
+            return False
+        sched_constraints.relax_constraints()
+        if not self.incremental:
+            sched_constraints.reset_constraints()
+        return True
 
     def set_constraints(self, constraints):
         self.solver.pop() # pop off the constraints so we can reset them
@@ -170,32 +259,168 @@ class Scheduler():
         self.solver.add(constraints)
 
 
-    def place_students(self, schedule, student_requirement_set):
+    def place_students(self, schedule, requirement_profiles):
         """
-        Attempts to place all the students in the schedule. This method will try to place the student
-        and if it fails, it will call a method to add targeted constraints then try placing the students again.
+        Attempts to place all the students in the schedule with the scheduler's placement (see
+        place_students)
 
         :param schedule: the ScheduleData constructed out of the z3
-        :param student_requirement_set:
-        :return: True if successfully placed all students, False otherwise
+        :param requirement_profiles: the RequirementProfiles of ScheduleConstraints, students
+                                     are placed a profile at a time
+        :return: the collisions of the students that couldn't be placed, empty if they all were
+        """
+        return place_students(self.placement, schedule, requirement_profiles)
+
+    def place_mappings(self, pool, schedules, requirement_profiles):
+        """
+        Places the students in each of the schedules in the pool's worker processes. Returns the
+        first schedule every student was placed in (with them placed) and no collisions, or
+        the last schedule to finish and its collisions when there isn't one. The schedules a
+        worker failed to place (or that couldn't be submitted to a broken pool) are placed in
+        this process
         """
-        # try every order of placing students, if they all fail, add constraints and try again
-        all_collisions = []
-        for i in range(len(student_requirement_set)):
-            for student_reqs in student_requirement_set:
-                # print("placing student {}".format(student_reqs.student_id))
-                collisions = schedule.schedule_student(student_reqs.student_id,
-                                                      student_reqs.required_course_ids,
-                                                      student_reqs.optional_course_ids)
-                if len(collisions) > 0:
-                    # print('\033[91m Failed on student {}, reordering student list and trying again...\033[0m'.format(
-                    #     student_reqs.student_id))
-                    schedule.clear_all_students()
-                    all_collisions += collisions
-
-                    break
-            # if we placed every student then return an empty list indicating success
-            if len(all_collisions) == 0:
-                return []
-
-        return all_collisions
+        futures = {}
+        in_process = []
+        for schedule in schedules:
+            classes = [ c for class_list in schedule.scheduled_classes.values() for c in class_list ]
+            class_tuples = [ (c.course_id, c.room_id, c.teacher_id, c.timeblock_id, c.max_student_count, c.min_student_count)
+                             for c in classes ]
+            try:
+                future = pool.submit(place_mapping, self.placement, class_tuples, list(schedule.timeblocks.keys()),
+                                     requirement_profiles)
+            except RuntimeError as e:
+                # a BrokenProcessPool, one of its workers died
+                SchedUtil.log_note("warning", "Scheduler", "Could not start a placement worker ({}: {}), "
+                                   "placing the mapping here".format(type(e).__name__, e))
+                in_process.append(schedule)
+                continue
+            futures[future] = (schedule, classes)
+
+        students = {}
+        for profile in requirement_profiles:
+            for student_reqs in profile.student_requirements:
+                students[student_reqs.student_id] = ScheduleStudent(student_reqs.student_id,
+                                                                    student_reqs.required_course_ids,
+                                                                    student_reqs.optional_course_ids)
+
+        collisions = []
+        for future in as_completed(futures):
+            schedule, classes = futures[future]
+            try:
+                class_students, collision_tuples, placement_count = future.result()
+            except Exception as e:
+                SchedUtil.log_note("warning", "Scheduler", "A placement worker failed ({}: {}), "
+                                   "placing the mapping here".format(type(e).__name__, e))
+                in_process.append(schedule)
+                continue
+            schedule.placement_count = placement_count
+            collisions = [ ScheduleCollision(students[student_id], classes[index], collision_type)
+                           for student_id, index, collision_type in collision_tuples ]
+            if len(collisions) == 0:
+                # the placements of the other mappings that haven't started aren't needed
+                for future_left in futures:
+                    future_left.cancel()
+                for sch_class, student_ids in zip(classes, class_students):
+                    for student_id in student_ids:
+                        sch_class.students.append(students[student_id])
+                        students[student_id].add_class(sch_class)
+                return schedule, collisions
+
+        for schedule in in_process:
+            collisions = self.place_students(schedule, requirement_profiles)
+            if len(collisions) == 0:
+                break
+        return schedule, collisions
+
+
+def place_students(placement, schedule, requirement_profiles):
+    """
+    Places all the students in the schedule with one of Scheduler.PLACEMENTS. Returns the
+    collisions of the students that couldn't be placed (an empty list if they all were)
+    """
+    requirement_profiles = list(requirement_profiles)
+    if placement == 'flow':
+        collisions = FlowPlacement(schedule, requirement_profiles).place()
+    elif placement == 'repair':
+        collisions = RepairPlacement(schedule, requirement_profiles).place()
+    else:
+        collisions = place_in_order(schedule, requirement_profiles)
+
+    msg = "Made {} placements for {} students".format(schedule.placement_count,
+                                                       sum(profile.student_count for profile in requirement_profiles))
+    SchedUtil.log_note("info", "Scheduler", msg)
+    return collisions
+
+
+def place_in_order(schedule, requirement_profiles):
+    """
+    Places the students a profile at a time, clearing the schedule and starting over when a
+    student can't be placed. Returns the collisions of the failed attempts
+    """
+    # try every order of placing students, if they all fail, add constraints and try again
+    student_count = sum(profile.student_count for profile in requirement_profiles)
+    all_collisions = []
+    for i in range(student_count):
+        for profile in requirement_profiles:
+            collisions = place_profile(schedule, profile)
+            if len(collisions) > 0:
+                # print('\033[91m Failed on student {}, reordering student list and trying again...\033[0m'.format(
+                #     student_reqs.student_id))
+                schedule.clear_all_students()
+                all_collisions += collisions
+
+                break
+        # if we placed every student then return an empty list indicating success
+        if len(all_collisions) == 0:
+            return []
+
+    return all_collisions
+
+
+def place_profile(schedule, profile):
+    """
+    Places the students of a RequirementProfile. Returns the collisions of the first student
+    that couldn't be placed (an empty list if they all were)
+    """
+    for student_reqs in profile.student_requirements:
+        # print("placing student {}".format(student_reqs.student_id))
+        collisions = schedule.schedule_student(student_reqs.student_id,
+                                              student_reqs.required_course_ids,
+                                              student_reqs.optional_course_ids)
+        if len(collisions) > 0:
+            return collisions
+    return []
+
+
+# the pid of the process init_placement_worker last ran in
+_placement_worker_pid = None
+
+
+def init_placement_worker():
+    """ prepares a placement worker process, once, before its first placement """
+    global _placement_worker_pid
+    if _placement_worker_pid == os.getpid():
+        return
+    _placement_worker_pid = os.getpid()
+    # the worker's notifications need their own DB connections, not the scheduler's
+    db.engine.dispose()
+    SchedUtil.reset_notes()
+
+
+def place_mapping(placement, class_tuples, timeblock_ids, requirement_profiles):
+    """
+    Places the students in a mapping in a worker process (see Scheduler.place_mappings). The
+    classes are (course_id, room_id, teacher_id, timeblock_id, max students, min students)
+    tuples. Returns the student ids of each class, the collisions as (student id, class index,
+    collision type) tuples and the number of placements made
+    """
+    init_placement_worker()
+    classes = [ ScheduleClass(*class_tuple) for class_tuple in class_tuples ]
+    schedule = ScheduleData(classes, timeblock_ids=timeblock_ids)
+    collisions = place_students(placement, schedule, requirement_profiles)
+    # the worker process is ended without running atexit
+    SchedUtil.flush_notes()
+    index = dict((id(sch_class), i) for i, sch_class in enumerate(classes))
+    return ([ [ student.id for student in sch_class.students ] for sch_class in classes ],
+            [ (col.student.id, index[id(col.scheduled_class)], col.collision_type) for col in collisions ],
+            schedule.placement_count)
@@ -1,11 +1,124 @@
+import atexit
+import logging
+import time
+from datetime import datetime
+from threading import Lock, Thread
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
 from schoolbloc.scheduler.models import Notification
 from schoolbloc import db
-from datetime import datetime
+from schoolbloc.config import config
+
+log = logging.getLogger(__name__)
+
+# notification type => level, log_note drops the notes below the verbosity's level
+LEVELS = { 'info': 0, 'success': 1, 'warning': 1, 'error': 2 }
+verbosity = config.notification_verbosity
+
+
+class NotificationSink:
+    """
+    Buffers the notifications of log_note and inserts them in batches from a session of its
+    own, so logging neither commits nor waits on the scheduler's session. The buffer is written
+    every flush_interval seconds, when it holds max_buffered notes and by flush_notes at the end
+    of a run. After a failed insert the buffer keeps at most the max_buffered latest notes, and
+    the timer and a full buffer wait longer before each retry (up to max_backoff seconds)
+    """
+
+    def __init__(self, flush_interval=None, max_buffered=500, max_backoff=300):
+        self.flush_interval = flush_interval or config.notification_flush_interval
+        self.max_buffered = max_buffered
+        self.max_backoff = max_backoff
+        self.reset()
+
+    def reset(self):
+        self.lock = Lock()
+        self.rows = []
+        self.timer = None
+        # the inserts that failed in a row, and the time before which they aren't retried
+        self.failures = 0
+        self.retry_at = 0
+
+    def add(self, row):
+        with self.lock:
+            self.rows.append(row)
+            if len(self.rows) > self.max_buffered:
+                # only while the inserts fail, the oldest note goes
+                del self.rows[0]
+            full = len(self.rows) >= self.max_buffered and time.time() >= self.retry_at
+            if self.timer is None:
+                self.timer = Thread(target=self.run_timer)
+                self.timer.daemon = True
+                self.timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """ inserts the buffered notes, keeping the latest ones for a retry when the insert fails """
+        with self.lock:
+            rows, self.rows = self.rows, []
+        if not rows:
+            return
+        session = Session(bind=db.engine)
+        try:
+            session.bulk_insert_mappings(Notification, rows)
+            session.commit()
+        except SQLAlchemyError as e:
+            session.rollback()
+            with self.lock:
+                self.rows[:0] = rows
+                dropped = max(0, len(self.rows) - self.max_buffered)
+                del self.rows[:dropped]
+                self.failures += 1
+                backoff = min(self.flush_interval * 2 ** (self.failures - 1), self.max_backoff)
+                self.retry_at = time.time() + backoff
+            log.warning("Could not save %d notifications (%d dropped), retrying in %ss: %s",
+                        len(rows), dropped, backoff, e)
+        else:
+            with self.lock:
+                self.failures = 0
+                self.retry_at = 0
+        finally:
+            session.close()
+
+    def run_timer(self):
+        while True:
+            time.sleep(self.flush_interval)
+            if time.time() >= self.retry_at:
+                self.flush()
+
+
+sink = NotificationSink()
+atexit.register(sink.flush)
+
+
+def set_verbosity(level):
+    """ keeps the notes of the level's type and the more important ones ('info' keeps them all) """
+    global verbosity
+    if level not in LEVELS:
+        raise ValueError("Unknown verbosity {}, expected one of {}".format(level, sorted(LEVELS)))
+    verbosity = level
+
+
+def flush_notes():
+    """ saves the buffered notifications, called at the end of each scheduler run """
+    sink.flush()
+
+
+def reset_notes():
+    """
+    drops the notifications buffered before a fork, called at the start of each forked process
+    (the parent saves them, the child would save them again at exit)
+    """
+    sink.reset()
+
 
 def log_note(type, subject, description):
+    if LEVELS.get(type, 0) < LEVELS[verbosity]:
+        return
     created_at = datetime.now()
-    db.session.add(Notification(type=type, subject=subject, description=description, created_at=created_at))
-    db.session.commit()
+    sink.add({'type': type, 'subject': subject, 'description': description,
+              'created_at': created_at, 'unread': True})
 
     text_color = ""
     if type == 'error':
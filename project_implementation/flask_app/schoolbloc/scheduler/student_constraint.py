@@ -1,8 +1,10 @@
 from schoolbloc.scheduler.models import *
+from schoolbloc.scheduler.constraint_snapshot import ConstraintSnapshot
 
 class StudentConstraint:
-	def __init__(self, student_id):
+	def __init__(self, student_id, snapshot=None):
 		self.student_id = student_id
+		self.snapshot = snapshot or ConstraintSnapshot()
 
 		self.calc_constraints()
 
@@ -43,71 +45,64 @@ class StudentConstraint:
 
 	def calc_constraints(self):
 		"""
-		Pulls the constraints related to this student from the database
+		Pulls the constraints related to this student from the constraint snapshot
 		"""
-		ss_list = StudentsStudentGroup.query.filter_by(student_id=self.student_id).all()
-		self.student_group_ids = [ ss.student_group_id for ss in ss_list ]
+		snapshot = self.snapshot
+		self.student_group_ids = list(snapshot.student_student_groups.get(self.student_id, []))
 
-		
-		self.mand_course_ids = [ ct.course_id 
-							for ct in CoursesStudent.query.filter_by(student_id=self.student_id,
-																	 priority="mandatory") ]
-		self.high_course_ids = [ ct.course_id 
-							for ct in CoursesStudent.query.filter_by(student_id=self.student_id,
-																	 priority="high") ]
-		self.low_course_ids = [ ct.course_id 
-						   for ct in CoursesStudent.query.filter_by(student_id=self.student_id,
-																	priority="low") ]
+		self.mand_course_ids = list(snapshot.lookup(snapshot.student_courses, self.student_id, "mandatory"))
+		self.high_course_ids = list(snapshot.lookup(snapshot.student_courses, self.student_id, "high"))
+		self.low_course_ids = list(snapshot.lookup(snapshot.student_courses, self.student_id, "low"))
 
 		# now collect the courses assigned to the student through their subjects
-		for ss in StudentsSubject.query.filter_by(student_id=self.student_id, priority="mandatory"):
+		for subject_id in snapshot.lookup(snapshot.student_subjects, self.student_id, "mandatory"):
 			# if a course is not already assigned to the student through a direct constraint, we choose
 			# one of the courses in the subject
-			course_ids = [ cs.course_id for cs in CoursesSubject.query.filter_by(subject_id=ss.subject_id) ]
+			course_ids = snapshot.subject_courses.get(subject_id, [])
 			if len(course_ids) > 0 and set(course_ids) & set(self.mand_course_ids) == set():
 				self.mand_course_ids.append(course_ids[0])
 
-		for ss in StudentsSubject.query.filter_by(student_id=self.student_id, priority="high"):
-			course_ids = [ cs.course_id for cs in CoursesSubject.query.filter_by(subject_id=ss.subject_id) ]
+		for subject_id in snapshot.lookup(snapshot.student_subjects, self.student_id, "high"):
+			course_ids = snapshot.subject_courses.get(subject_id, [])
 			if len(course_ids) > 0 and set(course_ids) & set(self.high_course_ids) == set():
 				self.high_course_ids.append(course_ids[0])
 
-		for ss in StudentsSubject.query.filter_by(student_id=self.student_id, priority="low"):
-			course_ids = [ cs.course_id for cs in CoursesSubject.query.filter_by(subject_id=ss.subject_id) ]
+		for subject_id in snapshot.lookup(snapshot.student_subjects, self.student_id, "low"):
+			course_ids = snapshot.subject_courses.get(subject_id, [])
 			if len(course_ids) > 0 and set(course_ids) & set(self.low_course_ids) == set():
 				self.low_course_ids.append(course_ids[0])
 
 		# now collect the courses assigned to the student through the student groups, but make sure
 		# we're not adding the same id twice
 		for sg_id in self.student_group_ids:
-			for csg in CoursesStudentGroup.query.filter_by(student_group_id=sg_id, priority="mandatory"):
-				if csg.course_id not in self.mand_course_ids:
-					self.mand_course_ids.append(csg.course_id)
+			for course_id in snapshot.lookup(snapshot.student_group_courses, sg_id, "mandatory"):
+				if course_id not in self.mand_course_ids:
+					self.mand_course_ids.append(course_id)
 			
-			for csg in CoursesStudentGroup.query.filter_by(student_group_id=sg_id, priority="high"):
-				if csg.course_id not in self.high_course_ids:
-					self.high_course_ids.append(csg.course_id)
+			for course_id in snapshot.lookup(snapshot.student_group_courses, sg_id, "high"):
+				if course_id not in self.high_course_ids:
+					self.high_course_ids.append(course_id)
 			
-			for csg in CoursesStudentGroup.query.filter_by(student_group_id=sg_id, priority="low"):
-				if csg.course_id not in self.low_course_ids:
-					self.low_course_ids.append(csg.course_id)
+			for course_id in snapshot.lookup(snapshot.student_group_courses, sg_id, "low"):
+				if course_id not in self.low_course_ids:
+					self.low_course_ids.append(course_id)
 
 		# now collect the courses assigned to the student through subjects assigend to the student group
 		for sg_id in self.student_group_ids:
-			for ss in StudentGroupsSubject.query.filter_by(student_group_id=sg_id, priority="mandatory"):
+			for subject_id in snapshot.lookup(snapshot.student_group_subjects, sg_id, "mandatory"):
 				# if a course is not already assigned to the student through a direct constraint, we choose
 				# one of the courses in the subject
-				course_ids = [ cs.course_id for cs in CoursesSubject.query.filter_by(subject_id=ss.subject_id) ]
+				course_ids = snapshot.subject_courses.get(subject_id, [])
 				if len(course_ids) > 0 and set(course_ids) & set(self.mand_course_ids) == set():
 					self.mand_course_ids.append(course_ids[0])
 
-			for ss in StudentGroupsSubject.query.filter_by(student_group_id=sg_id, priority="high"):
-				course_ids = [ cs.course_id for cs in CoursesSubject.query.filter_by(subject_id=ss.subject_id) ]
+			for subject_id in snapshot.lookup(snapshot.student_group_subjects, sg_id, "high"):
+				course_ids = snapshot.subject_courses.get(subject_id, [])
 				if len(course_ids) > 0 and set(course_ids) & set(self.high_course_ids) == set():
 					self.high_course_ids.append(course_ids[0])
 
-			for ss in StudentGroupsSubject.query.filter_by(student_group_id=sg_id, priority="low"):
-				course_ids = [ cs.course_id for cs in CoursesSubject.query.filter_by(subject_id=ss.subject_id) ]
+			for subject_id in snapshot.lookup(snapshot.student_group_subjects, sg_id, "low"):
+				course_ids = snapshot.subject_courses.get(subject_id, [])
 				if len(course_ids) > 0 and set(course_ids) & set(self.low_course_ids) == set():
 					self.low_course_ids.append(course_ids[0])
 
@@ -0,0 +1,420 @@
+from schoolbloc.scheduler.schedule_data import ScheduleStudent, ScheduleCollision
+import schoolbloc.scheduler.scheduler_util as SchedUtil
+
+
+class MaxFlow:
+    def __init__(self, node_count):
+        """
+        A flow network solved with Dinic's algorithm. Nodes are numbered from 0, edges are
+        numbered in the order they are added (see add_edge and flow)
+        """
+        self.adjacent = [ [] for i in range(node_count) ]
+        # the edges are stored in pairs (forward, reverse): to node, residual capacity
+        self.to = []
+        self.capacity = []
+        self.initial_capacity = []
+
+    def add_edge(self, u, v, capacity):
+        """ adds an edge from u to v and returns its number """
+        edge = len(self.to)
+        self.adjacent[u].append(edge)
+        self.to.append(v)
+        self.capacity.append(capacity)
+        self.initial_capacity.append(capacity)
+        self.adjacent[v].append(edge + 1)
+        self.to.append(u)
+        self.capacity.append(0)
+        self.initial_capacity.append(0)
+        return edge
+
+    def flow(self, edge):
+        """ the flow through the edge after max_flow """
+        return self.initial_capacity[edge] - self.capacity[edge]
+
+    def max_flow(self, source, sink):
+        total = 0
+        while self.build_levels(source, sink):
+            self.next_edge = [ 0 for i in range(len(self.adjacent)) ]
+            pushed = self.push(source, sink, float('inf'))
+            while pushed:
+                total += pushed
+                pushed = self.push(source, sink, float('inf'))
+        return total
+
+    def build_levels(self, source, sink):
+        """ numbers the nodes by their distance from the source in the residual network """
+        self.level = [ -1 for i in range(len(self.adjacent)) ]
+        self.level[source] = 0
+        queue = [source]
+        for u in queue:
+            for edge in self.adjacent[u]:
+                v = self.to[edge]
+                if self.capacity[edge] > 0 and self.level[v] < 0:
+                    self.level[v] = self.level[u] + 1
+                    queue.append(v)
+        return self.level[sink] >= 0
+
+    def push(self, u, sink, limit):
+        """ pushes up to limit units along one path of increasing levels, returns the amount """
+        if u == sink:
+            return limit
+        while self.next_edge[u] < len(self.adjacent[u]):
+            edge = self.adjacent[u][self.next_edge[u]]
+            v = self.to[edge]
+            if self.capacity[edge] > 0 and self.level[v] == self.level[u] + 1:
+                pushed = self.push(v, sink, min(limit, self.capacity[edge]))
+                if pushed:
+                    self.capacity[edge] -= pushed
+                    self.capacity[edge ^ 1] += pushed
+                    return pushed
+            self.next_edge[u] += 1
+        return 0
+
+
+class Placement:
+    def __init__(self, schedule, requirement_profiles):
+        """
+        The students of a mapping and the moves shared by the placements below. Every student
+        put in a class counts towards schedule.placement_count
+
+        :param schedule: the ScheduleData of the mapping
+        :param requirement_profiles: the RequirementProfiles of ScheduleConstraints
+        """
+        self.schedule = schedule
+        self.requirement_profiles = list(requirement_profiles)
+        self.students = {} # student id => ScheduleStudent
+        self.students_by_course = {}
+        for profile in self.requirement_profiles:
+            for student_reqs in profile.student_requirements:
+                student = ScheduleStudent(student_reqs.student_id,
+                                          student_reqs.required_course_ids,
+                                          student_reqs.optional_course_ids)
+                self.students[student.id] = student
+                for course_id in student.required_course_ids:
+                    self.students_by_course.setdefault(course_id, []).append(student)
+        self.max_search_steps = 0
+        self.steps = 0
+
+    def search(self, unplaced):
+        """
+        Tries to place the (student, course_id) pairs left out, by moving the student's
+        class in the way (or a student of a full class) to another class of the same course, or
+        swapping places with a student of that class. When no single move does it, the student's
+        classes are all chosen again (see reseat).
+        Stops after max_search_steps moves were tried, returns the pairs still unplaced
+        """
+        self.steps = 0
+        progress = True
+        while progress and len(unplaced) > 0 and self.steps < self.max_search_steps:
+            progress = False
+            still_unplaced = []
+            for student, course_id in unplaced:
+                if self.takes(student, course_id):
+                    # placed by the reseat of one of the student's other courses
+                    progress = True
+                elif self.steps < self.max_search_steps and \
+                        (self.place_by_moving(student, course_id) or self.reseat(student)):
+                    progress = True
+                else:
+                    still_unplaced.append((student, course_id))
+            unplaced = still_unplaced
+        return unplaced
+
+    def takes(self, student, course_id):
+        return any(c.course_id == course_id for c in student.classes)
+
+    def place_by_moving(self, student, course_id):
+        for sch_class in self.schedule.scheduled_classes.get(course_id, []):
+            self.steps += 1
+            blocking = student.class_in(sch_class.timeblock_bit)
+            full = len(sch_class.students) >= sch_class.max_student_count
+            if blocking is None and not full:
+                self.add(student, sch_class)
+                return True
+            if blocking is not None and not full:
+                # move the student's other class out of the timeblock
+                if self.move(student, blocking, exclude_timeblock_id=sch_class.timeblock_id):
+                    self.add(student, sch_class)
+                    return True
+            elif blocking is None and full:
+                # move one of the class's students to another class of the course (a swap
+                # would leave the class full)
+                for other in list(sch_class.students):
+                    if self.move(other, sch_class, swap=False):
+                        self.add(student, sch_class)
+                        return True
+        return False
+
+    def reseat(self, student):
+        """
+        drops the student from their classes and looks for classes with free seats for all of
+        their courses at once, puts them back in their classes if there aren't any
+        """
+        old_classes = list(student.classes)
+        for sch_class in old_classes:
+            sch_class.drop_student(student)
+        if self.seat(student, 0):
+            return True
+        for sch_class in old_classes:
+            self.add(student, sch_class)
+        return False
+
+    def seat(self, student, course_index):
+        """ places the student in the courses from course_index on, backtracking like ScheduleData """
+        if course_index >= len(student.required_course_ids):
+            return True
+        for sch_class in self.schedule.scheduled_classes[student.required_course_ids[course_index]]:
+            self.steps += 1
+            if self.steps >= self.max_search_steps:
+                return False
+            if len(sch_class.students) < sch_class.max_student_count and student.is_free(sch_class.timeblock_bit):
+                self.add(student, sch_class)
+                if self.seat(student, course_index + 1):
+                    return True
+                sch_class.drop_student(student)
+        return False
+
+    def move(self, student, sch_class, exclude_timeblock_id=None, swap=True):
+        """
+        moves the student from sch_class to another class of the course in a free timeblock, one
+        with a free seat or (when swap is true) with a student that can take the student's place
+        in sch_class
+        """
+        for other_class in self.schedule.scheduled_classes[sch_class.course_id]:
+            self.steps += 1
+            if other_class is sch_class or other_class.timeblock_id == exclude_timeblock_id:
+                continue
+            if not self.free_after_leaving(student, other_class.timeblock_bit, sch_class):
+                continue
+            if len(other_class.students) < other_class.max_student_count:
+                sch_class.drop_student(student)
+                self.add(student, other_class)
+                return True
+            if not swap:
+                continue
+            for other in other_class.students:
+                if self.free_after_leaving(other, sch_class.timeblock_bit, other_class):
+                    sch_class.drop_student(student)
+                    other_class.drop_student(other)
+                    self.add(student, other_class)
+                    self.add(other, sch_class)
+                    return True
+        return False
+
+    def free_after_leaving(self, student, timeblock_bit, leaving_class):
+        """ true if the student has nothing in the timeblock once they leave leaving_class """
+        return student.class_in(timeblock_bit) in (None, leaving_class)
+
+    def add(self, student, sch_class):
+        sch_class.students.append(student)
+        student.add_class(sch_class)
+        self.schedule.placement_count += 1
+
+    def student_collisions(self, unplaced):
+        """
+        the collisions ScheduleData.schedule_student_to_courses runs into for each of the
+        unplaced students, given where everyone else is. These point at the courses in the way,
+        not only at the course a student was left out of
+        """
+        collisions = []
+        students = []
+        for student, course_id in unplaced:
+            if student not in students:
+                students.append(student)
+        if len(students) > 0:
+            SchedUtil.log_note("warning", "Scheduler",
+                               "Could not place {} students with this mapping".format(len(students)))
+        for student in students:
+            old_classes = list(student.classes)
+            for sch_class in old_classes:
+                sch_class.drop_student(student)
+            student_collisions = self.schedule.schedule_student_to_courses(student, 0)
+            if len(student_collisions) > 0:
+                for sch_class in old_classes:
+                    self.add(student, sch_class)
+                collisions += student_collisions
+        return collisions
+
+    def collisions(self, unplaced, collision_type=None):
+        """
+        the collisions of the (student, course_id) pairs with each class of the course, like
+        ScheduleData's. Without a collision_type, full classes are 'full class' collisions and
+        the others 'timeblock' ones
+        """
+        collisions = []
+        for student, course_id in unplaced:
+            for sch_class in self.schedule.scheduled_classes.get(course_id, []):
+                if collision_type is not None:
+                    collisions.append(ScheduleCollision(student, sch_class, collision_type))
+                elif len(sch_class.students) >= sch_class.max_student_count:
+                    collisions.append(ScheduleCollision(student, sch_class, "full class"))
+                else:
+                    collisions.append(ScheduleCollision(student, sch_class, "timeblock"))
+        return collisions
+
+
+class FlowPlacement(Placement):
+    def __init__(self, schedule, requirement_profiles, max_search_steps=None):
+        """
+        Places students course by course: each course is a flow network from the students that
+        need it to its classes (limited by their free seats), where a student is only connected
+        to the classes in one of their free timeblocks. The students a course's flow couldn't
+        place are moved around by a bounded local search (see search), which moves a student's
+        other class or another student of the class out of the way.
+
+        Before placing anyone, the students that can't be placed in any order are found (a course
+        without enough seats, or a set of courses without classes in enough different timeblocks)
+        and reported as such.
+
+        :param schedule: the ScheduleData of the mapping
+        :param requirement_profiles: the RequirementProfiles of ScheduleConstraints
+        :param max_search_steps: the number of moves the local search may try (by default 20
+                                 for each student)
+        """
+        Placement.__init__(self, schedule, requirement_profiles)
+        if max_search_steps is None:
+            max_search_steps = 20 * len(self.students)
+        self.max_search_steps = max_search_steps
+        self.infeasible = []
+
+    def place(self):
+        """
+        Places the students. Returns the collisions of the students that weren't placed, an
+        empty list if every student was
+        """
+        self.find_infeasible()
+        if len(self.infeasible) > 0:
+            return self.infeasible
+
+        unplaced = []
+        for course_id in self.course_order():
+            unplaced += self.place_course(course_id)
+
+        return self.student_collisions(self.search(unplaced))
+
+    def find_infeasible(self):
+        """
+        Finds the students no placement order could place, their collisions are added to
+        self.infeasible
+        """
+        classes = self.schedule.scheduled_classes
+        for course_id, students in self.students_by_course.items():
+            if course_id not in classes:
+                raise Exception("students {}, course {} not in scheduled classes".format([ s.id for s in students ], course_id))
+            seats = sum(c.max_student_count for c in classes.get(course_id, []))
+            if len(students) > seats:
+                msg = "Course {} needs {} seats, its classes have {}".format(course_id, len(students), seats)
+                SchedUtil.log_note("warning", "Scheduler", msg)
+                for student in students[seats:]:
+                    self.infeasible += self.collisions([(student, course_id)], "full class")
+
+        for profile in self.requirement_profiles:
+            if FlowPlacement.timeblock_matching_size(profile.required_course_ids, classes) < len(profile.required_course_ids):
+                msg = "The classes of courses {} are not in {} different timeblocks, {} students can't take them all".format(
+                    sorted(profile.course_ids), len(profile.required_course_ids), profile.student_count)
+                SchedUtil.log_note("warning", "Scheduler", msg)
+                for student_reqs in profile.student_requirements:
+                    student = self.students[student_reqs.student_id]
+                    self.infeasible += self.collisions([ (student, c_id) for c_id in profile.required_course_ids ])
+
+    @staticmethod
+    def timeblock_matching_size(course_ids, classes):
+        """ the number of the courses that can be given different timeblocks of their classes """
+        timeblock_ids = sorted(set(c.timeblock_id for course_id in course_ids for c in classes.get(course_id, [])))
+        node = dict((t_id, i + len(course_ids) + 2) for i, t_id in enumerate(timeblock_ids))
+        network = MaxFlow(len(course_ids) + len(timeblock_ids) + 2)
+        source, sink = 0, 1
+        for i, course_id in enumerate(course_ids):
+            network.add_edge(source, i + 2, 1)
+            for t_id in set(c.timeblock_id for c in classes.get(course_id, [])):
+                network.add_edge(i + 2, node[t_id], 1)
+        for t_id in timeblock_ids:
+            network.add_edge(node[t_id], sink, 1)
+        return network.max_flow(source, sink)
+
+    def course_order(self):
+        """ the courses with the fewest spare seats go first, they have the fewest ways to place their students """
+        classes = self.schedule.scheduled_classes
+        return sorted(self.students_by_course.keys(),
+                      key=lambda c_id: sum(c.max_student_count for c in classes.get(c_id, [])) - len(self.students_by_course[c_id]))
+
+    def place_course(self, course_id):
+        """ places the students of the course with a max flow, returns the (student, course_id) pairs it couldn't """
+        # the students with the most courses have the fewest free timeblocks, so they go first
+        students = sorted(self.students_by_course[course_id], key=lambda s: -len(s.required_course_ids))
+        classes = self.schedule.scheduled_classes.get(course_id, [])
+        network = MaxFlow(len(students) + len(classes) + 2)
+        source, sink = 0, 1
+        edges = []
+        for i, student in enumerate(students):
+            network.add_edge(source, i + 2, 1)
+            # the classes in timeblocks the student's other courses need the least go first
+            for j, sch_class in sorted(enumerate(classes), key=lambda jc: self.timeblock_demand(student, jc[1].timeblock_id)):
+                if student.is_free(sch_class.timeblock_bit):
+                    edges.append((network.add_edge(i + 2, len(students) + j + 2, 1), student, sch_class))
+        for j, sch_class in enumerate(classes):
+            network.add_edge(len(students) + j + 2, sink, max(0, sch_class.max_student_count - len(sch_class.students)))
+        network.max_flow(source, sink)
+
+        placed = set()
+        for edge, student, sch_class in edges:
+            if network.flow(edge) > 0:
+                self.add(student, sch_class)
+                placed.add(student)
+        return [ (student, course_id) for student in students if student not in placed ]
+
+    def timeblock_demand(self, student, timeblock_id):
+        """ the number of the student's unplaced courses with a class in the timeblock """
+        demand = 0
+        placed = set(c.course_id for c in student.classes)
+        for course_id in student.required_course_ids:
+            if course_id not in placed:
+                demand += len([ c for c in self.schedule.scheduled_classes.get(course_id, []) if c.timeblock_id == timeblock_id ])
+        return demand
+
+class RepairPlacement(Placement):
+    def __init__(self, schedule, requirement_profiles, max_repair_steps=200):
+        """
+        Places the students one at a time, like ScheduleData.schedule_student. A student that
+        doesn't fit doesn't start the placement over: the students already placed stay where
+        they are and the search makes room around the new one, moving the student's own
+        classes or students of a full class to other classes of the same course, or swapping
+        two students between them (see Placement.search).
+
+        :param schedule: the ScheduleData of the mapping
+        :param requirement_profiles: the RequirementProfiles of ScheduleConstraints
+        :param max_repair_steps: the number of moves the search may try for each student
+        """
+        Placement.__init__(self, schedule, requirement_profiles)
+        self.max_search_steps = max_repair_steps
+
+    def place(self):
+        """
+        Places the students. Returns the collisions of the students that weren't placed, an
+        empty list if every student was
+        """
+        unplaced = []
+        for profile in self.requirement_profiles:
+            for student_reqs in profile.student_requirements:
+                unplaced += self.place_student(self.students[student_reqs.student_id])
+        return self.student_collisions(unplaced)
+
+    def place_student(self, student):
+        """ places the student, returns the (student, course_id) pairs the repairs couldn't """
+        self.steps = 0
+        if self.seat(student, 0):
+            return []
+
+        # take the free seats there are, then repair around the courses left
+        unplaced = []
+        for course_id in student.required_course_ids:
+            if not self.place_in_free_class(student, course_id):
+                unplaced.append((student, course_id))
+        return self.search(unplaced)
+
+    def place_in_free_class(self, student, course_id):
+        for sch_class in self.schedule.scheduled_classes[course_id]:
+            if len(sch_class.students) < sch_class.max_student_count and student.is_free(sch_class.timeblock_bit):
+                self.add(student, sch_class)
+                return True
+        return False
@@ -1,10 +1,16 @@
 from schoolbloc.scheduler.models import *
 from schoolbloc.scheduler.classroom_constraint import ClassroomConstraint
+from schoolbloc.scheduler.constraint_snapshot import ConstraintSnapshot
 import schoolbloc.scheduler.scheduler_util as SchedUtil
 
 class TeacherConstraint:
-    def __init__(self, teacher_id):
+    def __init__(self, teacher_id, snapshot=None):
+        """
+        Holds the classroom and timeblock constraints of a teacher. Like ClassroomConstraint, the
+        object is never modified after it is built and relaxations are passed in by the caller
+        """
         self.teacher_id = teacher_id
+        self.snapshot = snapshot or ConstraintSnapshot()
         self.subject_ids = []
 
         self.mand_classroom_constraints = []
@@ -18,109 +24,101 @@ class TeacherConstraint:
         self.calc_subject_ids()
         self.calc_constraints()
 
-    def relax_constraints(self, class_id):
+    @classmethod
+    def cached(cls, teacher_id, snapshot):
+        """ Returns the TeacherConstraint for the teacher, building it once per snapshot """
+        key = (cls, teacher_id)
+        if key not in snapshot.constraint_cache:
+            snapshot.constraint_cache[key] = cls(teacher_id, snapshot)
+        return snapshot.constraint_cache[key]
+
+    def relax_key(self, *args):
+        return ('teacher', self.teacher_id) + args
+
+    def relax_constraints(self, class_id, relaxed):
         if len(self.mand_classroom_constraints) == 0:
-            if len(self.high_classroom_constraints) > 0:
+            if len(self.high_classroom_constraints) > 0 and self.relax_key('classroom') not in relaxed:
                 SchedUtil.log_note("info", "Scheduler", "Relaxing the teacher->classroom constraints for class {} (teacher: {})".format(
                     class_id, self.teacher_id))
-                self.high_classroom_constraints = []
+                relaxed.add(self.relax_key('classroom'))
                 return 
             else:
                 for cc in self.low_classroom_constraints:
-                    if cc.can_relax_constraints():
-                        cc.relax_constraints(class_id)
+                    if cc.can_relax_constraints(relaxed, self.relax_key()):
+                        cc.relax_constraints(class_id, relaxed, self.relax_key())
                         return
 
-        if len(self.mand_timeblock_ids) == 0 and len(self.high_timeblock_ids) > 0:
+        if len(self.mand_timeblock_ids) == 0 and len(self.high_timeblock_ids) > 0 and \
+                self.relax_key('timeblock') not in relaxed:
                 SchedUtil.log_note("info", "Scheduler", "Relaxing the teacher->timeblock constraints for class {} (teacher: {})".format(
                     class_id, self.teacher_id))
-                self.high_timeblock_ids = []
+                relaxed.add(self.relax_key('timeblock'))
                 return 
 
         return False
 
-    def can_relax_constraints(self):
+    def can_relax_constraints(self, relaxed=frozenset()):
         """
         Returns true if this teacher or its descendants contains high priority constraints that can
         fall back to low priority constraints
         """
         if len(self.mand_classroom_constraints) == 0:
-            if len(self.high_classroom_constraints) > 0:
+            if len(self.high_classroom_constraints) > 0 and self.relax_key('classroom') not in relaxed:
                 return True
             else:
                 for cc in self.low_classroom_constraints:
-                    if cc.can_relax_constraints():
+                    if cc.can_relax_constraints(relaxed, self.relax_key()):
                         return True
 
         if len(self.mand_timeblock_ids) == 0:
-            if len(self.high_timeblock_ids) > 0:
+            if len(self.high_timeblock_ids) > 0 and self.relax_key('timeblock') not in relaxed:
                 return True
 
         return False
 
-    def get_classroom_constraints(self):
+    def get_classroom_constraints(self, relaxed=frozenset()):
         if len(self.mand_classroom_constraints) > 0:
             return self.mand_classroom_constraints
-        elif len(self.high_classroom_constraints) > 0:
+        elif len(self.high_classroom_constraints) > 0 and self.relax_key('classroom') not in relaxed:
             return self.high_classroom_constraints
         else:
             return self.low_classroom_constraints
 
-    def get_classroom_ids(self):
-        return [ c.classroom_id for c in self.get_classroom_constraints() ]
+    def get_classroom_ids(self, relaxed=frozenset()):
+        return [ c.classroom_id for c in self.get_classroom_constraints(relaxed) ]
 
-    def get_timeblock_ids(self):
+    def get_timeblock_ids(self, relaxed=frozenset()):
         if len(self.mand_timeblock_ids) > 0:
             return self.mand_timeblock_ids
-        elif len(self.high_timeblock_ids) > 0:
+        elif len(self.high_timeblock_ids) > 0 and self.relax_key('timeblock') not in relaxed:
             return self.high_timeblock_ids
         else:
             return self.low_timeblock_ids
 
+    def get_classroom_timeblock_ids(self, classroom_constraint, relaxed=frozenset()):
+        """ Returns the timeblock ids of one of this teacher's classrooms """
+        return classroom_constraint.get_timeblock_ids(relaxed, self.relax_key())
+
 
     def calc_subject_ids(self):
-        ts_list = TeachersSubject.query.filter_by(teacher_id=self.teacher_id).all()
-        self.subject_ids = [ cs.subject_id for cs in ts_list ]
+        self.subject_ids = list(self.snapshot.teacher_subjects.get(self.teacher_id, []))
 
     def calc_constraints(self):
+        snapshot = self.snapshot
+
         # first calculate the timeblock id lists
-        self.mand_timeblock_ids = [ ct.timeblock_id for ct in 
-                        TeachersTimeblock.query.filter_by(priority='mandatory', 
-                                                            teacher_id=self.teacher_id,
-                                                            active=True).all() ]
-        self.high_timeblock_ids = [ ct.timeblock_id for ct in 
-                        TeachersTimeblock.query.filter_by(priority='high', 
-                                                            teacher_id=self.teacher_id,
-                                                            active=True).all() ]
-        self.low_timeblock_ids = [ ct.timeblock_id for ct in 
-                        TeachersTimeblock.query.filter_by(priority='low', 
-                                                            teacher_id=self.teacher_id,
-                                                            active=True).all() ]
-
-        not_timeblock_ids = [ ct.timeblock_id for ct in 
-                        TeachersTimeblock.query.filter_by(priority='not', 
-                                                            teacher_id=self.teacher_id,
-                                                            active=True).all() ]
-        for subject_id in self.subject_ids:
-            self.mand_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='mandatory', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-            self.high_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='high', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-            self.low_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='low', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
-            not_timeblock_ids += [ st.timeblock_id for st in 
-                             SubjectsTimeblock.query.filter_by(priority='not', 
-                                                               subject_id=subject_id,
-                                                               active=True).all() ]
+        self.mand_timeblock_ids = snapshot.lookup(snapshot.teacher_timeblocks, self.teacher_id, 'mandatory') + \
+                                  snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'mandatory')
+        self.high_timeblock_ids = snapshot.lookup(snapshot.teacher_timeblocks, self.teacher_id, 'high') + \
+                                  snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'high')
+        self.low_timeblock_ids = snapshot.lookup(snapshot.teacher_timeblocks, self.teacher_id, 'low') + \
+                                 snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'low')
+        not_timeblock_ids = snapshot.lookup(snapshot.teacher_timeblocks, self.teacher_id, 'not') + \
+                            snapshot.lookup_subjects(snapshot.subject_timeblocks, self.subject_ids, 'not')
+
         # if our low id set is empty. we assume all timeblocks are in the low set
         if len(self.low_timeblock_ids) == 0: 
-            self.low_timeblock_ids = [ t.id for t in Timeblock.query.all() ]
+            self.low_timeblock_ids = list(snapshot.timeblock_ids)
 
 
         self.mand_timeblock_ids = set(self.mand_timeblock_ids) - set(not_timeblock_ids)
@@ -128,51 +126,26 @@ class TeacherConstraint:
         self.low_timeblock_ids = set(self.low_timeblock_ids) - set(not_timeblock_ids)
 
         # now calculate the classrooms
-        mand_classroom_ids = [ ct.classroom_id for ct in 
-                               ClassroomsTeacher.query.filter_by(priority='mandatory', 
-                                                                 teacher_id=self.teacher_id,
-                                                                 active=True).all() ]
-        high_classroom_ids = [ ct.classroom_id for ct in 
-                               ClassroomsTeacher.query.filter_by(priority='high', 
-                                                                 teacher_id=self.teacher_id,
-                                                                 active=True).all() ]
-        low_classroom_ids = [ ct.classroom_id for ct in 
-                               ClassroomsTeacher.query.filter_by(priority='low', 
-                                                                 teacher_id=self.teacher_id,
-                                                                 active=True).all() ]
-        not_classroom_ids = [ ct.classroom_id for ct in 
-                               ClassroomsTeacher.query.filter_by(priority='not', 
-                                                                 teacher_id=self.teacher_id,
-                                                                 active=True).all() ]
-        for subject_id in self.subject_ids:
-            mand_classroom_ids += [ cs.classroom_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='mandatory', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-            high_classroom_ids += [ cs.classroom_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='high', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-            low_classroom_ids += [ cs.classroom_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='low', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
-            not_classroom_ids += [ cs.classroom_id for cs in 
-                                    ClassroomsSubject.query.filter_by(priority='not', 
-                                                                      subject_id=subject_id,
-                                                                      active=True).all() ]
+        mand_classroom_ids = snapshot.lookup(snapshot.teacher_classrooms, self.teacher_id, 'mandatory') + \
+                             snapshot.lookup_subjects(snapshot.subject_classrooms, self.subject_ids, 'mandatory')
+        high_classroom_ids = snapshot.lookup(snapshot.teacher_classrooms, self.teacher_id, 'high') + \
+                             snapshot.lookup_subjects(snapshot.subject_classrooms, self.subject_ids, 'high')
+        low_classroom_ids = snapshot.lookup(snapshot.teacher_classrooms, self.teacher_id, 'low') + \
+                            snapshot.lookup_subjects(snapshot.subject_classrooms, self.subject_ids, 'low')
+        not_classroom_ids = snapshot.lookup(snapshot.teacher_classrooms, self.teacher_id, 'not') + \
+                            snapshot.lookup_subjects(snapshot.subject_classrooms, self.subject_ids, 'not')
         
         # if our low id set is empty. we assume all timeblocks are in the low set
         if len(low_classroom_ids) == 0:
-            low_classroom_ids = [ c.id for c in Classroom.query.all() ]
+            low_classroom_ids = list(snapshot.classroom_ids)
 
         mand_classroom_ids = set(mand_classroom_ids) - set(not_classroom_ids)
         high_classroom_ids = set(high_classroom_ids) - set(not_classroom_ids)
         low_classroom_ids = set(low_classroom_ids) - set(not_classroom_ids)
 
         # now make a set of ClassroomConstraints from each list
-        self.mand_classroom_constraints = [ ClassroomConstraint(c_id) for c_id in mand_classroom_ids ]
-        self.high_classroom_constraints = [ ClassroomConstraint(c_id) for c_id in high_classroom_ids ]
-        self.low_classroom_constraints = [ ClassroomConstraint(c_id) for c_id in low_classroom_ids ]
+        self.mand_classroom_constraints = [ ClassroomConstraint.cached(c_id, snapshot) for c_id in mand_classroom_ids ]
+        self.high_classroom_constraints = [ ClassroomConstraint.cached(c_id, snapshot) for c_id in high_classroom_ids ]
+        self.low_classroom_constraints = [ ClassroomConstraint.cached(c_id, snapshot) for c_id in low_classroom_ids ]
 
 
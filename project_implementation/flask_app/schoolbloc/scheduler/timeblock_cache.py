@@ -0,0 +1,135 @@
+"""
+A process wide cache of what the scheduler and the serializers need of the timeblocks: their
+start and end times, their days in week order and their bit in ScheduleStudent.occupied.
+
+It is loaded on first use and dropped when a session that inserted, updated or deleted a
+Timeblock, TimeblocksDay or Day row through the ORM (the REST API, the csv import, the tests)
+commits or rolls back, so it is reloaded with the next use. While such changes are flushed but
+not committed, the loads aren't cached. Bulk inserts and raw SQL bypass the ORM events; call
+invalidate() after those.
+"""
+from collections import OrderedDict
+from threading import Lock
+from weakref import WeakSet
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from schoolbloc import db
+from schoolbloc.scheduler.models import Timeblock, TimeblocksDay, Day
+
+WEEK = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+# the days written to ScheduledClass.days (Sunday has never been listed there)
+SCHEDULED_CLASS_DAYS = WEEK[:6]
+
+_lock = Lock()
+_timeblocks = None
+# bumped by invalidate, so a load that raced a change isn't kept
+_generation = 0
+# the sessions that flushed timeblock changes they haven't committed or rolled back yet
+_pending = WeakSet()
+
+
+class TimeblockInfo:
+    """ The cached data of one timeblock """
+    __slots__ = ('id', 'start_time', 'end_time', 'days', 'bit')
+
+    def __init__(self, id, start_time, end_time, days, bit):
+        self.id = id
+        self.start_time = start_time
+        self.end_time = end_time
+        # the day names, in WEEK order (days not in WEEK last)
+        self.days = days
+        self.bit = bit
+
+    @property
+    def days_string(self):
+        """ the days as they are saved in ScheduledClass.days """
+        return ", ".join(d for d in self.days if d in SCHEDULED_CLASS_DAYS)
+
+    def __repr__(self):
+        return "<TimeblockInfo id={} start_time={} end_time={} days={}>".format(
+            self.id, self.start_time, self.end_time, self.days)
+
+
+def timeblocks():
+    """ timeblock id => TimeblockInfo of every timeblock, in id order. Don't modify it """
+    global _timeblocks
+    with _lock:
+        if _timeblocks is not None:
+            return _timeblocks
+        generation = _generation
+    loaded = load()
+    with _lock:
+        # a load may see the uncommitted changes of a session
+        if generation == _generation and len(_pending) == 0:
+            _timeblocks = loaded
+    return loaded
+
+
+def timeblock(timeblock_id):
+    """ the TimeblockInfo of one timeblock, reloading once if it isn't cached yet """
+    info = timeblocks().get(timeblock_id)
+    if info is None:
+        invalidate()
+        info = timeblocks().get(timeblock_id)
+    return info
+
+
+def days(timeblock_id):
+    """ the day names of a timeblock in week order, an empty list for an unknown timeblock """
+    info = timeblock(timeblock_id)
+    return list(info.days) if info else []
+
+
+def invalidate():
+    """ drops the cache """
+    global _timeblocks, _generation
+    with _lock:
+        _timeblocks = None
+        _generation += 1
+
+
+def load():
+    timeblock_days = {}
+    query = db.session.query(TimeblocksDay.timeblock_id, Day.name)\
+                      .join(Day, TimeblocksDay.day_id == Day.id)\
+                      .order_by(TimeblocksDay.id)
+    for timeblock_id, day_name in query:
+        timeblock_days.setdefault(timeblock_id, []).append(day_name)
+
+    def week_index(day_name):
+        return WEEK.index(day_name) if day_name in WEEK else len(WEEK)
+
+    infos = OrderedDict()
+    query = db.session.query(Timeblock.id, Timeblock.start_time, Timeblock.end_time).order_by(Timeblock.id)
+    for i, (timeblock_id, start_time, end_time) in enumerate(query):
+        day_names = tuple(sorted(timeblock_days.get(timeblock_id, []), key=week_index))
+        infos[timeblock_id] = TimeblockInfo(timeblock_id, start_time, end_time, day_names, 1 << i)
+    return infos
+
+
+def _changes_flushed(mapper, connection, target):
+    session = object_session(target)
+    with _lock:
+        if session is not None:
+            _pending.add(session)
+
+
+def _changes_ended(session):
+    with _lock:
+        if session not in _pending:
+            return
+        _pending.discard(session)
+    invalidate()
+
+
+def _changes_rolled_back(session, previous_transaction):
+    # the rollback of a savepoint leaves the changes flushed before it
+    if not previous_transaction.nested:
+        _changes_ended(session)
+
+
+for model in (Timeblock, TimeblocksDay, Day):
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, event_name, _changes_flushed)
+event.listen(Session, 'after_commit', _changes_ended)
+event.listen(Session, 'after_soft_rollback', _changes_rolled_back)
@@ -1,14 +1,13 @@
-from threading import Thread
-
-from flask import Blueprint, request
+from flask import Blueprint, Response, request
 from flask.ext.jwt import current_identity
 from flask.ext.restful import Api, Resource, abort
 from sqlalchemy.orm.exc import NoResultFound
 
 from schoolbloc import auth_required
-from schoolbloc.scheduler.restexport import TestRest, TestRestList
+from schoolbloc.scheduler.restexport import TestRest, TestRestList, get_rest_constraints
 from schoolbloc.scheduler.models import *
-from schoolbloc.scheduler.scheduler import Scheduler, SchedulerNoSolution
+from schoolbloc.scheduler.schedule_jobs import job_queue
+import schoolbloc.scheduler.schedule_views as schedule_views
 
 mod = Blueprint('api', __name__)
 api = Api(mod)
@@ -36,9 +35,11 @@ def register_rest_orm(orm, get='admin', put='admin', post='admin',
     """
     # We are basing the endpoint name on the tablename for simplicity sake
     name = orm.__tablename__
+    # The relationships of the constraints, worked out once for both endpoints
+    constraints = get_rest_constraints(orm)
 
     # Create the single object get/modify/delete endpoints, and apply access controls
-    cls = type(name, (TestRest,), {'orm': orm})
+    cls = type(name, (TestRest,), {'orm': orm, 'constraints': constraints})
     if get is not False:
         cls.get = auth_required(roles=get)(cls.get)
     if put is not False:
@@ -47,7 +48,7 @@ def register_rest_orm(orm, get='admin', put='admin', post='admin',
         cls.delete = auth_required(roles=delete)(cls.delete)
 
     # Create list/post endpoint, and apply access control decorators if present
-    cls_list = type(name + 'list', (TestRestList,), {'orm': orm})
+    cls_list = type(name + 'list', (TestRestList,), {'orm': orm, 'constraints': constraints})
     if list is not False:
         cls_list.get = auth_required(roles=list)(cls_list.get)
     if post is not False:
@@ -117,49 +118,85 @@ class UnreadNotifications(Resource):
         return [note.serialize() for note in notes]
 
 
+def schedule_view_response(schedule_id, name):
+    """ the cached JSON of a view of a schedule (see schedule_views) """
+    data = schedule_views.get(schedule_id, name)
+    if data is None:
+        abort(404, message="Schedule {} not found".format(schedule_id))
+    return Response(data, mimetype='application/json')
+
+
+def delete_schedule(schedule_id):
+    schedule = Schedule.query.get(schedule_id)
+    if not schedule:
+        abort(404, message="Schedule {} not found".format(schedule_id))
+    db.session.delete(schedule)
+    db.session.commit()
+    schedule_views.evict(schedule_id)
+    return {'success': True}
+
+
 class ScheduleApi(Resource):
 
     @auth_required(roles='admin')
     def get(self, schedule_id):
-        schedule = Schedule.query.get(schedule_id)
-        if not schedule:
-            abort(404, message="Schedule {} not found".format(schedule_id))
-        return schedule.serialize(expanded=True)
+        return schedule_view_response(schedule_id, 'class')
 
     @auth_required(roles='admin')
     def delete(self, schedule_id):
-        schedule = Schedule.query.get(schedule_id)
-        if not schedule:
-            abort(404, message="Schedule {} not found".format(schedule_id))
-        db.session.delete(schedule)
-        db.session.commit()
-        return {'success': True}
+        return delete_schedule(schedule_id)
 
 
 class ScheduleStudentApi(Resource):
 
     @auth_required(roles='admin')
     def get(self, schedule_id):
-        schedule = Schedule.query.get(schedule_id)
-        if not schedule:
-            abort(404, message="Schedule {} not found".format(schedule_id))
-        return schedule.student_serialize()
+        return schedule_view_response(schedule_id, 'student')
 
     @auth_required(roles='admin')
     def delete(self, schedule_id):
+        return delete_schedule(schedule_id)
+
+
+class ScheduleStudentTimetableApi(Resource):
+
+    @auth_required(roles=['student', 'parent', 'admin'])
+    def get(self, schedule_id, student_id):
         schedule = Schedule.query.get(schedule_id)
         if not schedule:
             abort(404, message="Schedule {} not found".format(schedule_id))
-        db.session.delete(schedule)
-        db.session.commit()
-        return {'success': True}
+        student = Student.query.get(student_id)
+        if not student:
+            abort(404, message="Student {} not found".format(student_id))
 
+        # students can see their own timetable, parents their students'
+        role = current_identity.role.role_type
+        if role == 'student' and student.user_id != current_identity.id:
+            abort(404, message='Access denied')
+        elif role == 'parent':
+            mapping = ParentStudentMapper.query.join(Parent, ParentStudentMapper.parent_id == Parent.id)\
+                                               .filter(Parent.user_id == current_identity.id,
+                                                       ParentStudentMapper.student_id == student.id).first()
+            if not mapping:
+                abort(404, message='Access denied')
+        return schedule.student_timetable(student)
 
-class CreateSchedule(Thread):
 
-    def run(self):
-        scheduler = Scheduler()
-        scheduler.make_schedule()
+class ScheduleTeacherTimetableApi(Resource):
+
+    @auth_required(roles=['teacher', 'admin'])
+    def get(self, schedule_id, teacher_id):
+        schedule = Schedule.query.get(schedule_id)
+        if not schedule:
+            abort(404, message="Schedule {} not found".format(schedule_id))
+        teacher = Teacher.query.get(teacher_id)
+        if not teacher:
+            abort(404, message="Teacher {} not found".format(teacher_id))
+
+        # teachers can see their own timetable
+        if current_identity.role.role_type == 'teacher' and teacher.user_id != current_identity.id:
+            abort(404, message='Access denied')
+        return schedule.teacher_timetable(teacher)
 
 
 class ScheduleListApi(Resource):
@@ -171,10 +208,40 @@ class ScheduleListApi(Resource):
 
     @auth_required(roles='admin')
     def post(self):
-        worker_thread = CreateSchedule()
-        worker_thread.daemon = True
-        worker_thread.start()
-        return {'success': 'Started generating schedule'}
+        options = request.get_json(force=True, silent=True) or {}
+        # race the PortfolioScheduler configurations instead of running the default one
+        job = job_queue.submit(portfolio=bool(options.get('portfolio', False)))
+        return {'success': 'Started generating schedule', 'job': job.serialize()}
+
+
+class ScheduleJobListApi(Resource):
+
+    @auth_required(roles='admin')
+    def get(self):
+        jobs = ScheduleJob.query.order_by(ScheduleJob.id.desc()).all()
+        return [job.serialize() for job in jobs]
+
+
+class ScheduleJobApi(Resource):
+
+    @auth_required(roles='admin')
+    def get(self, job_id):
+        job = ScheduleJob.query.get(job_id)
+        if not job:
+            abort(404, message="Schedule job {} not found".format(job_id))
+        return job.serialize()
+
+
+class ScheduleJobCancelApi(Resource):
+
+    @auth_required(roles='admin')
+    def post(self, job_id):
+        if not ScheduleJob.query.get(job_id):
+            abort(404, message="Schedule job {} not found".format(job_id))
+        job = job_queue.cancel(job_id)
+        if not job:
+            abort(400, message="Schedule job {} already finished".format(job_id))
+        return job.serialize()
 
 
 class ParentsStudents(Resource):
@@ -431,6 +498,11 @@ class StudentCourseSelector(Resource):
 api.add_resource(UnreadNotifications, '/api/notifications/unread')
 api.add_resource(ScheduleApi, '/api/schedules/<int:schedule_id>/class')
 api.add_resource(ScheduleStudentApi, '/api/schedules/<int:schedule_id>/student')
+api.add_resource(ScheduleStudentTimetableApi, '/api/schedules/<int:schedule_id>/students/<int:student_id>')
+api.add_resource(ScheduleTeacherTimetableApi, '/api/schedules/<int:schedule_id>/teachers/<int:teacher_id>')
 api.add_resource(ScheduleListApi, '/api/schedules')
+api.add_resource(ScheduleJobListApi, '/api/schedules/jobs')
+api.add_resource(ScheduleJobApi, '/api/schedules/jobs/<int:job_id>')
+api.add_resource(ScheduleJobCancelApi, '/api/schedules/jobs/<int:job_id>/cancel')
 api.add_resource(ParentsStudents, '/api/my_students')
 api.add_resource(StudentCourseSelector, '/api/student_course')
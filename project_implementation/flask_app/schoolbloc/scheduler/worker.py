@@ -0,0 +1,120 @@
+"""
+Runs the scheduler in a process of its own, outside the web app. ScheduleJobQueue launches it
+for the jobs of the api, and it can be run by hand from the flask_app directory:
+
+    python -m schoolbloc.scheduler.worker [--portfolio] [--db-uri sqlite:///../schoolbloc.db]
+    python -m schoolbloc.scheduler.worker --job 12 [--verbosity warning]
+
+ScheduleJobQueue passes the app's database URI in the SCHOOLBLOC_DB_URI environment variable
+rather than with --db-uri, which would show it (and its credentials) to every user in ps.
+
+The worker reads the facts and constraints into a ConstraintSnapshot (see ScheduleConstraints),
+solves, and writes the schedule and the notifications back through its own DB connection,
+so the z3 checks and the scheduler's queries never hold the app's GIL or its session.
+"""
+import argparse
+import os
+import sys
+import time
+from sqlalchemy.orm import Session
+from schoolbloc import app, db
+from schoolbloc.scheduler.models import ScheduleJob
+from schoolbloc.scheduler.scheduler import Scheduler, SchedulerNoSolution
+from schoolbloc.scheduler.portfolio_scheduler import PortfolioScheduler
+import schoolbloc.scheduler.scheduler_util as SchedUtil
+
+# the environment variable of the database URI, used without --db-uri
+DB_URI_ENV = 'SCHOOLBLOC_DB_URI'
+
+
+class JobProgress:
+    """
+    The Scheduler progress callback of a job, writes the counts to its row at most once a second
+    from a session of its own, so it never commits what the scheduler has in its session
+    """
+
+    def __init__(self, job_id):
+        self.job_id = job_id
+        self.written_at = 0
+
+    def __call__(self, check_count, class_count):
+        if time.time() - self.written_at < 1:
+            return
+        self.written_at = time.time()
+        session = Session(bind=db.engine)
+        try:
+            session.query(ScheduleJob).filter_by(id=self.job_id).update({'check_count': check_count,
+                                                                         'class_count': class_count})
+            session.commit()
+        finally:
+            session.close()
+
+
+def make_schedule(portfolio=False, progress=None):
+    """ makes and saves a schedule, returns (the Schedule id, the solver checks made) """
+    if portfolio:
+        return PortfolioScheduler().make_schedule(), None
+    scheduler = Scheduler(progress=progress)
+    return scheduler.make_schedule(), scheduler.check_count
+
+
+def run_job(job_id):
+    """ makes the schedule of a ScheduleJob, keeping its row up to date. Returns the exit code """
+    job = ScheduleJob.query.get(job_id)
+    if job is None:
+        print("Schedule job {} not found".format(job_id), file=sys.stderr)
+        return 2
+
+    try:
+        schedule_id, check_count = make_schedule(job.portfolio, JobProgress(job_id))
+    except SchedulerNoSolution as e:
+        db.session.rollback()
+        job.finish('failed', e.message)
+        db.session.commit()
+        return 1
+    except Exception as e:
+        db.session.rollback()
+        job.finish('failed', "{}: {}".format(type(e).__name__, e))
+        db.session.commit()
+        raise
+
+    if check_count is not None:
+        job.check_count = check_count
+    job.finish('succeeded', "Saved schedule {}".format(schedule_id), schedule_id)
+    db.session.commit()
+    return 0
+
+
+def main(argv=None):
+    # the worker saves its own notes, not those of a process it may have been forked from
+    SchedUtil.reset_notes()
+    parser = argparse.ArgumentParser(description="Scheduler worker")
+    parser.add_argument('--job', type=int, help="id of the ScheduleJob to run")
+    parser.add_argument('--portfolio', action='store_true',
+                        help="race the PortfolioScheduler configurations (without --job)")
+    parser.add_argument('--db-uri', help="the SQLALCHEMY_DATABASE_URI of the app "
+                                         "(default: ${}, then config.py)".format(DB_URI_ENV))
+    parser.add_argument('--verbosity', choices=['info', 'warning', 'error'],
+                        help="the least important notifications kept (default: config.notification_verbosity)")
+    args = parser.parse_args(argv)
+
+    db_uri = args.db_uri or os.environ.get(DB_URI_ENV)
+    if db_uri:
+        # before the first query, so the engine is made for it
+        app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    if args.verbosity:
+        SchedUtil.set_verbosity(args.verbosity)
+    if args.job is not None:
+        return run_job(args.job)
+
+    try:
+        schedule_id, check_count = make_schedule(args.portfolio)
+    except SchedulerNoSolution as e:
+        print("No schedule: {}".format(e.message), file=sys.stderr)
+        return 1
+    print("Saved schedule {}".format(schedule_id))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
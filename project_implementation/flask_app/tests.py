@@ -3,6 +3,9 @@ import unittest
 # from schoolbloc.users.tests import UserTests
 # from schoolbloc.classrooms.tests import ClassroomTests
 from schoolbloc.scheduler.full_tests import FullScheduleTests
+from schoolbloc.scheduler.constraint_tests import ConstraintTests
+from schoolbloc.scheduler.placement_tests import PlacementTests
+from schoolbloc.scheduler.api_tests import ApiTests
 # from schoolbloc.scheduler.tests import SchedulerTests
 # from schoolbloc.data_import.tests import ImportTests
 